@@ -7,117 +7,434 @@ Created on Tue Feb 18 13:03:46 2014
 
 import socket
 import select
+import threading
 import time
+import collections
+
+try:  # python 2
+    import Queue as queue
+except ImportError:  # python 3
+    import queue
+
+# Messages are lines of text. A line "REQ <id> <text>" is a request, answered
+# with "REP <id> <reply>"; any other line is fire-and-forget.
+DELIM = b"\n"
+REQUEST_PREFIX = "REQ "
+REPLY_PREFIX = "REP "
+
+# How often the server thread checks whether it should stop
+SELECT_TIMEOUT = 0.1  # s
+# broadcast() skips clients with more than this many bytes still unsent
+MAX_WRITE_BUFFER = 2**20
+
+# Client timing: replies are looked for every POLL_PERIOD; after losing the
+# connection the client retries after RECONNECT_BACKOFF, doubling the wait
+# after every failure up to MAX_BACKOFF
+POLL_PERIOD = 0.01  # s
+CONNECT_TIMEOUT = 1.0  # s
+SEND_TIMEOUT = 1.0  # s
+RECONNECT_BACKOFF = 0.1  # s
+MAX_BACKOFF = 5.0  # s
+
+
+class _Connection:
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.read_buffer = b""
+        self.write_buffer = b""
 
 
 class AsyncSocketServer:
-    def __init__(self, port_number=50000):
+    """
+    Line based TCP server that runs on its own thread, so nothing is lost
+    between polls. Any number of clients can be connected at once, and every
+    complete line from any of them is delivered in the order it arrived:
+    either passed to on_message(line) on the server thread, or, if on_message
+    is None, put in self.messages for run()/get_lines() to pick up (e.g.
+    from a Qt timer).
+
+    Requests ("REQ <id> <text>") are answered on the server thread with
+    request_handler(text), which should return quickly. Without a
+    request_handler they are delivered like any other line.
+    """
+
+    def __init__(self, port_number=50000, on_message=None, request_handler=None):
         self.port_number = port_number
-        self.sock_conn = None
+        self.on_message = on_message
+        self.request_handler = request_handler
         self.sock_server = None
-        self.read_buffer = ""
+        self.connections = {}  # socket -> _Connection
+        self.messages = queue.Queue()
+        self.lock = threading.Lock()  # guards connections and their buffers
 
         self.bVerbose = False
 
+        self._shutdown = threading.Event()
+        self._thread = None
         self.startListening()
 
     def startListening(self):
-        # Initialization part: starts listening on the two ports
+        # Initialization part: starts listening on the port
         print("Creating server socket...")
         HOST = ""  # means local host
 
         self.sock_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock_server.setblocking(0)
+        # A restarted server can bind again while connections of the last
+        # one are still in TIME_WAIT. On Windows SO_REUSEADDR would also let
+        # a second server take a port that is in use, so there the port is
+        # claimed exclusively instead (TIME_WAIT does not block a bind there)
+        if hasattr(socket, "SO_EXCLUSIVEADDRUSE"):
+            self.sock_server.setsockopt(
+                socket.SOL_SOCKET, socket.SO_EXCLUSIVEADDRUSE, 1
+            )
+        else:
+            self.sock_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock_server.bind((HOST, self.port_number))
         self.sock_server.listen(5)
 
+        self._shutdown.clear()
+        self._thread = threading.Thread(
+            target=self._serve, name="socket server %i" % self.port_number
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stopListening(self):
+        self._shutdown.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    close = stopListening
+
     def run(self):
-        # First: check if there is any connection pending:
-        # Check if there is a connection pending:
-        # note the [0] at the end which selects only the first output of the
-        # select()
-        if self.bVerbose:
-            print("First")
-        ready_to_read = select.select([self.sock_server], [], [], 0)[0]
+        """Returns the oldest line not yet picked up, or None"""
+        try:
+            return self.messages.get_nowait()
+        except queue.Empty:
+            return None
 
-        if ready_to_read:
-            (sock_conn, addr) = self.sock_server.accept()
-            sock_conn.setblocking(0)
-            self.sock_conn = sock_conn
-            self.conn_addr = addr
-            if self.bVerbose:
-                print("Accepted connection from %s" % str(addr))
-
-        # Second: try to read from the socket:
-        # We need a try/catch around these lines as the socket could have been
-        # closed in the meantime (or any number of possible errors):
-        if self.bVerbose:
-            print("Second")
-        if self.sock_conn:
+    def get_lines(self):
+        """Returns every line not yet picked up, oldest first"""
+        lines = []
+        line = self.run()
+        while line is not None:
+            lines.append(line)
+            line = self.run()
+        return lines
+
+    def broadcast(self, text):
+        """
+        Queues text to be sent to every connected client. A client that is
+        not keeping up (more than MAX_WRITE_BUFFER bytes unsent) misses it.
+        """
+        data = text.encode("ascii")
+        with self.lock:
+            for connection in self.connections.values():
+                if len(connection.write_buffer) < MAX_WRITE_BUFFER:
+                    connection.write_buffer += data
+
+    def _serve(self):
+        while not self._shutdown.is_set():
+            with self.lock:
+                readers = [self.sock_server] + list(self.connections)
+                writers = [s for s, c in self.connections.items() if c.write_buffer]
             try:
-                (read_buffer, bSocketOpen) = self.readdata_async(
-                    self.sock_conn, self.read_buffer
-                )
-                self.read_buffer = read_buffer
-
-                if not bSocketOpen:
-                    # socket has been closed on the other side:
-                    if self.bVerbose:
-                        print("Socket closed detected.")
-                    self.sock_conn = None
-            except:
-                # probably better to just close the socket if we get here:
-                print("Read generated an exception")
-                # self.sock_conn.close() # this can also throw an exception:
-                self.sock_conn = None
-        #                raise
-
-        # parse the receive buffer:
-        delim = "\n"
-        line = None
-        while self.read_buffer.find(delim) != -1:
-            line, self.read_buffer = self.read_buffer.split("\n", 1)
-
-        # if we have a valid line, this is what we output:
-        return line
-
-    def readdata_async(self, sock, read_buffer):
+                ready_to_read, ready_to_write = select.select(
+                    readers, writers, [], SELECT_TIMEOUT
+                )[:2]
+            except (select.error, socket.error, ValueError) as e:
+                print("Socket server select failed: %s" % e)
+                time.sleep(SELECT_TIMEOUT)
+                continue
+
+            for sock in ready_to_read:
+                if sock is self.sock_server:
+                    self._accept()
+                else:
+                    self._read(sock)
+            for sock in ready_to_write:
+                if sock in self.connections:
+                    self._write(sock)
+
+        for sock in list(self.connections):
+            self._drop(sock)
+        self.sock_server.close()
+
+    def _accept(self):
+        try:
+            (sock_conn, addr) = self.sock_server.accept()
+        except socket.error:
+            return
+        sock_conn.setblocking(0)
+        with self.lock:
+            self.connections[sock_conn] = _Connection(sock_conn, addr)
         if self.bVerbose:
-            print("readdata_async: entering")
-        recv_buffer = 4096
-        data = True
-        while data:
-            # Check if there is data:
-            # note the [0] at the end which selects only the first output of
-            # the select()
-            ready_to_read = select.select([sock], [], [], 0)[0]
-
-            if ready_to_read:
-                data = sock.recv(recv_buffer)
-
-                if not data:
-                    # This means that the other end has closed the socket:
-                    if self.bVerbose:
-                        print("socket close detected")
-                        print("readdata_async: exiting")
-                    return (read_buffer, False)
-
-                read_buffer += data
-                # print('read buffer: %s' % read_buffer)
-            else:
-                break
+            print("Accepted connection from %s" % str(addr))
 
+    def _drop(self, sock):
+        with self.lock:
+            connection = self.connections.pop(sock)
         if self.bVerbose:
-            print("readdata_async: exiting")
-        return (read_buffer, True)
+            print("Connection from %s closed." % str(connection.addr))
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def _read(self, sock):
+        try:
+            data = sock.recv(4096)
+        except socket.error:
+            data = b""
+        if not data:
+            # the other end has closed the socket
+            self._drop(sock)
+            return
+
+        connection = self.connections[sock]
+        lines = (connection.read_buffer + data).split(DELIM)
+        connection.read_buffer = lines.pop()
+        for line in lines:
+            self._dispatch(connection, line.decode("ascii", "replace").rstrip("\r"))
+
+    def _write(self, sock):
+        connection = self.connections[sock]
+        with self.lock:
+            data = connection.write_buffer
+        try:
+            sent = sock.send(data)
+        except socket.error:
+            self._drop(sock)
+            return
+        with self.lock:
+            connection.write_buffer = connection.write_buffer[sent:]
+
+    def _dispatch(self, connection, line):
+        if not line:
+            return
+        if line.startswith(REQUEST_PREFIX) and self.request_handler is not None:
+            request_id, _, text = line[len(REQUEST_PREFIX) :].partition(" ")
+            try:
+                reply = self.request_handler(text)
+            except Exception as e:
+                reply = "ERROR %s" % e
+            with self.lock:
+                connection.write_buffer += (
+                    "%s%s %s\n" % (REPLY_PREFIX, request_id, reply)
+                ).encode("ascii")
+        elif self.on_message is not None:
+            self.on_message(line)
+        else:
+            self.messages.put(line)
 
 
 class AsyncSocketClient:
-    def __init__(self, PORT=50000):
+    """
+    Line based TCP client whose socket is owned by a background thread, so
+    sending never blocks the caller: send_text() only queues the line.
+
+    If the connection is lost (e.g. the server is restarted) the thread
+    reconnects with exponential backoff, from RECONNECT_BACKOFF up to
+    max_backoff seconds, and then sends whatever was queued meanwhile. At
+    most max_queue lines are kept; beyond that the oldest are dropped.
+
+    send_setpoint() is for values where only the newest matters: a setpoint
+    that has not been sent yet is replaced rather than queued behind it.
+
+    The constructor still raises socket.error if no server is listening, so
+    callers can tell that nothing is there. See stats() for health and
+    latency figures.
+    """
+
+    def __init__(self, PORT=50000, max_queue=1000, max_backoff=MAX_BACKOFF):
         HOST = "localhost"  # means local host
         self.PORT = PORT
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((HOST, self.PORT))
+        self.address = (HOST, self.PORT)
+        self.max_backoff = max_backoff  # s
+
+        self.lock = threading.Lock()
+        self.queue = collections.deque()  # (time queued, line)
+        self.max_queue = max_queue
+        self.setpoint = None  # (time queued, line) of the unsent setpoint
+        self.requests = {}  # request id (str) -> [Event, reply]
+        self.request_id = 0
+        self.read_buffer = b""
+
+        # metrics
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.reconnects = 0
+        self.last_error = None
+        self.last_latency = None  # s from send_text() to the line being sent
+        self.max_latency = 0.0
+
+        self.sock = self._connect()
+        self._wakeup = threading.Event()
+        self._shutdown = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="socket client %i" % self.PORT
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def stats(self):
+        with self.lock:
+            queued = len(self.queue) + (self.setpoint is not None)
+        return dict(
+            connected=self.connected,
+            queued=queued,
+            sent=self.sent,
+            dropped=self.dropped,
+            coalesced=self.coalesced,
+            reconnects=self.reconnects,
+            last_error=self.last_error,
+            last_latency=self.last_latency,
+            max_latency=self.max_latency,
+        )
+
+    def _encode(self, txt):
+        if not isinstance(txt, bytes):
+            txt = txt.encode("ascii")
+        return txt
+
+    def _enqueue(self, line):
+        # called with self.lock held
+        if len(self.queue) >= self.max_queue:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(line)
 
     def send_text(self, txt_to_send):
-        self.sock.sendall(txt_to_send)
+        with self.lock:
+            # keep the order of a pending setpoint and this line
+            if self.setpoint is not None:
+                self._enqueue(self.setpoint)
+                self.setpoint = None
+            self._enqueue((time.time(), self._encode(txt_to_send)))
+        self._wakeup.set()
+
+    def send_setpoint(self, txt_to_send):
+        with self.lock:
+            if self.setpoint is not None:
+                self.coalesced += 1
+            self.setpoint = (time.time(), self._encode(txt_to_send))
+        self._wakeup.set()
+
+    def request(self, text, timeout=1.0):
+        """Sends text as a request and returns the server's reply"""
+        with self.lock:
+            self.request_id += 1
+            request_id = str(self.request_id)
+            pending = self.requests[request_id] = [threading.Event(), None]
+        self.send_text("%s%s %s\n" % (REQUEST_PREFIX, request_id, text))
+        try:
+            if not pending[0].wait(timeout):
+                raise IOError("No reply to request %r" % text)
+            return pending[1]
+        finally:
+            with self.lock:
+                self.requests.pop(request_id, None)
+
+    def close(self):
+        self._shutdown.set()
+        self._wakeup.set()
+        self._thread.join()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, CONNECT_TIMEOUT)
+        sock.settimeout(SEND_TIMEOUT)
+        return sock
+
+    def _disconnect(self, error):
+        self.last_error = str(error)
+        try:
+            self.sock.close()
+        except (socket.error, AttributeError):
+            pass
+        self.sock = None
+
+    def _reconnect(self, backoff):
+        try:
+            self.sock = self._connect()
+        except socket.error as e:
+            self.last_error = str(e)
+            self._shutdown.wait(backoff)
+            return min(2 * backoff, self.max_backoff)
+        self.reconnects += 1
+        self.read_buffer = b""
+        return RECONNECT_BACKOFF
+
+    def _flush(self):
+        with self.lock:
+            batch = list(self.queue)
+            self.queue.clear()
+            if self.setpoint is not None:
+                batch.append(self.setpoint)
+                self.setpoint = None
+        if not batch:
+            return
+        try:
+            self.sock.sendall(b"".join(line for t, line in batch))
+        except socket.error as e:
+            # put the batch back, in front of anything queued since
+            with self.lock:
+                self.queue.extendleft(reversed(batch))
+                while len(self.queue) > self.max_queue:
+                    self.queue.popleft()
+                    self.dropped += 1
+            self._disconnect(e)
+            return
+        now = time.time()
+        self.sent += len(batch)
+        self.last_latency = now - batch[-1][0]
+        self.max_latency = max(self.max_latency, now - batch[0][0])
+
+    def _receive(self, timeout=0):
+        if not select.select([self.sock], [], [], timeout)[0]:
+            return
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            self._disconnect(e)
+            return
+        if not data:
+            self._disconnect("connection closed by server")
+            return
+        lines = (self.read_buffer + data).split(DELIM)
+        self.read_buffer = lines.pop()
+        for line in lines:
+            line = line.decode("ascii", "replace").rstrip("\r")
+            if not line.startswith(REPLY_PREFIX):
+                continue
+            request_id, _, reply = line[len(REPLY_PREFIX) :].partition(" ")
+            with self.lock:
+                pending = self.requests.get(request_id)
+            if pending is not None:
+                pending[1] = reply
+                pending[0].set()
+
+    def _run(self):
+        backoff = RECONNECT_BACKOFF
+        while not self._shutdown.is_set():
+            if self.sock is None:
+                backoff = self._reconnect(backoff)
+                continue
+            self._wakeup.wait(POLL_PERIOD)
+            self._wakeup.clear()
+            self._flush()
+            if self.sock is not None:
+                # While a request is waiting, wait on the socket instead, so
+                # the reply is picked up as soon as it arrives
+                self._receive(POLL_PERIOD if self.requests else 0)
+
+        if self.sock is not None:
+            self._flush()
+            self._disconnect("closed")
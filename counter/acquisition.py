@@ -0,0 +1,179 @@
+# %% package imports
+import threading
+import time
+import numpy as np
+
+# %% global variables
+# Number of readings held by each ring buffer. At a 0.1 s gate time this is
+# almost two hours of data per channel.
+DEFAULT_BUFFER_SIZE = 2**16
+
+
+# %% ring buffer
+class RingBuffer:
+    """
+    Fixed size buffer of timestamped readings.
+
+    There is exactly one producer (the acquisition worker) and any number of
+    consumers. The producer writes the sample first and only then advances
+    self.head, which is a single attribute assignment and therefore atomic
+    under the GIL, so no lock is needed. Every consumer keeps its own cursor
+    (see RingReader) and drains the buffer at its own rate. A consumer that
+    falls more than self.size samples behind loses the oldest samples, and
+    is told how many.
+    """
+
+    def __init__(self, size=DEFAULT_BUFFER_SIZE):
+        self.size = int(size)
+        self.times = np.zeros(self.size)
+        self.values = np.zeros(self.size)
+        # total number of samples ever written
+        self.head = 0
+
+    def push(self, t, value):
+        i = self.head % self.size
+        self.times[i] = t
+        self.values[i] = value
+        self.head += 1
+
+    def read(self, cursor, head=None):
+        """
+        Returns (times, values, new_cursor, dropped) for every sample written
+        since cursor.
+        """
+        if head is None:
+            head = self.head
+        start = max(cursor, head - self.size)
+        dropped = start - cursor
+
+        idx = np.arange(start, head) % self.size
+        times = self.times[idx]
+        values = self.values[idx]
+
+        # The producer may have lapped us while we were copying; throw away
+        # anything that was overwritten during the copy
+        overrun = self.head - self.size - start
+        if overrun > 0:
+            times = times[overrun:]
+            values = values[overrun:]
+            dropped += overrun
+        return times, values, head, dropped
+
+    def latest(self, n=1):
+        """Returns the last n samples (oldest first) without moving any cursor"""
+        head = self.head
+        n = min(n, head, self.size)
+        times, values, _, _ = self.read(head - n, head)
+        return times, values
+
+    def reader(self, from_start=False):
+        return RingReader(self, from_start)
+
+    def __len__(self):
+        return min(self.head, self.size)
+
+
+class RingReader:
+    """
+    A consumer's cursor into a RingBuffer
+    """
+
+    def __init__(self, buffer, from_start=False):
+        self.buffer = buffer
+        self.cursor = max(0, buffer.head - buffer.size) if from_start else buffer.head
+        self.dropped = 0
+
+    def drain(self):
+        times, values, self.cursor, dropped = self.buffer.read(self.cursor)
+        self.dropped += dropped
+        return times, values
+
+    def pending(self):
+        return self.buffer.head - self.cursor
+
+
+# %% function defs
+def pair_by_time(times_a, times_b, tolerance):
+    """
+    Pairs every time in times_a with the nearest time in times_b (both
+    sorted). Returns index arrays (ia, ib) of the pairs that are no more than
+    tolerance apart.
+    """
+    times_a = np.asarray(times_a)
+    times_b = np.asarray(times_b)
+    if not len(times_a) or not len(times_b):
+        empty = np.zeros(0, dtype=int)
+        return empty, empty
+
+    right = np.clip(np.searchsorted(times_b, times_a), 1, len(times_b) - 1)
+    left = right - 1
+    if len(times_b) == 1:
+        ib = np.zeros(len(times_a), dtype=int)
+    else:
+        use_left = abs(times_a - times_b[left]) <= abs(times_b[right] - times_a)
+        ib = np.where(use_left, left, right)
+
+    ia = np.flatnonzero(abs(times_b[ib] - times_a) <= tolerance)
+    return ia, ib[ia]
+
+
+# %% acquisition worker
+class AcquisitionWorker(threading.Thread):
+    """
+    Reads one instrument in a loop on its own thread and pushes every reading
+    into self.buffer, stamped with time.perf_counter() taken right after the
+    read returned.
+
+    read_func is a blocking callable that returns one frequency (Hz). If it
+    raises, the exception is stored in self.error and the worker pauses
+    itself; the owner is expected to check self.error, deal with it, and
+    call resume().
+
+    If bus (a telemetry.TelemetryBus) is given, every reading is also
+    published on it under topic.
+    """
+
+    def __init__(self, read_func, buffer=None, name=None, bus=None, topic=None):
+        super().__init__(name=name, daemon=True)
+        self.read_func = read_func
+        self.buffer = RingBuffer() if buffer is None else buffer
+        self.bus = bus
+        self.topic = topic
+        self.error = None
+
+        self._enabled = threading.Event()
+        self._shutdown = threading.Event()
+        self._enabled.set()
+
+    def run(self):
+        while not self._shutdown.is_set():
+            if not self._enabled.wait(0.1):
+                continue
+            try:
+                value = self.read_func()
+            except Exception as e:
+                if self._shutdown.is_set():
+                    break
+                self.error = e
+                self._enabled.clear()
+                continue
+            t = time.perf_counter()
+            self.buffer.push(t, value)
+            if self.bus is not None:
+                self.bus.publish(self.topic, t, value)
+
+    def pause(self):
+        self._enabled.clear()
+
+    def resume(self):
+        self.error = None
+        self._enabled.set()
+
+    def is_paused(self):
+        return not self._enabled.is_set()
+
+    def stop(self, timeout=None):
+        self._shutdown.set()
+        self._enabled.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,147 @@
+# %% package imports
+import numpy as np
+
+# %% global variables
+# Largest averaging factor tracked, as a power of two (2**14 samples is about
+# half an hour at a 0.1 s gate time)
+DEFAULT_MAX_OCTAVE = 14
+
+
+# %% streaming Allan deviation
+class StreamingAllan:
+    """
+    Overlapping Allan deviation and modified Allan deviation of a frequency
+    series, updated one sample at a time.
+
+    Averaging factors are octave spaced, m = 1, 2, 4, ... 2**max_octave. The
+    frequency readings are turned into fractional frequency y relative to
+    nominal (the first reading if not given) and summed into phase x (in
+    units of tau0). Each new phase point closes exactly one second
+    difference
+        d = x[n] - 2 x[n - m] + x[n - 2 m]
+    per averaging factor, so the accumulators
+        ADEV^2(m) = sum(d^2) / (2 m^2 N_d)
+        MDEV^2(m) = sum(S^2) / (2 m^4 N_S),  S = sum of the last m d's
+    cost O(number of taus) per sample, independent of the run length, and
+    nothing ever has to be recomputed. The readings are assumed to be evenly
+    spaced; tau0 is taken from the timestamps passed to update() when there
+    are any.
+    """
+
+    def __init__(self, tau0=1.0, nominal=None, max_octave=DEFAULT_MAX_OCTAVE):
+        self.tau0 = tau0  # s
+        self.nominal = nominal  # Hz
+        self.m = 2 ** np.arange(max_octave + 1)
+        self.reset()
+
+    def reset(self):
+        num = len(self.m)
+        max_m = self.m[-1]
+
+        # ring of the last 2 * max_m + 1 phase points
+        self.x = np.zeros(2 * max_m + 1)
+        self.n = 0  # number of phase points so far
+        self.t_first = None
+        self.t_last = None
+
+        self.adev_sums = np.zeros(num)
+        self.adev_counts = np.zeros(num, dtype=int)
+
+        # ring of the last m second differences for each m, and their sum
+        self.d_ring = np.zeros((num, max_m))
+        self.d_sums = np.zeros(num)
+        self.d_counts = np.zeros(num, dtype=int)
+        self.mdev_sums = np.zeros(num)
+        self.mdev_counts = np.zeros(num, dtype=int)
+
+        self._rows = np.arange(num)
+
+    def update(self, freqs, times=None):
+        freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+        if not len(freqs):
+            return
+        if self.nominal is None:
+            self.nominal = freqs[0]
+        if times is not None and len(times):
+            if self.t_first is None:
+                self.t_first = times[0]
+            self.t_last = times[-1]
+
+        if not self.n:
+            # the phase series starts at zero
+            self.n = 1
+        size = len(self.x)
+        x = self.x[(self.n - 1) % size]
+        for y in (freqs - self.nominal) / self.nominal:
+            x += y
+            self.x[self.n % size] = x
+            self._step()
+            self.n += 1
+
+    def _step(self):
+        size = len(self.x)
+        n = self.n
+        ok = n >= 2 * self.m
+        if not ok.any():
+            return
+        m = self.m[ok]
+        rows = self._rows[ok]
+
+        d = self.x[n % size] - 2 * self.x[(n - m) % size] + self.x[(n - 2 * m) % size]
+        self.adev_sums[rows] += d**2
+        self.adev_counts[rows] += 1
+
+        # Slide each m-long window of second differences forward by one
+        slot = self.d_counts[rows] % m
+        full = self.d_counts[rows] >= m
+        self.d_sums[rows] += d - np.where(full, self.d_ring[rows, slot], 0)
+        self.d_ring[rows, slot] = d
+        self.d_counts[rows] += 1
+
+        full = self.d_counts[rows] >= m
+        self.mdev_sums[rows[full]] += self.d_sums[rows[full]] ** 2
+        self.mdev_counts[rows[full]] += 1
+
+    def taus(self):
+        tau0 = self.tau0
+        if self.t_first is not None and self.n > 2:
+            # average spacing of the readings
+            tau0 = (self.t_last - self.t_first) / (self.n - 2)
+        return self.m * tau0
+
+    def adev(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self.adev_sums / (2 * self.m**2 * self.adev_counts))
+
+    def mdev(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self.mdev_sums / (2 * self.m**4 * self.mdev_counts))
+
+    def results(self):
+        """Returns (taus, adev, mdev) for every tau that has data"""
+        valid = self.adev_counts > 0
+        return self.taus()[valid], self.adev()[valid], self.mdev()[valid]
+
+
+# %% function defs
+def overlapping_adev(freqs, tau0=1.0, nominal=None, max_octave=DEFAULT_MAX_OCTAVE):
+    """
+    Overlapping Allan deviation of a block of evenly spaced frequency
+    readings, e.g. a ring buffer window, at the same octave spaced taus as
+    StreamingAllan. Each tau is one vectorized pass over the phase series.
+    Returns (taus, adevs) for every tau the block is long enough for.
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    if len(freqs) < 2:
+        return np.zeros(0), np.zeros(0)
+    if nominal is None:
+        nominal = freqs[0]
+    x = np.concatenate(([0.0], np.cumsum((freqs - nominal) / nominal)))
+
+    m = 2 ** np.arange(max_octave + 1)
+    m = m[2 * m < len(x)]
+    adevs = np.empty(len(m))
+    for i, mi in enumerate(m):
+        d = x[2 * mi :] - 2 * x[mi:-mi] + x[: -2 * mi]
+        adevs[i] = np.sqrt(np.mean(d**2) / (2 * mi**2))
+    return m * tau0, adevs
@@ -0,0 +1,222 @@
+"""
+Throughput and latency benchmark of the counter acquisition path, run
+headless against the simulated instruments in simulators.py.
+
+Measures
+  - raw AgilentCounter reads (single and acquire_block)
+  - raw serial Counter reads
+  - the pipeline shared by CounterWidget and CounterDaemon
+    (pipeline.CounterPipeline): acquisition threads, the telemetry bus,
+    outlier screening and binary logging of every reading, with reference
+    laser feedback (feedback.ReferenceFeedback) on the screened readings
+and reports samples/s, p50/p99 read-to-log and read-to-feedback latency,
+dropped and rejected sample counts as JSON, e.g.
+
+    python benchmark.py --duration 10 --gate-time 0.01 --output bench.json
+"""
+
+# %% package imports
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import contextlib
+import functools
+import platform
+import tempfile
+import datetime
+import numpy as np
+import orionlasers
+import feedback
+import pipeline
+import simulators
+
+
+# %% function defs
+def latency_summary(latencies):
+    """p50/p99/max of a list of latencies (s), in ms"""
+    latencies = np.asarray(latencies, dtype=float)
+    if not len(latencies):
+        return dict(n=0, p50_ms=None, p99_ms=None, max_ms=None)
+    return dict(
+        n=len(latencies),
+        p50_ms=1e3 * np.percentile(latencies, 50),
+        p99_ms=1e3 * np.percentile(latencies, 99),
+        max_ms=1e3 * latencies.max(),
+    )
+
+
+def make_pipeline(log_dir, gate_time, period, latency):
+    log = logging.getLogger("counter.benchmark")
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+    return pipeline.CounterPipeline(
+        log,
+        log_dir,
+        [0.0, 0.0],
+        sim=True,
+        sim_options=dict(noise=1.0, latency=latency, period=period, seed=0),
+        gate_time=gate_time,
+        ring_prefix="counter_benchmark",
+    )
+
+
+def bench_hp_counter(counter, duration, block_size):
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        counter.begin_freq_measure(1)
+        counter.wait_for_result()
+        counter.get_result()
+        n += 1
+    single = n / (time.perf_counter() - start)
+
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        n += len(counter.acquire_block(1, block_size))
+    block = n / (time.perf_counter() - start)
+    return dict(single_samples_per_s=single, block_samples_per_s=block)
+
+
+def bench_serial_counter(chin_counter, duration):
+    # start from an empty buffer, not the frames queued during earlier tests
+    chin_counter.select_high_freq_channel()
+    n = 0
+    errors = chin_counter.decoder.errors
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        n += len(chin_counter.read_available(2, block=True))
+    return dict(
+        samples_per_s=n / (time.perf_counter() - start),
+        frame_errors=chin_counter.decoder.errors - errors,
+    )
+
+
+def bench_pipeline(counter_pipeline, duration, consumer_period, feedback_period):
+    """
+    Runs counter_pipeline (before its start()) as the widget and daemon do:
+    a consumer drains the bus every consumer_period (the GUI timer or the
+    daemon's control loop) and steps the simulated reference laser on
+    channel 1. Every reading is logged.
+    """
+    signals = counter_pipeline.sim_signals
+    counter_pipeline.targets[:] = [signals[1].freq, signals[2].freq]
+    counter_pipeline.freq_log_period = 0
+    counter_pipeline.log_flush_period = 0.1
+    counter_pipeline.log_fsync_period = 1.0
+
+    bus = counter_pipeline.bus
+    raw_subs = [bus.subscribe(topic) for topic in counter_pipeline.topics]
+    feedback_sub = bus.subscribe(counter_pipeline.clean_topics[0])
+
+    laser = orionlasers.OrionLaser(
+        simulators.SIM_LASER_PORT, ser=simulators.FakeOrionSerial(signals[1])
+    )
+    settings = feedback.FeedbackSettings()
+    settings.laser_feedback_period = feedback_period
+    settings.laser_feedback_threshold = 0
+    settings.laser_allowed_frequency_detune = np.inf
+    ref = feedback.ReferenceFeedback(
+        laser, counter_pipeline.targets[0], settings, 1, log=counter_pipeline.log
+    )
+
+    # Log records carry times relative to the start of their log
+    log_latencies = []
+
+    def on_write(index, records):
+        t_0 = counter_pipeline.log_start_times[index]
+        log_latencies.extend(time.perf_counter() - (records["time"] + t_0))
+
+    writers = []
+    for index in range(len(counter_pipeline.channels)):
+        counter_pipeline.start_logging(index, functools.partial(on_write, index))
+        writers.append(counter_pipeline.log_files[index])
+
+    feedback_latencies = []
+    counts = [0, 0]
+    counter_pipeline.chin_counter.select_high_freq_channel()
+    counter_pipeline.start()
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        time.sleep(consumer_period)
+        for index, sub in enumerate(raw_subs):
+            times, freqs = sub.drain()
+            counts[index] += len(freqs)
+        times, freqs = feedback_sub.drain()
+        last_time = ref.last_time
+        ref.update(times, freqs)
+        if ref.last_time != last_time:
+            feedback_latencies.append(time.perf_counter() - ref.last_time)
+    elapsed = time.perf_counter() - start
+
+    for index in range(len(counter_pipeline.channels)):
+        counter_pipeline.stop_logging(index)
+    laser.close()
+    workers = counter_pipeline.workers
+
+    return dict(
+        samples_per_s=[n / elapsed for n in counts],
+        dropped_samples=[sub.dropped for sub in raw_subs + [feedback_sub]],
+        rejected_samples=[f.rejected for f in counter_pipeline.outlier_filters],
+        read_errors=[repr(w.error) for w in workers if w.error is not None],
+        frame_errors=counter_pipeline.chin_counter.decoder.errors,
+        records_logged=[writer.records_written for writer in writers],
+        read_to_log=latency_summary(log_latencies),
+        read_to_feedback=latency_summary(feedback_latencies),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=float, default=5, help="s per test")
+    parser.add_argument("--gate-time", type=float, default=0.01, help="HP gate (s)")
+    parser.add_argument(
+        "--period", type=float, default=0.01, help="serial counter frame period (s)"
+    )
+    parser.add_argument("--latency", type=float, default=0.002, help="bus latency (s)")
+    parser.add_argument("--block-size", type=int, default=100)
+    parser.add_argument("--consumer-period", type=float, default=0.1)
+    parser.add_argument("--feedback-period", type=float, default=0.5)
+    parser.add_argument("--output", help="JSON file to write (default: stdout)")
+    args = parser.parse_args(argv)
+
+    # The drivers print status messages; keep stdout clean for the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        log_dir = tempfile.mkdtemp()
+        counter_pipeline = make_pipeline(
+            log_dir, args.gate_time, args.period, args.latency
+        )
+        counter = counter_pipeline.counter
+        chin_counter = counter_pipeline.chin_counter
+        results = dict(
+            date=datetime.datetime.now().isoformat(),
+            python=sys.version.split()[0],
+            platform=platform.platform(),
+            parameters=vars(args),
+            hp_counter=bench_hp_counter(counter, args.duration, args.block_size),
+            serial_counter=bench_serial_counter(chin_counter, args.duration),
+            pipeline=bench_pipeline(
+                counter_pipeline,
+                args.duration,
+                args.consumer_period,
+                args.feedback_period,
+            ),
+        )
+        counter_pipeline.close()
+        shutil.rmtree(log_dir)
+
+    text = json.dumps(results, indent=2, default=float)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return results
+
+
+# %% run
+if __name__ == "__main__":
+    main()
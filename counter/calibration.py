@@ -0,0 +1,191 @@
+# %% package imports
+import threading
+import logging
+import numpy as np
+import acquisition
+import stats
+
+# %% global variables
+# Topics the calibration listens to: HP counter readings of the signal the
+# serial counter measures, and the serial counter's uncorrected frequencies
+REFERENCE_TOPIC = "hp_chan2"
+RAW_TOPIC = "chin_raw"
+
+# Memory of the fit, in readings (about an hour of paired readings at a
+# 0.1 s gate time with the HP counter alternating between channels)
+DEFAULT_FORGETTING = 1 - 1 / 20000
+# The fit is only applied once its offset is known at least this well.
+# The uncertainty falls as 1/sqrt(pairs), about 5 pairs/s come in: with the
+# simulated counters (counter_daemon.py --sim --calibrate, 10 Hz noise) it
+# was +-1.4 Hz after 25 s (124 pairs), +-0.57 Hz after 2 minutes, and the
+# fit was applied after about 850 pairs, close to 3 minutes. Quieter
+# counters get there sooner.
+DEFAULT_MAX_UNCERTAINTY = 0.5  # Hz
+DEFAULT_MIN_PAIRS = 100
+UPDATE_PERIOD = 1.0  # s
+# Without a sweep much larger than the counter noise the scale is not
+# observable; this keeps it at 1 until the data says otherwise
+SCALE_PRIOR_PRECISION = 1e12  # 1/scale^2
+
+
+# %% cross calibration
+class CounterCalibration(threading.Thread):
+    """
+    Fits the serial counter to the HP counter while both measure the same
+    signal, in the background, so the correction the serial counter needs
+    is kept up to date without stopping to rerun new_counter.py.
+
+    Every reading published on reference_topic is paired with the raw
+    (uncorrected) reading on raw_topic nearest in time, no more than
+    tolerance apart, and the pairs are fitted with
+        reference - raw = offset + (scale - 1) (raw - raw_0)
+    by recursive least squares with exponential forgetting (see
+    stats.RecursiveLeastSquares), raw_0 being the first raw reading. Only
+    the offset is fitted unless fit_scale is set; the scale can only be
+    told apart from noise if the frequency is swept by much more than the
+    counter noise.
+
+    Once the offset uncertainty is below max_uncertainty the fit is applied:
+    apply(raw) returns the corrected frequency. Until then the offset passed
+    in is used. result() may be called from any thread.
+    """
+
+    def __init__(
+        self,
+        bus,
+        offset=0.0,
+        tolerance=0.1,
+        reference_topic=REFERENCE_TOPIC,
+        raw_topic=RAW_TOPIC,
+        forgetting=DEFAULT_FORGETTING,
+        fit_scale=False,
+        max_uncertainty=DEFAULT_MAX_UNCERTAINTY,
+        min_pairs=DEFAULT_MIN_PAIRS,
+        period=UPDATE_PERIOD,
+        log=None,
+    ):
+        super().__init__(name="counter calibration", daemon=True)
+        self.tolerance = tolerance  # s
+        self.fit_scale = fit_scale
+        self.max_uncertainty = max_uncertainty  # Hz
+        self.min_pairs = min_pairs
+        self.period = period  # s
+        self.log = logging.getLogger("counter") if log is None else log
+        self.error = None
+
+        if fit_scale:
+            self.rls = stats.RecursiveLeastSquares(
+                2, forgetting, prior_precision=[0.0, SCALE_PRIOR_PRECISION]
+            )
+        else:
+            self.rls = stats.RecursiveLeastSquares(1, forgetting)
+        # (offset, scale, raw_0) in use, replaced as a whole so apply() never
+        # sees half an update
+        self.correction = (offset, 1.0, 0.0)
+        self.raw_0 = None
+        self.applied = False
+        # Held while the fit is updated, so result() sees all of an update
+        self.lock = threading.Lock()
+
+        self.reference_sub = bus.subscribe(reference_topic)
+        self.raw_sub = bus.subscribe(raw_topic)
+        self.pending_times = [np.zeros(0), np.zeros(0)]  # reference, raw
+        self.pending_freqs = [np.zeros(0), np.zeros(0)]
+        self._shutdown = threading.Event()
+
+    def apply(self, raw):
+        offset, scale, raw_0 = self.correction
+        return raw + offset + (scale - 1) * (raw - raw_0)
+
+    def run(self):
+        while not self._shutdown.wait(self.period):
+            try:
+                self.update()
+            except Exception as e:
+                self.error = e
+
+    def update(self):
+        """Fits every pair that has come in since the last call"""
+        # Max number of unpaired readings kept per topic
+        max_backlog = 4096
+
+        for i, sub in enumerate((self.reference_sub, self.raw_sub)):
+            times, freqs = sub.drain()
+            self.pending_times[i] = np.append(self.pending_times[i], times)[
+                -max_backlog:
+            ]
+            self.pending_freqs[i] = np.append(self.pending_freqs[i], freqs)[
+                -max_backlog:
+            ]
+        t_ref, t_raw = self.pending_times
+        f_ref, f_raw = self.pending_freqs
+        if not len(t_ref) or not len(t_raw):
+            return
+
+        # As in CounterWidget.calc_values: only pair raw readings older than
+        # the newest reference reading, a later one could still be closer
+        n = np.searchsorted(t_raw, t_ref[-1], side="right")
+        i_raw, i_ref = acquisition.pair_by_time(t_raw[:n], t_ref, self.tolerance)
+        if len(i_raw):
+            raw = f_raw[i_raw]
+            if self.raw_0 is None:
+                self.raw_0 = raw[0]
+            if self.fit_scale:
+                X = np.column_stack((np.ones(len(raw)), raw - self.raw_0))
+            else:
+                X = np.ones((len(raw), 1))
+            with self.lock:
+                self.rls.update(X, f_ref[i_ref] - raw)
+                self.check_fit()
+
+        self.pending_times[1] = t_raw[n:]
+        self.pending_freqs[1] = f_raw[n:]
+        t_min = (t_raw[n] if n < len(t_raw) else t_ref[-1]) - self.tolerance
+        keep = t_ref >= t_min
+        self.pending_times[0] = t_ref[keep]
+        self.pending_freqs[0] = f_ref[keep]
+
+    def check_fit(self):
+        if self.rls.count < self.min_pairs:
+            return
+        theta = self.rls.theta
+        std = self.rls.std
+        if not std[0] <= self.max_uncertainty:
+            return
+        scale = 1 + theta[1] if self.fit_scale else 1.0
+        if not self.applied:
+            self.log.warning(
+                "Counter calibration applied: offset %.3f +- %.3f Hz (was %.3f)"
+                % (theta[0], std[0], self.correction[0])
+            )
+            self.applied = True
+        self.correction = (theta[0], scale, self.raw_0)
+
+    def result(self):
+        """The current fit and its uncertainty, as a dict"""
+        with self.lock:
+            offset, scale, raw_0 = self.correction
+            result = dict(
+                offset=offset,
+                scale=scale,
+                pairs=self.rls.count,
+                applied=self.applied,
+                fit_offset=np.nan,
+                fit_offset_std=np.nan,
+                fit_scale=np.nan,
+                fit_scale_std=np.nan,
+            )
+            if self.rls.count > self.rls.num_params:
+                theta = self.rls.theta
+                std = self.rls.std
+                result.update(fit_offset=theta[0], fit_offset_std=std[0])
+                if self.fit_scale:
+                    result.update(fit_scale=1 + theta[1], fit_scale_std=std[1])
+        return result
+
+    def stop(self, timeout=None):
+        self._shutdown.set()
+        self.reference_sub.close()
+        self.raw_sub.close()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,592 @@
+# %% package imports
+import os
+import json
+import argparse
+import threading
+import socket
+import numpy as np
+import orionlasers
+import stats
+import simulators
+import freqlogs
+import feedback
+import pipeline
+import sharedring
+import AsyncSocketComms
+
+# %% global variables
+# Port of the control/query API (see CounterDaemon.handle_request)
+DEFAULT_CONTROL_PORT = 60010
+
+# How often the control loop drains the bus and runs the feedback
+LOOP_PERIOD = 0.1  # s
+
+# STATUS reports the mean and spread of this many of the latest good readings
+ROLLING_WINDOW = 100
+
+# Feedback parameters that can be changed with the PARAM command
+PARAMETERS = (
+    "freq_log_period",
+    "laser_feedback_period",
+    "laser_feedback_threshold",
+    "laser_allowed_frequency_detune",
+    "laser_feedback_strike_limit",
+    "temp_feedback_period",
+    "temp_feedback_threshold",
+    "temp_step",
+    "temp_max_allowed_adjust",
+    "feedback_average_weight",
+    "outlier_window",
+    "outlier_threshold",
+    "outlier_min_spread",
+)
+# ... of which these are whole numbers
+INTEGER_PARAMETERS = ("laser_feedback_strike_limit", "outlier_window")
+# ... and these set every channel's outlier filter (stats.HampelFilter)
+OUTLIER_PARAMETERS = {
+    "outlier_window": "window",
+    "outlier_threshold": "threshold",
+    "outlier_min_spread": "min_spread",
+}
+
+
+# Most readings a PollingReader asks for at a time
+POLL_SAMPLES = 1000
+
+
+# %% function defs
+def parse_switch(word):
+    word = word.upper()
+    if word not in ("ON", "OFF"):
+        raise ValueError("Expected ON or OFF, got " + word)
+    return word == "ON"
+
+
+# %% counter daemon
+class CounterDaemon:
+    """
+    Runs acquisition, logging and feedback of the counter without any GUI,
+    built on pipeline.CounterPipeline and the controllers of feedback.py.
+    CounterWidget is a client of a running daemon (and only runs the same
+    things itself when there is none), so they carry on when its window is
+    closed. Everything is controlled through a line based request API on
+    localhost (see AsyncSocketComms): send a request "<COMMAND> <args...>"
+    and get a JSON reply. CounterClient does this for you. Commands
+    (channels are 1 or 2):
+
+        STATUS                      state of every channel
+        TARGET <ch> [<Hz>]          get or set the target frequency
+        CHANNEL <ch> ON|OFF         start or stop measuring a channel
+        LOG <ch> ON|OFF             start or stop logging a channel
+        LASER <port>|OFF            connect or disconnect the reference laser
+        REFFB <ch> ON|OFF           feedback to the reference laser
+        TEMPFB <ch> ON|OFF [<port>] feedback to the comb temperature
+        COMMIT <ch>                 commit the temperature adjust and stop
+        PARAM [<name> [<value>]]    get or set feedback parameters
+        STOP                        shut the daemon down
+
+    plus the queries of queries.QueryHandler (LATEST, LAST, STATS, ADEV),
+    which are answered from the ring buffers without waiting for the
+    control loop. Errors are replied as {"error": "<message>"}.
+    """
+
+    def __init__(
+        self,
+        sim=False,
+        control_port=DEFAULT_CONTROL_PORT,
+        log_dir=None,
+        chin_port_name="COM18",
+        telemetry_port=None,
+        calibrate=False,
+    ):
+        self.channels = [1, 2]
+        num = len(self.channels)
+
+        # Feedback parameters, shared with the running controllers
+        self.settings = feedback.FeedbackSettings()
+        self.temp_port_numbers = [60002, 60003]
+        self.use_laser_temp = False
+
+        self.log_dir = log_dir or os.path.join(os.getcwd(), "counterlogs")
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        self.log = pipeline.make_logger(self.log_dir)
+
+        self.freqs = [np.nan] * num
+        self.rolling_stats = [
+            stats.RollingStats(ROLLING_WINDOW) for index in range(num)
+        ]
+        self.freqTargets = [199869965.598, 199870591.410]
+        self.channel_is_active = [True] * num
+        self.ref_feedbacks = [None] * num  # feedback.ReferenceFeedback
+        self.temp_feedbacks = [None] * num  # feedback.TemperatureFeedback
+        self.reference_laser = None
+
+        # Acquisition, outlier screening and logging run on threads of their
+        # own; the control loop runs both feedbacks on the good readings
+        self.sim = sim
+        self.pipeline = pipeline.CounterPipeline(
+            self.log,
+            self.log_dir,
+            self.freqTargets,
+            sim=sim,
+            chin_port_name=chin_port_name,
+            ring_prefix="counter_daemon",
+            calibrate=calibrate,
+            telemetry_port=telemetry_port,
+        )
+        self.subs = [
+            self.pipeline.bus.subscribe(topic) for topic in self.pipeline.clean_topics
+        ]
+        self.pipeline.start()
+
+        # Requests are handled on the server thread, the feedback on the
+        # control loop; self.lock keeps them apart
+        self.lock = threading.RLock()
+        self._shutdown = threading.Event()
+        self.commands = {
+            "STATUS": self.status,
+            "TARGET": self.target,
+            "CHANNEL": self.set_channel,
+            "LOG": self.set_logging,
+            "LASER": self.set_laser,
+            "REFFB": self.set_reference_feedback,
+            "TEMPFB": self.set_temperature_feedback,
+            "COMMIT": self.commit_to_temp_adjustment,
+            "PARAM": self.parameter,
+            "STOP": self.stop,
+        }
+        self.queries = self.pipeline.queries
+        self.server = AsyncSocketComms.AsyncSocketServer(
+            control_port, request_handler=self.handle_request
+        )
+        self.log.warning("Counter daemon listening on port %i" % control_port)
+
+    def index(self, channel):
+        try:
+            return self.channels.index(int(channel))
+        except ValueError:
+            raise ValueError("No channel %s" % channel)
+
+    # %% control loop
+    def run(self, period=LOOP_PERIOD):
+        """Runs the control loop until stop() is called"""
+        while not self._shutdown.wait(period):
+            with self.lock:
+                for index in range(len(self.channels)):
+                    if self.channel_is_active[index]:
+                        self.handle_channel(index)
+
+    def handle_channel(self, index):
+        error = self.pipeline.workers[index].error
+        if error is not None:
+            # Likely a counter timeout; probably there is no signal on the
+            # channel, so stop trying to measure it
+            self.log.warning(
+                "Read failed on channel %i (%s)" % (self.channels[index], error)
+            )
+            self.set_channel(self.channels[index], "OFF")
+            return
+        error = self.pipeline.screeners[index].error
+        if error is not None:
+            self.log.warning(
+                "Screening failed on channel %i (%s)" % (self.channels[index], error)
+            )
+            self.set_channel(self.channels[index], "OFF")
+            return
+
+        times, freqs = self.subs[index].drain()
+        if not len(freqs):
+            return
+        self.freqs[index] = freqs[-1]
+        self.rolling_stats[index].update(freqs)
+
+        ref = self.ref_feedbacks[index]
+        if ref is not None and not ref.update(times, freqs):
+            self.set_reference_feedback(self.channels[index], "OFF")
+        temp = self.temp_feedbacks[index]
+        if temp is not None:
+            temp.update(times, freqs)
+
+    # %% control API
+    def handle_request(self, text):
+        # Runs on the server thread
+        words = text.split()
+        try:
+            if not words:
+                raise ValueError("Empty request")
+            name = words[0].upper()
+            if name in self.queries.commands:
+                # Queries only read the ring buffers, so need no lock
+                result = self.queries.commands[name](*words[1:])
+            elif name in self.commands:
+                with self.lock:
+                    result = self.commands[name](*words[1:])
+            else:
+                raise ValueError("Unknown command " + words[0])
+        except Exception as e:
+            result = dict(error="%s: %s" % (type(e).__name__, e))
+        return json.dumps(result)
+
+    def status(self):
+        channels = []
+        for index, channel in enumerate(self.channels):
+            temp = self.temp_feedbacks[index]
+            buffer = self.pipeline.workers[index].buffer
+            channels.append(
+                dict(
+                    channel=channel,
+                    active=self.channel_is_active[index],
+                    freq=self.freqs[index],
+                    target=self.freqTargets[index],
+                    logging=self.pipeline.is_logging(index),
+                    ref_feedback=self.ref_feedbacks[index] is not None,
+                    temp_feedback=temp is not None,
+                    temp_adjust=None if temp is None else temp.adjust,
+                    temp_port=self.temp_port_numbers[index],
+                    mean=self.rolling_stats[index].mean,
+                    std=self.rolling_stats[index].std,
+                    rejected=self.pipeline.outlier_filters[index].rejected,
+                    uneven=channel in self.pipeline.uneven_channels,
+                    ring=self.pipeline.ring_names[index]
+                    if isinstance(buffer, sharedring.SharedRing)
+                    else None,
+                )
+            )
+        return dict(
+            channels=channels,
+            gate_time=self.pipeline.gateTime,
+            laser=self.reference_laser is not None,
+            calibration=None
+            if self.pipeline.calibration is None
+            else self.pipeline.calibration.result(),
+        )
+
+    def target(self, channel, value=None):
+        index = self.index(channel)
+        if value is not None:
+            value = float(value)
+            low, high = pipeline.ACCEPTABLE_FREQ_RANGE
+            if not low <= value <= high:
+                raise ValueError(
+                    "Requested value (%s) is outside allowed range (%s to %s)"
+                    % (value, low, high)
+                )
+            self.freqTargets[index] = value
+            for controller in (self.ref_feedbacks[index], self.temp_feedbacks[index]):
+                if controller is not None:
+                    controller.target = value
+        return self.freqTargets[index]
+
+    def set_channel(self, channel, state):
+        index = self.index(channel)
+        if parse_switch(state):
+            self.channel_is_active[index] = True
+            if self.pipeline.resume(index):
+                # skip whatever was left over from before the pause
+                self.subs[index].clear()
+                self.rolling_stats[index].reset()
+        else:
+            # Disable channel and all related feedback and logging
+            self.channel_is_active[index] = False
+            self.pipeline.pause(index)
+            self.set_logging(channel, "OFF")
+            self.set_reference_feedback(channel, "OFF")
+            self.set_temperature_feedback(channel, "OFF")
+        return self.channel_is_active[index]
+
+    def set_logging(self, channel, state):
+        index = self.index(channel)
+        self.pipeline.stop_logging(index)
+        if parse_switch(state):
+            if not self.channel_is_active[index]:
+                raise ValueError("Channel %i is not active" % self.channels[index])
+            self.pipeline.start_logging(index)
+        return self.pipeline.is_logging(index)
+
+    def set_laser(self, port):
+        if self.reference_laser is not None:
+            for channel in self.channels:
+                self.set_reference_feedback(channel, "OFF")
+            self.reference_laser.close()
+            self.reference_laser = None
+            self.log.warning("Reference laser disconnected")
+        if port.upper() == "OFF":
+            return None
+
+        if self.sim:
+            # the simulated laser steers the channel 1 comb
+            self.reference_laser = orionlasers.OrionLaser(
+                port, ser=simulators.FakeOrionSerial(self.pipeline.sim_signals[1])
+            )
+        else:
+            self.reference_laser = orionlasers.OrionLaser(port)
+        self.log.warning("Reference laser connected on " + port)
+        return self.reference_laser.t_0
+
+    def set_reference_feedback(self, channel, state):
+        index = self.index(channel)
+        if parse_switch(state):
+            if self.reference_laser is None:
+                raise ValueError("Reference laser is not connected")
+            # There is one laser, so only one channel can steer it
+            for other in self.channels:
+                if other != self.channels[index]:
+                    self.set_reference_feedback(other, "OFF")
+            if self.ref_feedbacks[index] is None:
+                self.ref_feedbacks[index] = feedback.ReferenceFeedback(
+                    self.reference_laser,
+                    self.freqTargets[index],
+                    self.settings,
+                    self.channels[index],
+                    self.use_laser_temp,
+                    self.log,
+                )
+                self.pipeline.set_flag(index, freqlogs.FEEDBACK_REF, True)
+                try:
+                    self.reference_laser.begin_session()
+                except Exception as e:
+                    self.log.warning("Failed to start ref laser session (%s)" % e)
+                self.log.warning(
+                    "Feedback to reference laser enabled on channel %i"
+                    % self.channels[index]
+                )
+        elif self.ref_feedbacks[index] is not None:
+            self.ref_feedbacks[index] = None
+            self.pipeline.set_flag(index, freqlogs.FEEDBACK_REF, False)
+            try:
+                self.reference_laser.end_session()
+            except Exception as e:
+                self.log.warning("Failed to end ref laser session (%s)" % e)
+            self.log.warning(
+                "Feedback to reference laser disabled on channel %i"
+                % self.channels[index]
+            )
+        return self.ref_feedbacks[index] is not None
+
+    def set_temperature_feedback(self, channel, state, port=None):
+        index = self.index(channel)
+        if port is not None:
+            self.temp_port_numbers[index] = int(port)
+        if parse_switch(state):
+            if self.temp_feedbacks[index] is None:
+                try:
+                    client = AsyncSocketComms.AsyncSocketClient(
+                        self.temp_port_numbers[index]
+                    )
+                except socket.error:
+                    raise IOError(
+                        "No server detected at port %i; cannot start temp feedback"
+                        % self.temp_port_numbers[index]
+                    )
+                self.temp_feedbacks[index] = feedback.TemperatureFeedback(
+                    client,
+                    self.freqTargets[index],
+                    self.settings,
+                    self.channels[index],
+                    self.log,
+                )
+                self.pipeline.set_flag(index, freqlogs.FEEDBACK_TEMP, True)
+                self.log.warning(
+                    "Socket connection on port %i successful; begin temp feedback"
+                    % self.temp_port_numbers[index]
+                )
+        elif self.temp_feedbacks[index] is not None:
+            self.temp_feedbacks[index].close()
+            self.temp_feedbacks[index] = None
+            self.pipeline.set_flag(index, freqlogs.FEEDBACK_TEMP, False)
+            self.log.warning(
+                "Temperature feedback on channel %i disabled" % self.channels[index]
+            )
+        return self.temp_feedbacks[index] is not None
+
+    def commit_to_temp_adjustment(self, channel):
+        index = self.index(channel)
+        temp = self.temp_feedbacks[index]
+        adjust = 0.0
+        if temp is not None:
+            adjust = temp.adjust
+            temp.commit()
+        self.set_temperature_feedback(channel, "OFF")
+        return adjust
+
+    def get_parameter(self, name):
+        if name == "freq_log_period":
+            return self.pipeline.freq_log_period
+        if name in OUTLIER_PARAMETERS:
+            return getattr(self.pipeline.outlier_filters[0], OUTLIER_PARAMETERS[name])
+        return getattr(self.settings, name)
+
+    def parameter(self, name=None, value=None):
+        if name is None:
+            return dict((name, self.get_parameter(name)) for name in PARAMETERS)
+        if name not in PARAMETERS:
+            raise ValueError("Unknown parameter " + name)
+        if value is not None:
+            value = int(value) if name in INTEGER_PARAMETERS else float(value)
+            if name == "feedback_average_weight" and not 0 < value <= 1:
+                raise ValueError("feedback_average_weight must be in (0, 1]")
+            # Running feedback and screening pick up the new value at once
+            if name == "freq_log_period":
+                self.pipeline.freq_log_period = value
+            elif name in OUTLIER_PARAMETERS:
+                for outlier_filter in self.pipeline.outlier_filters:
+                    setattr(outlier_filter, OUTLIER_PARAMETERS[name], value)
+            else:
+                setattr(self.settings, name, value)
+        return self.get_parameter(name)
+
+    def stop(self):
+        self._shutdown.set()
+        return True
+
+    def close(self):
+        self.log.warning("Counter daemon exit; cleaning up")
+        self._shutdown.set()
+        self.server.close()
+        with self.lock:
+            for channel in self.channels:
+                self.set_logging(channel, "OFF")
+                self.set_temperature_feedback(channel, "OFF")
+            if self.reference_laser is not None:
+                self.set_laser("OFF")
+
+        for sub in self.subs:
+            sub.close()
+        self.pipeline.close()
+
+
+# %% client
+class CounterClient:
+    """
+    Talks to a running CounterDaemon, e.g. from a GUI or a lab script, or to
+    the query port of a CounterWidget (queries only). command() sends one
+    request and returns the decoded reply, raising IOError if the daemon
+    reports an error.
+    """
+
+    def __init__(self, port=DEFAULT_CONTROL_PORT, timeout=1.0):
+        self.timeout = timeout  # s
+        self.client = AsyncSocketComms.AsyncSocketClient(port)
+        self.rings = []  # attached by reader()
+
+    def command(self, *words):
+        reply = self.client.request(" ".join(str(w) for w in words), self.timeout)
+        result = json.loads(reply)
+        if isinstance(result, dict) and "error" in result:
+            raise IOError(result["error"])
+        return result
+
+    def status(self):
+        return self.command("STATUS")
+
+    def freq(self, channel):
+        return self.command("LATEST", channel)["freq"]
+
+    def last(self, channel, n):
+        result = self.command("LAST", channel, n)
+        return np.array(result["times"]), np.array(result["freqs"])
+
+    def stats(self, channel, seconds):
+        return self.command("STATS", channel, seconds)
+
+    def adev(self, channel, seconds=None):
+        words = ("ADEV", channel) if seconds is None else ("ADEV", channel, seconds)
+        result = self.command(*words)
+        return np.array(result["taus"]), np.array(result["adevs"])
+
+    def set_target(self, channel, freq):
+        return self.command("TARGET", channel, "%.3f" % freq)
+
+    def reader(self, channel):
+        """
+        Returns a reader whose drain() gives the readings of channel since the
+        last drain(), as sharedring.SharedRingReader does: straight from the
+        daemon's ring buffer if it is in shared memory, else by polling LAST
+        """
+        for state in self.status()["channels"]:
+            if state["channel"] == int(channel) and state["ring"] is not None:
+                try:
+                    ring = sharedring.SharedRing.attach(state["ring"])
+                except Exception:
+                    break
+                self.rings.append(ring)
+                return ring.reader()
+        return PollingReader(self, channel)
+
+    def close(self):
+        for ring in self.rings:
+            ring.close()
+        self.rings = []
+        self.client.close()
+
+
+class PollingReader:
+    """
+    Reads the new readings of one channel of a CounterDaemon with LAST, for
+    when its ring buffer is not in shared memory. Readings that arrive faster
+    than POLL_SAMPLES per drain() are missed, and so are those that arrive
+    while the daemon does not reply (self.error says why).
+    """
+
+    def __init__(self, client, channel):
+        self.client = client
+        self.channel = channel
+        self.last_time = client.command("LATEST", channel)["time"] or -np.inf
+        self.error = None
+
+    def drain(self):
+        try:
+            times, values = self.client.last(self.channel, POLL_SAMPLES)
+            self.error = None
+        except IOError as e:
+            self.error = e
+            return np.zeros(0), np.zeros(0)
+        new = times > self.last_time
+        if new.any():
+            self.last_time = times[-1]
+        return times[new], values[new]
+
+
+# %% run call
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs the counter without a GUI, controlled over localhost"
+    )
+    parser.add_argument("--port", type=int, default=DEFAULT_CONTROL_PORT)
+    parser.add_argument("--sim", action="store_true", help="simulated instruments")
+    parser.add_argument("--counter-port", default="COM18", help="serial counter")
+    parser.add_argument("--laser-port", help="connect the reference laser")
+    parser.add_argument("--telemetry-port", type=int)
+    parser.add_argument(
+        "--calibrate", action="store_true", help="fit the serial counter offset"
+    )
+    parser.add_argument("--log-dir")
+    parser.add_argument(
+        "--send", nargs="+", metavar="WORD", help="send a command to a running daemon"
+    )
+    args = parser.parse_args()
+
+    if args.send:
+        client = CounterClient(args.port)
+        try:
+            print(json.dumps(client.command(*args.send), indent=2))
+        finally:
+            client.close()
+    else:
+        daemon = CounterDaemon(
+            args.sim,
+            args.port,
+            args.log_dir,
+            args.counter_port,
+            args.telemetry_port,
+            args.calibrate,
+        )
+        try:
+            if args.laser_port:
+                daemon.set_laser(args.laser_port)
+            daemon.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.close()
@@ -1,28 +1,29 @@
 # %% package imports
 import os
 import time
-import datetime
-import random
-import logging
 from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QMainWindow
-import hpcounters
 import orionlasers
+import acquisition
+import allan
+import stats
+import simulators
+import freqlogs
+import feedback
+import pipeline
+import counter_daemon
 import AsyncSocketComms
 import socket
 import numpy as np
 from Window import Ui_MainWindow
-import serial
 
 # %% global variables
 # USETEMP = True
 USETEMP = False
 
-# channels for Agilent and chinese counter
-channel_hpc = 1
-channel_chin = 2
-
-time.clock = time.process_time
+# Readings are timestamped on the acquisition threads, so this has to be a
+# wall clock shared by every thread (process_time counts CPU time)
+time.clock = time.perf_counter
 
 # %% function defs
 def read_text(edit_field):
@@ -34,70 +35,6 @@ def read_text(edit_field):
     return None
 
 
-# %% chinese counter
-class Counter:
-    """
-    This is the Chinese counter
-    """
-
-    def __init__(self, COM):
-        # initialize the Serial instance
-        self.ser = serial.Serial()
-
-        # set the serial's communication port
-        self.COM = COM
-
-        # the baudrate should already be 9600, but just so you know
-        self.ser.baudrate = 9600
-
-    @property
-    def COM(self):
-        return self.ser.port
-
-    @COM.setter
-    def COM(self, port):
-        assert type(port) == str, f"the port must be a string, but got: {port}"
-        assert port[:3] == "COM", f"the port must start with 'COM' but got {port}"
-
-        self.ser.port = port
-
-    def select_high_freq_channel(self):
-        # initialization from Scott Egbert
-        # Power up select CH2 frequency mode (the high speed channel)
-        self.open()
-        self.ser.write(b"$E2222*")
-        self.close()
-
-    def select_low_freq_channel(self):
-        # initialization from Scott Egbert
-        # Power up select CH2 frequency mode (the low speed channel)
-        self.open()
-        self.ser.write(b"$E2020*")
-        self.close()
-
-    def readonce(self, size):
-        self.open()
-        read = self.ser.read(size)
-        self.close()
-        return read
-
-    def writeonce(self, byt):
-        self.open()
-        self.ser.write(byt)
-        self.close()
-
-    def open(self):
-        self.ser.open()
-
-    def close(self):
-        self.ser.close()
-
-    def read_and_return_float(self):
-        dat = str(self.ser.read(29))
-        dat = float((dat.split("F-CH2:")[1]).split("\\r")[0])
-        return dat
-
-
 # %% counter widget
 class CounterWidget(QMainWindow, Ui_MainWindow):
     def __init__(self, *args, **kwargs):
@@ -211,90 +148,52 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
         # counterName = 'HEWLETT-PACKARD,53131A,0,3427' #????
         # counterName = 'HEWLETT-PACKARD,53131A,0,3536' #PDCS System
 
-        # How often to log frequencies
-        self.freq_log_period = 0.1  # s
-
-        # How often to feedback to reference laser
-        self.laser_feedback_period = 2  # s
-        # Deviation from target frequency that triggers laser feedback
-        self.laser_feedback_threshold = 5  # Hz
-        # Max frequency deviation from target before laser feedback is canceled
-        self.laser_allowed_frequency_detune = 120  # Hz
-        # Number of consecutive times the frequency deviation can be bigger
-        # than max allowed before feedback is canceled
-        self.laser_feedback_strike_limit = 3
-
-        # How often to feedback to comb temperature
-        self.temp_feedback_period = 10  # s
-        # Temperature step size during temperature tuning
-        self.temp_step = 0.08  # deg C
-        # Deviation from target frequency that triggers temperature feedback
-        self.temp_feedback_threshold = 100  # Hz
-        # Max magnitude temperature adjustment that is allowed
-        self.temp_max_allowed_adjust = 5  # deg C
+        # Feedback parameters (see feedback.FeedbackSettings), shared with the
+        # running feedback controllers. Logging and outlier screening are
+        # set up in pipeline.CounterPipeline.
+        self.feedback_settings = feedback.FeedbackSettings()
         # IPC socket port numbers for [channel 1, channel 2] temperature feedback
         self.temp_port_numbers = [60002, 60003]
 
         # [min,max] frequencies that are allowed to be entered as targets
-        self.acceptableFreqRange = np.array([1e9 - 1e6, 1e9 + 1e6])  # Hz
-        self.acceptableFreqRange = 1010e6 - self.acceptableFreqRange[::-1]
-
-        # Deliminator used in log file
-        self.delim = ","
-        # Log file header (set to '' for none)
-        self.hdr_str = "Time (s)" + self.delim + "Frequency (Hz)"
-        # String written on each line of log. First number is filled with time,
-        # in seconds, from the log start; second number filled with frequency
-        # in Hz
-        self.logfmt = "\n{:.2f}" + self.delim + "{}"
-        # Datetime format used in logfile names, logging events, etc
-        self.timefmt = "%Y-%m-%d_%H%M%S"
+        self.acceptableFreqRange = np.array(pipeline.ACCEPTABLE_FREQ_RANGE)  # Hz
+
+        # Set calibrate_counters to keep the serial counter offset fitted
+        # while running (see calibration.py). The HP counter then also
+        # measures the channel 2 signal on its own channel 2, wired as for
+        # new_counter.py. Channel 1 readings then come in bursts, so its ADEV
+        # is not shown.
+        self.calibrate_counters = False
+        # Set telemetry_port to stream every reading to other processes as
+        # lines of text (see telemetry.SocketBridge)
+        self.telemetry_port = None
+        # Set query_port to let other scripts ask for the latest reading, the
+        # last n readings, statistics or ADEV (see queries.py); they are
+        # answered from the ring buffers on a server thread
+        self.query_port = None
+        # If a counter_daemon.py is running on daemon_port, the widget is only
+        # a client of it: acquisition, logging and feedback run in the daemon
+        # and carry on when the window is closed. Otherwise (or with
+        # daemon_port None) the widget runs them itself, as set up here.
+        self.daemon_port = counter_daemon.DEFAULT_CONTROL_PORT
 
         # Make log directory
-        cwd = os.getcwd()
-        self.log_dir = cwd + "\\counterlogs\\"
+        self.log_dir = os.path.join(os.getcwd(), "counterlogs")
         if not os.path.exists(self.log_dir):
             os.makedirs(self.log_dir)
 
         # Set up logger
-        self.logger_name = "counter"
-        self.logger_level = logging.DEBUG
-        fh = logging.FileHandler(
-            "%s\\%s_counterlog.log"
-            % (self.log_dir, datetime.datetime.now().strftime(self.timefmt)),
-            "w",
-        )
-        sh = logging.StreamHandler()
-        formatter = logging.Formatter("%(asctime)s  %(message)s", self.timefmt)
-        fh.setFormatter(formatter)
-        sh.setFormatter(formatter)
-
-        self.log = logging.getLogger(self.logger_name)
-        self.log.setLevel(self.logger_level)
-        self.log.handlers = [fh, sh]
+        self.log = pipeline.make_logger(self.log_dir)
 
         ##################################################################
 
         # Initialize variables
         num = len(self.channels)
 
-        self.IPC_clients = [None] * num
-        self.tempFeedbacks = [False] * num
-        self.tempFeedbackStartDatetimes = [None] * num
-        self.lastTempFeedbackTimes = [0] * num
-        self.tempAdjustValues = [0] * num
-
-        self.refLaserFeedbacks = [False] * len(self.channels)
-        self.refFeedbackStrikes = [0] * len(self.channels)
+        self.ref_feedbacks = [None] * num  # feedback.ReferenceFeedback
+        self.temp_feedbacks = [None] * num  # feedback.TemperatureFeedback
         self.laser_connected = False
-        self.lastRefFeedbackTime = 0
 
-        self.logging_channel = [False] * num
-        self.log_files = [None] * num
-        self.last_log_time = [0] * num
-        self.log_start_times = [0] * num
-
-        self.index = 0
         self.channel_is_active = [True] * num
         self.startTime = time.clock()
         self.disp_format = "{:,.1f}"
@@ -305,238 +204,279 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
         self.freqs = [199867900.421, 199868526.215]
         self.freqTargets = self.freqs[:]
         self.freqTargets = [199869965.598, 199870591.410]
+        self.nq_stats = stats.RunningStats()
         self.nqAverages = 0
         self.nq = 0
-        self.calc_values()
+        self.deltaF = abs(self.freqs[1] - self.freqs[0])
         for index in range(len(self.channels)):
             self.update_display(index)
             self.edit_freqTargets[index].setText(
                 "{:.3f}".format(self.freqTargets[index])
             )
 
-        # Load Agilent counter
+        # Each instrument is read by its own acquisition thread, which pushes
+        # timestamped readings into a ring buffer as soon as the counter has
+        # them, with no timer-imposed dead time. The GUI timer below only
+        # drains the telemetry bus, so a slow repaint can no longer delay or
+        # drop a measurement. Readings are screened for outliers and logged
+        # by the pipeline (see pipeline.CounterPipeline); the feedback loops
+        # only get the readings that passed screening.
+        # With simData the real drivers talk to simulated instruments (see
+        # simulators.py) instead of the hardware.
         if self.simData:
-            self.gateTime = 0.1
+            self.edit_laserPort.setText(simulators.SIM_LASER_PORT)
+        self.daemon = self.connect_daemon()
+        if self.daemon is not None:
+            self.pipeline = None
+            self.gateTime = self.daemon_status["gate_time"]
+            # The display reads the daemon's readings; it does the feedback
+            self.display_subs = [self.daemon.reader(ch) for ch in self.channels]
+            self.pair_readers = [self.daemon.reader(ch) for ch in self.channels]
+            # There are no commands for these in the daemon
+            self.button_resetLaser.setEnabled(False)
+            self.check_enableLaserTemp.setEnabled(False)
+            self.edit_laserTemp.setEnabled(False)
         else:
-            """
-            initializes the counter, and takes the first measurement index
-            tells it which channel to take the measurement for, it toggles
-            between the two since you have two frequency combs
-            """
-
-            self.counter = hpcounters.AgilentCounter(None, False, 0.1)
-            self.counter.set_clock_external(True)
-            self.counter.set_apporx_freq([1, 2], 199868311)
-            self.gateTime = self.counter.get_gate_time()
-
-            # The Agilent only takes data on one of its channels now
-            # self.counter.begin_freq_measure(self.channels[self.index])
-            self.counter.begin_freq_measure(channel_hpc)
-
-        # Load the Chinese counter from eBay
-        self.offset_agilent_chin = 8.646939525961876
-        self.chin_counter = Counter("COM18")
-        self.chin_counter.select_high_freq_channel()
-        self.chin_counter.readonce(100)
-        self.chin_counter.open()
-
-        # Set up timer to handle measurement events
-        # Timer interval is set to couter gate time;
-        # this is the fastest we can acquire measurements
+            self.pipeline = pipeline.CounterPipeline(
+                self.log,
+                self.log_dir,
+                self.freqTargets,
+                sim=self.simData,
+                ring_prefix="counter_widget",
+                calibrate=self.calibrate_counters,
+                telemetry_port=self.telemetry_port,
+                query_port=self.query_port,
+            )
+            self.gateTime = self.pipeline.gateTime
+            self.uneven_channels = self.pipeline.uneven_channels
+            # Display and the feedback loops each have a subscription
+            bus = self.pipeline.bus
+            self.display_subs = [
+                bus.subscribe(topic) for topic in self.pipeline.topics
+            ]
+            self.ref_subs = [
+                bus.subscribe(topic) for topic in self.pipeline.clean_topics
+            ]
+            self.temp_subs = [
+                bus.subscribe(topic) for topic in self.pipeline.clean_topics
+            ]
+            self.pair_readers = [
+                worker.buffer.reader() for worker in self.pipeline.workers
+            ]
+
+        # The two counters run independently, so deltaF and nq are computed
+        # from readings paired by timestamp. Readings more than one gate time
+        # apart are not paired.
+        self.pair_tolerance = self.gateTime  # s
+        self.pair_times = [np.zeros(0) for index in range(num)]
+        self.pair_freqs = [np.zeros(0) for index in range(num)]
+        if self.pipeline is not None:
+            self.pipeline.start()
+
+        # Live Allan deviation of each channel, shown in the status bar
+        self.allans = [allan.StreamingAllan(self.gateTime) for index in range(num)]
+        # ... next to the mean error and spread of the last rolling_window
+        # readings
+        self.rolling_window = 100
+        self.rolling_stats = [
+            stats.RollingStats(self.rolling_window) for index in range(num)
+        ]
+        self.adev_display_period = 1  # s
+        self.last_adev_display_time = 0
+
+        # Set up timer to handle display, logging and feedback
+        self.display_period = 0.1  # s
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.timer_handler)
-        self.timer.start(round(1500 * self.gateTime))
+        self.timer.start(round(1000 * self.display_period))
 
         # Show the GUI
         self.populate_textboxes()
         self.show()
 
-    def timer_handler(self):
-
-        thisTime = time.clock()
-
-        # self.index is last channel that counter was set to measure
-        index = self.index
-        self.increment_index()
-        # Now self.index is set to next channel to be measured
-
-        # Get measurement result
-        if self.simData:
-            self.freqs[index] = self.freqs[index] + (random.random() - 0.5) * 20
-        else:
+    # %% counter daemon
+    def connect_daemon(self):
+        # Returns a counter_daemon.CounterClient if a daemon answers on
+        # daemon_port, and takes on its state and feedback parameters
+        if self.daemon_port is None:
+            return None
+        try:
+            daemon = counter_daemon.CounterClient(self.daemon_port)
+        except socket.error:
+            return None
+        try:
+            self.daemon_status = daemon.status()
+            parameters = daemon.command("PARAM")
+        except IOError as e:
+            self.log.warning("No reply from the counter daemon (%s)" % e)
+            daemon.close()
+            return None
+        self.log.warning(
+            "Connected to the counter daemon on port %i" % self.daemon_port
+        )
+        for name, value in parameters.items():
+            if hasattr(self.feedback_settings, name):
+                setattr(self.feedback_settings, name, value)
+        self.daemon = daemon
+        self.sync_with_daemon(self.daemon_status)
+        return daemon
+
+    def daemon_command(self, *words):
+        # Sends a command to the daemon, then shows the state it is left in
+        try:
+            result = self.daemon.command(*words)
+        except IOError as e:
+            self.log.warning("Counter daemon: %s" % e)
+            result = None
+        self.sync_with_daemon()
+        return result
+
+    def sync_with_daemon(self, status=None):
+        # The daemon may also change by itself (e.g. turn off a channel that
+        # has no signal) or at the request of another client
+        if status is None:
             try:
-                if self.channels[index] == 1:
-                    # Get result of last measurement
-                    self.freqs[index] = self.counter.get_result()
-                elif self.channels[index] == 2:
-                    self.freqs[index] = (
-                        1010e6
-                        - self.chin_counter.read_and_return_float()
-                        + self.offset_agilent_chin
-                    )
-
-                else:
-                    raise ValueError("self.channels[index] should be either 1 or 2")
-
-            except Exception as e:
-                print(e)
-                # This is likely a counter timeout; probably there is no signal
-                # on self.channel[index], so stop trying to measure it
-
-                self.log.warning("Read failed on channel " + str(self.channels[index]))
-                self.check_activateChannels[index].setChecked(False)
-                self.enable_channels()
+                status = self.daemon.status()
+            except IOError as e:
+                self.statusbar.showMessage("No reply from the counter daemon (%s)" % e)
                 return
+        self.daemon_status = status
+        self.laser_connected = status["laser"]
+        self.check_laserConnect.setChecked(status["laser"])
+        self.uneven_channels = set()
+        for index, state in enumerate(status["channels"]):
+            self.channel_is_active[index] = state["active"]
+            self.check_activateChannels[index].setChecked(state["active"])
+            self.check_logChannels[index].setChecked(state["logging"])
+            self.check_refFeedbacks[index].setChecked(state["ref_feedback"])
+            self.check_tempFeedbacks[index].setChecked(state["temp_feedback"])
+            if state["target"] != self.freqTargets[index]:
+                self.freqTargets[index] = state["target"]
+                self.edit_freqTargets[index].setText(
+                    "{:.3f}".format(self.freqTargets[index])
+                )
+            if state["uneven"]:
+                self.uneven_channels.add(self.channels[index])
 
-            # Start new measurement for the incremented index
-            # The Agilent only takes data on one of its channels now
-            # self.counter.begin_freq_measure(self.channels[self.index])
-            self.counter.begin_freq_measure(channel_hpc)
-
+    # %% display and feedback
+    def timer_handler(self):
         self.calc_values()
+        for index in range(len(self.channels)):
+            if self.channel_is_active[index]:
+                self.handle_channel(index)
 
-        # Update display
+        thisTime = time.clock()
+        if thisTime - self.last_adev_display_time > self.adev_display_period:
+            if self.daemon is not None:
+                self.sync_with_daemon()
+            self.update_adev_display()
+            self.last_adev_display_time = thisTime
+
+    def handle_channel(self, index):
+        if self.daemon is not None:
+            self.show_readings(index, *self.display_subs[index].drain())
+            return
+
+        error = self.pipeline.workers[index].error
+        if error is not None:
+            print(error)
+            # This is likely a counter timeout; probably there is no signal
+            # on self.channel[index], so stop trying to measure it
+
+            self.log.warning("Read failed on channel " + str(self.channels[index]))
+            self.check_activateChannels[index].setChecked(False)
+            self.enable_channels()
+            return
+        error = self.pipeline.screeners[index].error
+        if error is not None:
+            # The readings are no longer screened, logged or fed back
+            self.log.warning(
+                "Screening failed on channel %i (%s)" % (self.channels[index], error)
+            )
+            self.check_activateChannels[index].setChecked(False)
+            self.enable_channels()
+            return
+
+        # Every consumer has its own subscription to the channel, so each one
+        # gets all readings published since it last ran (the feedback loops
+        # only get readings that passed screening, see
+        # pipeline.CounterPipeline)
+        self.show_readings(index, *self.display_subs[index].drain())
+        self.reference_feedback(index, *self.ref_subs[index].drain())
+        self.temperature_feedback(index, *self.temp_subs[index].drain())
+
+    def show_readings(self, index, times, freqs):
+        if not len(freqs):
+            return
+        self.freqs[index] = freqs[-1]
+        self.allans[index].update(freqs, times)
+        self.rolling_stats[index].update(freqs)
         self.update_display(index)
 
-        # Log data
-        if self.logging_channel[index]:
-            if thisTime - self.last_log_time[index] > self.freq_log_period:
-                # Time to log another point...
-                self.log_files[index].write(
-                    self.logfmt.format(
-                        thisTime - self.log_start_times[index], self.freqs[index]
-                    )
-                )
-                self.log_files[index].flush()
-                # If it has been too long since last log, set current time to
-                # last log Otherwise just add log period to last log time to
-                # keep interval constant
-                if thisTime - self.last_log_time[index] < self.freq_log_period * 2:
-                    self.last_log_time[index] += self.freq_log_period
-                else:
-                    self.last_log_time[index] = thisTime
-
-        # Feedback to reference laser
-        if self.refLaserFeedbacks[index]:
-            if thisTime - self.lastRefFeedbackTime > self.laser_feedback_period:
-                dF = self.freqs[index] - self.freqTargets[index]
+    def reference_feedback(self, index, times, freqs):
+        ref = self.ref_feedbacks[index]
+        if ref is None:
+            return
+        if not ref.update(times, freqs):
+            # Frequency is too far off or the laser failed; turn off feedback
+            self.check_refFeedbacks[index].setChecked(False)
+            self.enable_reference_feedback(index)
+        elif USETEMP and ref.setpoint is not None:
+            self.edit_laserTemp.setText(str(ref.setpoint))
 
-                if abs(dF) > self.laser_allowed_frequency_detune:
-                    self.log.warning(
-                        "Frequency difference from target (%.1f) greater than allowed (%.1f)"
-                        % (dF, self.laser_allowed_frequency_detune)
-                    )
-                    self.refFeedbackStrikes[index] += 1
-                    self.log.warning(
-                        "Strike #%i (%i strikes allowed)"
-                        % (
-                            self.refFeedbackStrikes[index],
-                            self.laser_feedback_strike_limit,
-                        )
-                    )
-                    if (
-                        self.refFeedbackStrikes[index]
-                        > self.laser_feedback_strike_limit
-                    ):
-                        # Frequency is too far off, turn off feedback
-                        self.check_refFeedbacks[index].setChecked(False)
-                        self.enable_reference_feedback(index)
-
-                else:  # Rep rate has NOT drifted too far from target
-                    self.refFeedbackStrikes[index] = 0
-                    if abs(dF) > self.laser_feedback_threshold:
-                        # Frequency has drifted far enough to feedback to laser
-                        # Change laser temp tocorrect problem
-                        try:
-                            if USETEMP:
-                                # Temp up, R down -> wl up, f down
-                                # So if dF > 0 turn R down
-                                if dF > 0:
-                                    dT = -1  # Ohms
-                                else:
-                                    dT = 1  # Ohms
-                                # dT changes thermister setpoint of laser in
-                                # Ohms dT>0 raises rep rate; dT<0 drops rep
-                                # rate
-                                new_temp = self.reference_laser.change_t(dT)
-                                self.log.info("Ref laser temp set to %i" % new_temp)
-                                self.edit_laserTemp.setText(str(new_temp))
-                            else:
-                                # I up -> wl up, f down
-                                # So if dF > 0 turn I up
-                                if dF < 0:
-                                    dI = 1  # 0.1 mA
-                                else:
-                                    dI = -1  # 0.1 mA
-                                new_I = self.reference_laser.change_i(dI)
-                                self.log.info(
-                                    "Ref laser current set to %i (0.1mA)" % new_I
-                                )
-
-                        except Exception as e:
-                            # Failed to set new laser temp; turn off feedback
-
-                            self.log.warning("Failed to communicate with ref laser")
-                            print(e)
-                            self.check_refFeedbacks[index].setChecked(False)
-                            self.enable_reference_feedback(index)
-                        self.lastRefFeedbackTime = thisTime
-
-        # Feedback to comb temperature
-        if self.tempFeedbacks[index]:
-            if thisTime - self.lastTempFeedbackTimes[index] > self.temp_feedback_period:
-                dF = self.freqs[index] - self.freqTargets[index]
-                if abs(dF) > self.temp_feedback_threshold:
-                    try:
-                        # Temp increase lowers rep rate, temp decrease raises
-                        # it
-                        if dF > 0:
-                            feedbackSign = 1
-                        else:
-                            feedbackSign = -1
-                        self.tempAdjustValues[index] += feedbackSign * self.temp_step
-
-                        # Limit temperature feedback value
-                        if (
-                            abs(self.tempAdjustValues[index])
-                            > self.temp_max_allowed_adjust
-                        ):
-                            self.tempAdjustValues[index] = (
-                                feedbackSign * self.temp_max_allowed_adjust
-                            )
-                            self.log.warning(
-                                "Channel %i temp adjust at limit (%.2f)"
-                                % (self.channels[index], self.tempAdjustValues[index])
-                            )
-
-                        self.IPC_clients[index].send_text(
-                            "%f\n" % self.tempAdjustValues[index]
-                        )
-                        self.log.info(
-                            "Channel %i temperature adjusted by %.2f"
-                            % (self.channels[index], self.tempAdjustValues[index])
-                        )
-                    except socket.error:
-                        # Failed to send to the socket port; the server has
-                        # been disconnected (happens if temp program closed).
-                        # Stop feedback
-
-                        self.log.warning(
-                            "Unable to communicate with server at port %i"
-                            % self.temp_port_numbers[index]
-                        )
-                        self.check_tempFeedbacks[index].setChecked(False)
-                        self.enable_temperature_feedback(index)
-                    self.lastTempFeedbackTimes[index] = thisTime
+    def temperature_feedback(self, index, times, freqs):
+        temp = self.temp_feedbacks[index]
+        if temp is not None:
+            temp.update(times, freqs)
 
     def calc_values(self):
-        self.deltaF = abs(self.freqs[1] - self.freqs[0])
-        self.nq = (self.nq * self.nqAverages + min(self.freqs) / self.deltaF) / (
-            self.nqAverages + 1
-        )
-        self.nqAverages += 1
+        # Max number of unpaired readings kept per channel
+        max_backlog = 4096
+
+        for index in range(len(self.channels)):
+            times, freqs = self.pair_readers[index].drain()
+            if not self.channel_is_active[index]:
+                # nothing to pair with
+                self.pair_times = [np.zeros(0) for t in self.pair_times]
+                self.pair_freqs = [np.zeros(0) for f in self.pair_freqs]
+                return
+            self.pair_times[index] = np.append(self.pair_times[index], times)[
+                -max_backlog:
+            ]
+            self.pair_freqs[index] = np.append(self.pair_freqs[index], freqs)[
+                -max_backlog:
+            ]
+
+        t1, t2 = self.pair_times
+        f1, f2 = self.pair_freqs
+        if not len(t1) or not len(t2):
+            return
+
+        # Only pair channel 1 readings that are older than the newest channel
+        # 2 reading; a later channel 2 reading could still be a closer match
+        # for the rest
+        n = np.searchsorted(t1, t2[-1], side="right")
+        i1, i2 = acquisition.pair_by_time(t1[:n], t2, self.pair_tolerance)
+        deltaF = abs(f2[i2] - f1[i1])
+        good = deltaF > 0
+        if good.any():
+            nq = np.minimum(f1[i1], f2[i2])[good] / deltaF[good]
+            self.deltaF = deltaF[good][-1]
+            self.nq_stats.update(nq)
+            self.nq = self.nq_stats.mean
+            self.nqAverages = self.nq_stats.count
+
+        # Keep the unpaired channel 1 readings, and every channel 2 reading
+        # that could still be paired with one of them
+        self.pair_times[0] = t1[n:]
+        self.pair_freqs[0] = f1[n:]
+        t_min = (t1[n] if n < len(t1) else t2[-1]) - self.pair_tolerance
+        keep = t2 >= t_min
+        self.pair_times[1] = t2[keep]
+        self.pair_freqs[1] = f2[keep]
 
     def reset_nq(self):
+        self.nq_stats.reset()
         self.nq = 0
         self.nqAverages = 0
 
@@ -549,40 +489,73 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
         self.display_nq.display(self.dispSmallFormat.format(self.nq))
         self.display_nqAverages.display(self.nqAverages)
 
-    def get_next_index(self, index=None):
-        # Returns next index, looping back to zero when last index is passed
-        if index is None:
-            index = self.index
-        if index == len(self.channels) - 1:
-            return 0
-        else:
-            return index + 1
-
-    def increment_index(self, n=0):
-        # Moves self.index to the next index and loops back to 0 when last
-        # index is passed
-        num = len(self.channels)
-        if self.index == num - 1:
-            self.index = 0
-        else:
-            self.index += 1
-        if not self.channel_is_active[self.index]:
-            n += 1
-            if n >= num:
-                return
+    def update_adev_display(self):
+        text = []
+        for index in range(len(self.channels)):
+            if not self.channel_is_active[index]:
+                continue
+            rolling = self.rolling_stats[index]
+            error = rolling.mean - self.freqTargets[index]
+            line = "Ch%i error %.1f +- %.1f Hz  ADEV  " % (
+                self.channels[index],
+                error,
+                rolling.std,
+            )
+            if self.channels[index] in self.uneven_channels:
+                line += "n/a while calibrating"
             else:
-                self.increment_index()
+                taus, adevs, mdevs = self.allans[index].results()
+                line += "  ".join(
+                    "%.3g s: %.2e" % (tau, adev) for tau, adev in zip(taus, adevs)
+                )
+            text.append(line)
+        if self.daemon is not None:
+            result = self.daemon_status["calibration"]
+        elif self.pipeline.calibration is not None:
+            result = self.pipeline.calibration.result()
+        else:
+            result = None
+        if result is not None:
+            text.append(
+                "Cal offset %.3f Hz (fit %.3f +- %.3f Hz, %i pairs)"
+                % (
+                    result["offset"],
+                    result["fit_offset"],
+                    result["fit_offset_std"],
+                    result["pairs"],
+                )
+            )
+        self.statusbar.showMessage("   |   ".join(text))
 
     def enable_channels(self):
         # Turns each channel on or off based on state of its GUI checkbox
+        if self.daemon is not None:
+            for index, channel in enumerate(self.channels):
+                active = self.check_activateChannels[index].isChecked()
+                if active == self.channel_is_active[index]:
+                    continue
+                self.daemon_command("CHANNEL", channel, "ON" if active else "OFF")
+                if active:
+                    # skip whatever was left over from before the pause
+                    self.display_subs[index].drain()
+                    self.allans[index].reset()
+                    self.rolling_stats[index].reset()
+            return
+
         for index in range(len(self.channels)):
             if self.check_activateChannels[index].isChecked():
                 # Enable channel measurement
                 self.channel_is_active[index] = True
-                self.index = index
+                if self.pipeline.resume(index):
+                    # skip whatever was left over from before the pause
+                    for subs in (self.display_subs, self.ref_subs, self.temp_subs):
+                        subs[index].clear()
+                    self.allans[index].reset()
+                    self.rolling_stats[index].reset()
             else:
                 # Disable channel and all related feedback and logging
                 self.channel_is_active[index] = False
+                self.pipeline.pause(index)
 
                 self.check_logChannels[index].setChecked(False)
                 self.enable_frequency_logging(index)
@@ -601,28 +574,13 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
             self.timer.stop()
 
     def enable_frequency_logging(self, index):
-        channel = self.channels[index]
-        try:
-            self.log_files[index].close()
-        except Exception:
-            pass
-
-        if self.check_logChannels[index].isChecked():
-            self.logging_channel[index] = True
-            startDateTime = datetime.datetime.now().strftime(
-                self.timefmt
-            )  # YYY-MM-DD_HHMMSS
-            self.log_files[index] = open(
-                self.log_dir + startDateTime + "_chan" + str(channel), "w"
-            )
-            self.log_files[index].write(self.hdr_str)
-            self.log_start_times[index] = time.clock()
-            self.last_log_time[index] = -9999
-            self.log.warning("Channel %i logging started" % channel)
+        if self.daemon is not None:
+            on = self.check_logChannels[index].isChecked()
+            self.daemon_command("LOG", self.channels[index], "ON" if on else "OFF")
+        elif self.check_logChannels[index].isChecked():
+            self.pipeline.start_logging(index)
         else:
-            if self.logging_channel[index]:
-                self.log.warning("Channel %i logging stopped" % channel)
-                self.logging_channel[index] = False
+            self.pipeline.stop_logging(index)
 
     def enable_all_logs(self, logEnable=True):
         for index in range(len(self.channels)):
@@ -646,7 +604,15 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
                     + str(self.acceptableFreqRange[1])
                     + ")"
                 )
+            if self.daemon is not None:
+                self.daemon_command(
+                    "TARGET", self.channels[index], "{:.3f}".format(userInput)
+                )
+                return
             self.freqTargets[index] = userInput
+            for controller in (self.ref_feedbacks[index], self.temp_feedbacks[index]):
+                if controller is not None:
+                    controller.target = userInput
         except Exception as e:
 
             self.edit_freqTargets[index].setText(
@@ -658,34 +624,71 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
             print("")
 
     def enable_reference_feedback(self, index):
-        if self.check_refFeedbacks[index].isChecked() and self.laser_connected:
+        if self.daemon is not None:
+            on = self.check_refFeedbacks[index].isChecked()
+            self.daemon_command("REFFB", self.channels[index], "ON" if on else "OFF")
+        elif self.check_refFeedbacks[index].isChecked() and self.laser_connected:
+            # There is one laser, so only one channel can steer it
             for ii in range(len(self.check_refFeedbacks)):
-                if ii != index:
+                if ii != index and self.ref_feedbacks[ii] is not None:
                     self.check_refFeedbacks[ii].setChecked(False)
-                    self.refLaserFeedbacks[index] = False
+                    self.enable_reference_feedback(ii)
             self.log.warning(
                 "Feedback to reference laser enabled on channel %i"
                 % self.channels[index]
             )
-            self.refLaserFeedbacks[index] = True
-            self.refFeedbackStartDatetime = datetime.datetime.now().strftime(
-                self.timefmt
-            )  # YYY-MM-DD_HHMMSS
-            self.lastRefFeedbackTime = -9999
-            self.refFeedbackStrikes[index] = 0
+            self.ref_feedbacks[index] = feedback.ReferenceFeedback(
+                self.reference_laser,
+                self.freqTargets[index],
+                self.feedback_settings,
+                self.channels[index],
+                USETEMP,
+                self.log,
+            )
+            self.pipeline.set_flag(index, freqlogs.FEEDBACK_REF, True)
+            # Keep RS232 control enabled while feedback runs, so each
+            # feedback step is a single packet exchange
+            try:
+                self.reference_laser.begin_session()
+            except Exception as e:
+                print(e)
+                self.log.warning("Failed to start ref laser session")
         else:
+            self.check_refFeedbacks[index].setChecked(False)
+            if self.ref_feedbacks[index] is None:
+                return
             self.log.warning(
                 "Feedback to reference laser disabled on channel %i"
                 % self.channels[index]
             )
-            self.check_refFeedbacks[index].setChecked(False)
-            self.refLaserFeedbacks = [False] * len(self.refLaserFeedbacks)
+            self.ref_feedbacks[index] = None
+            self.pipeline.set_flag(index, freqlogs.FEEDBACK_REF, False)
+            if self.laser_connected:
+                try:
+                    self.reference_laser.end_session()
+                except Exception as e:
+                    print(e)
+                    self.log.warning("Failed to end ref laser session")
 
     def connect_laser(self):
-        if self.check_laserConnect.isChecked():
+        if self.daemon is not None:
+            port = "".join(str(self.edit_laserPort.text()).split())
+            if not self.check_laserConnect.isChecked():
+                port = "OFF"
+            t_0 = self.daemon_command("LASER", port)
+            if t_0 is not None:
+                self.edit_laserTemp.setText(str(t_0))
+        elif self.check_laserConnect.isChecked():
             port = "".join(str(self.edit_laserPort.text()).split())
             try:
-                self.reference_laser = orionlasers.OrionLaser(port)
+                if self.simData:
+                    # the simulated laser steers the channel 1 comb
+                    self.reference_laser = orionlasers.OrionLaser(
+                        port,
+                        ser=simulators.FakeOrionSerial(self.pipeline.sim_signals[1]),
+                    )
+                else:
+                    self.reference_laser = orionlasers.OrionLaser(port)
                 self.laser_connected = True
                 self.edit_laserTemp.setText(str(self.reference_laser.t_0))
             except Exception as e:
@@ -693,7 +696,7 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
                 print(e)
                 self.log.warning("Failed to connect ORION Laser on " + port)
         else:
-            for index in range(len(self.refLaserFeedbacks)):
+            for index in range(len(self.channels)):
                 self.check_refFeedbacks[index].setChecked(False)
                 self.enable_reference_feedback(index)
             self.reference_laser.close()
@@ -733,84 +736,100 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
             self.populate_textboxes()
 
     def enable_temperature_feedback(self, index):
-        if self.check_tempFeedbacks[index].isChecked():
+        if self.daemon is not None:
+            if self.check_tempFeedbacks[index].isChecked():
+                self.daemon_command(
+                    "TEMPFB", self.channels[index], "ON", self.temp_port_numbers[index]
+                )
+            else:
+                self.daemon_command("TEMPFB", self.channels[index], "OFF")
+        elif self.check_tempFeedbacks[index].isChecked():
+            if self.temp_feedbacks[index] is not None:
+                return
             try:
-                test = AsyncSocketComms.AsyncSocketClient(self.temp_port_numbers[index])
-                self.IPC_clients[index] = test
-                self.tempFeedbacks[index] = True
-                self.tempFeedbackStartDatetimes[
-                    index
-                ] = datetime.datetime.now().strftime(
-                    self.timefmt
-                )  # YYY-MM-DD_HHMMSS
-                self.lastTempFeedbackTimes[index] = -9999
-                self.log.warning(
-                    "Socket connection on port  %i successful; begin temp feedback"
-                    % self.temp_port_numbers[index]
+                client = AsyncSocketComms.AsyncSocketClient(
+                    self.temp_port_numbers[index]
                 )
             except socket.error:
-
                 self.log.warning(
                     "No server detected at port %i; cannot start temp feedback"
                     % self.temp_port_numbers[index]
                 )
                 self.check_tempFeedbacks[index].setChecked(False)
-        else:
+                return
+            self.temp_feedbacks[index] = feedback.TemperatureFeedback(
+                client,
+                self.freqTargets[index],
+                self.feedback_settings,
+                self.channels[index],
+                self.log,
+            )
+            self.pipeline.set_flag(index, freqlogs.FEEDBACK_TEMP, True)
+            self.log.warning(
+                "Socket connection on port  %i successful; begin temp feedback"
+                % self.temp_port_numbers[index]
+            )
+        elif self.temp_feedbacks[index] is not None:
             self.log.warning(
                 "Temperature feedback on channel %i disabled" % self.channels[index]
             )
-            self.tempFeedbacks[index] = False
+            self.temp_feedbacks[index].close()
+            self.temp_feedbacks[index] = None
+            self.pipeline.set_flag(index, freqlogs.FEEDBACK_TEMP, False)
 
     def commit_to_temp_adjustment(self, index):
-        if self.tempFeedbacks[index]:
-            try:
-                self.IPC_clients[index].send_text("COMMITADJUST\n")
-                self.log.warning(
-                    "Channel %i temperature adjust value (%.2f) added to set point"
-                    % (self.channels[index], self.tempAdjustValues[index])
-                )
-            except socket.error:
-                # Failed to send to the socket port; the server has
-                # been disconnected (happens if temp program closed).
-                # Stop feedback
-
-                self.log.warning(
-                    "Unable to communicate with server at port %i"
-                    % self.temp_port_numbers[index]
-                )
+        if self.daemon is not None:
+            self.daemon_command("COMMIT", self.channels[index])
+            return
+        if self.temp_feedbacks[index] is not None:
+            self.temp_feedbacks[index].commit()
         self.check_tempFeedbacks[index].setChecked(False)
         self.enable_temperature_feedback(index)
-        self.tempAdjustValues[index] = 0
 
     def adjust_parameters(self):
         try:
-            self.temp_feedback_period = float(self.edit_tempFeedbackPeriod.text())
-            self.temp_feedback_threshold = float(self.edit_tempFeedbackThreshold.text())
-            self.temp_step = float(self.edit_tempStepSize.text())
-            self.laser_feedback_period = float(self.edit_laserFeedbackPeriod.text())
-            self.laser_feedback_threshold = float(
-                self.edit_laserFeedbackThreshold.text()
+            values = dict(
+                temp_feedback_period=float(self.edit_tempFeedbackPeriod.text()),
+                temp_feedback_threshold=float(self.edit_tempFeedbackThreshold.text()),
+                temp_step=float(self.edit_tempStepSize.text()),
+                laser_feedback_period=float(self.edit_laserFeedbackPeriod.text()),
+                laser_feedback_threshold=float(
+                    self.edit_laserFeedbackThreshold.text()
+                ),
             )
         except ValueError:
 
             print("Invalid input")
             self.populate_textboxes()
+            return
+        for name, value in values.items():
+            if value == getattr(self.feedback_settings, name):
+                continue
+            if self.daemon is not None:
+                value = self.daemon_command("PARAM", name, value)
+                if value is None:
+                    continue
+            setattr(self.feedback_settings, name, value)
+        self.populate_textboxes()
 
     def populate_textboxes(self):
+        settings = self.feedback_settings
         for index in range(len(self.channels)):
             self.edit_portNumbers[index].setText(
                 "{:}".format(self.temp_port_numbers[index])
             )
-        self.edit_tempFeedbackPeriod.setText("{:.0f}".format(self.temp_feedback_period))
+        self.edit_tempFeedbackPeriod.setText(
+            "{:.0f}".format(settings.temp_feedback_period)
+        )
         self.edit_tempFeedbackThreshold.setText(
-            "{:.0f}".format(self.temp_feedback_threshold)
+            "{:.0f}".format(settings.temp_feedback_threshold)
         )
-        self.edit_tempStepSize.setText("{:.2f}".format(self.temp_step))
+        self.edit_tempStepSize.setText("{:.2f}".format(settings.temp_step))
         self.edit_laserFeedbackPeriod.setText(
-            "{:.0f}".format(self.laser_feedback_period)
+            "{:.0f}".format(settings.laser_feedback_period)
         )
         self.edit_laserFeedbackThreshold.setText(
-            "{:.0f}".format(self.laser_feedback_threshold)
+            "{:.0f}".format(settings.laser_feedback_threshold)
         )
 
     def close_cleanup(self):
@@ -818,17 +837,26 @@ class CounterWidget(QMainWindow, Ui_MainWindow):
         print(1 + 1)
 
     def closeEvent(self, event):
-        # close the com port to the chinese counter
-        self.chin_counter.close()
-
         # QT method, cannot rename
+        if self.daemon is not None:
+            self.log.warning("GUI exit; the counter daemon keeps running")
+            self.timer.stop()
+            self.daemon.close()
+            event.accept()
+            return
+
         self.log.warning("GUI exit; cleaning up")
         self.enable_all_logs(False)
 
         self.timer.stop()
 
-        if not self.simData:
-            self.counter.close()
+        for index in range(len(self.channels)):
+            self.check_tempFeedbacks[index].setChecked(False)
+            self.enable_temperature_feedback(index)
+
+        for sub in self.display_subs + self.ref_subs + self.temp_subs:
+            sub.close()
+        self.pipeline.close()
 
         event.accept()
         return
@@ -0,0 +1,327 @@
+# %% package imports
+import os
+import sys
+import glob
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import serial
+from serial.tools import list_ports
+
+# %% global variables
+# Device types discovery can identify
+ORION = "orion"
+SERIAL_COUNTER = "serial_counter"
+
+# Where identified devices are remembered between runs
+DEFAULT_REGISTRY_PATH = os.path.join(os.path.expanduser("~"), ".counter_devices.json")
+DEFAULT_IDN_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".counter_visa_idn.json")
+
+# How long to listen for serial counter frames (it sends at least one a
+# second), and the read timeout used when probing for an Orion laser
+COUNTER_LISTEN_TIME = 1.2  # s
+PROBE_TIMEOUT = 0.2  # s
+MAX_WORKERS = 16
+
+# VISA timeout while asking a resource for *IDN?
+IDN_TIMEOUT = 2000  # ms
+
+
+# %% function defs
+def load_json(path):
+    if path is None:
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json(path, data):
+    if path is None:
+        return
+    try:
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+    except OSError as e:
+        print("Could not save %s: %s" % (path, e))
+
+
+# %% serial ports
+def candidate_ports():
+    """
+    Returns the serial ports the OS knows about, as a dict of port name ->
+    USB key (see usb_key) or None for ports that are not USB devices
+    """
+    try:
+        return dict((p.device, usb_key(p)) for p in list_ports.comports())
+    except Exception:
+        pass
+
+    # Fall back on guessing names, as serial_finder used to
+    if sys.platform.startswith("win"):
+        ports = ["COM%s" % (i + 1) for i in range(256)]
+    elif sys.platform.startswith("linux") or sys.platform.startswith("cygwin"):
+        # this excludes your current terminal "/dev/tty"
+        ports = glob.glob("/dev/tty[A-Za-z]*")
+    elif sys.platform.startswith("darwin"):
+        ports = glob.glob("/dev/tty.*")
+    else:
+        raise EnvironmentError("Unsupported platform")
+    return dict((port, None) for port in ports)
+
+
+def usb_key(port_info):
+    if port_info.vid is None:
+        return None
+    return "%04X:%04X:%s" % (port_info.vid, port_info.pid, port_info.serial_number)
+
+
+def can_open(port):
+    try:
+        s = serial.Serial(port)
+        s.close()
+        return True
+    except (OSError, serial.SerialException):
+        return False
+
+
+def available_ports(ports=None, max_workers=MAX_WORKERS):
+    """Ports that can be opened, tested concurrently"""
+    if ports is None:
+        ports = list(candidate_ports())
+    with ThreadPoolExecutor(max_workers) as pool:
+        ok = list(pool.map(can_open, ports))
+    return [port for port, good in zip(ports, ok) if good]
+
+
+def identify(port, listen_time=COUNTER_LISTEN_TIME, timeout=PROBE_TIMEOUT):
+    """
+    Works out what is on port from its protocol. A serial counter talks on
+    its own, so first listen for F-CH frames; if nothing is heard, try to
+    read an Orion laser's serial number. Returns a dict describing the
+    device, or None.
+    """
+    # Both modules use this one, so they are not imported at the top
+    try:
+        from . import orionlasers, serialcounters
+    except ImportError:
+        import orionlasers
+        import serialcounters
+
+    try:
+        ser = serial.Serial(port, baudrate=9600, timeout=timeout)
+    except (OSError, serial.SerialException):
+        return None
+    try:
+        decoder = serialcounters.FrameDecoder()
+        deadline = time.time() + listen_time
+        while time.time() < deadline:
+            data = ser.read(max(1, ser.in_waiting))
+            readings = decoder.feed(data)
+            if readings:
+                return dict(port=port, type=SERIAL_COUNTER, channel=readings[0][0])
+
+        ser.reset_input_buffer()
+        codec = orionlasers.PacketCodec(ser, timeout)
+        # Enable RS232, read the serial number, disable RS232; one packet at
+        # a time, as OrionLaser does, unless pipelining is turned on
+        cmds = [(0x24, None), (0x08, None), (0x25, None)]
+        batches = [cmds] if orionlasers.PIPELINE_COMMANDS else [[c] for c in cmds]
+        replies = []
+        for batch in batches:
+            pkt_ids, pkts = codec.send(batch)
+            replies += [orionlasers.pkt_interpret(codec.receive(i)) for i in pkt_ids]
+        return dict(port=port, type=ORION, sn=replies[1][0])
+    except Exception:
+        return None
+    finally:
+        ser.close()
+
+
+def discover(ports=None, max_workers=MAX_WORKERS, **kwargs):
+    """
+    Identifies the devices on every port (or just ports) concurrently, each
+    probe with its own timeouts. Returns a list of device dicts with a "usb"
+    key added.
+    """
+    if ports is None:
+        ports = candidate_ports()
+    elif not isinstance(ports, dict):
+        ports = dict((port, None) for port in ports)
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        found = list(pool.map(lambda port: identify(port, **kwargs), ports))
+
+    devices = []
+    for port, device in zip(ports, found):
+        if device is not None:
+            device["usb"] = ports[port]
+            devices.append(device)
+    return devices
+
+
+# %% device registry
+class DeviceRegistry:
+    """
+    Remembers identified devices on disk, keyed by USB VID:PID:serial number
+    (or by port name for non-USB ports), so the next startup can go straight
+    to the right port instead of probing all of them
+    """
+
+    def __init__(self, path=DEFAULT_REGISTRY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.devices = load_json(path)
+
+    @staticmethod
+    def key(device):
+        return device.get("usb") or device["port"]
+
+    def update(self, devices):
+        with self.lock:
+            for device in devices:
+                self.devices[self.key(device)] = device
+            save_json(self.path, self.devices)
+
+    def lookup(self, device_type, sn=None, ports=None):
+        """
+        Known devices of device_type (and serial number sn) that are plugged
+        in now, with their current port name (USB devices can move between
+        port names)
+        """
+        if ports is None:
+            ports = candidate_ports()
+        usb_ports = dict((key, port) for port, key in ports.items() if key)
+
+        matches = []
+        for key, device in self.devices.items():
+            if device["type"] != device_type:
+                continue
+            if sn is not None and device.get("sn") != sn:
+                continue
+            port = usb_ports.get(key, key if key in ports else None)
+            if port is not None:
+                matches.append(dict(device, port=port))
+        return matches
+
+
+def find_devices(device_type, sn=None, registry=None, verify=True):
+    """
+    Returns the ports of every device_type (with serial number sn) device.
+    Devices in the registry are tried first, confirmed with one probe each
+    if verify is True; only if none is found are all ports probed, and the
+    registry is updated with everything found.
+    """
+    if registry is None:
+        registry = DeviceRegistry()
+    ports = candidate_ports()
+
+    known = registry.lookup(device_type, sn, ports)
+    if known and verify:
+        confirmed = discover([device["port"] for device in known])
+        known = [d for d in confirmed if d["type"] == device_type]
+        if sn is not None:
+            known = [d for d in known if d.get("sn") == sn]
+    if known:
+        return [device["port"] for device in known]
+
+    devices = discover(ports)
+    registry.update(devices)
+    return [
+        d["port"]
+        for d in devices
+        if d["type"] == device_type and (sn is None or d.get("sn") == sn)
+    ]
+
+
+# %% VISA instruments
+def query_idn(rm, resource_name, timeout=IDN_TIMEOUT):
+    """Returns the *IDN? reply of resource_name, or None if it does not answer"""
+    try:
+        resource = rm.open_resource(resource_name)
+    except Exception as e:
+        print("Failed to open " + resource_name)
+        print(e)
+        return None
+    try:
+        resource.timeout = timeout
+        return str(resource.query("*IDN?")).strip()
+    except Exception as e:
+        print("Failed to test device at " + resource_name)
+        print(e)
+        return None
+    finally:
+        try:
+            resource.before_close()
+            resource.close()
+        except Exception:
+            pass
+
+
+def scan_visa(rm, query="GPIB?*INSTR", max_workers=MAX_WORKERS):
+    """
+    Asks every resource matching query for *IDN? concurrently, so absent or
+    slow instruments time out together instead of one after another.
+    Returns a dict of resource name -> IDN for the resources that answered.
+    """
+    names = list(rm.list_resources(query))
+    if not names:
+        return {}
+    with ThreadPoolExecutor(min(max_workers, len(names))) as pool:
+        idns = list(pool.map(lambda name: query_idn(rm, name), names))
+    return dict((name, idn) for name, idn in zip(names, idns) if idn is not None)
+
+
+class IdnCache:
+    """
+    Resource name -> IDN of VISA instruments seen before, kept on disk at
+    path, or only in memory if path is None
+    """
+
+    def __init__(self, path=DEFAULT_IDN_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.idns = load_json(path)
+
+    def update(self, idns):
+        with self.lock:
+            self.idns.update(idns)
+            save_json(self.path, self.idns)
+
+    def forget(self, resource_name):
+        with self.lock:
+            if self.idns.pop(resource_name, None) is not None:
+                save_json(self.path, self.idns)
+
+
+def find_visa(rm, match, query="GPIB?*INSTR", cache=None):
+    """
+    Returns (resource name, IDN) of the first instrument whose IDN satisfies
+    match(idn), or (None, None). Resources the cache says match are checked
+    first, with one *IDN? query each; the whole bus is only scanned if none
+    of them still answers correctly. An entry is only forgotten when its
+    resource answers with a different IDN, not when it does not answer
+    (switched off, bus busy).
+    """
+    if cache is None:
+        cache = IdnCache()
+
+    for resource_name, idn in list(cache.idns.items()):
+        if not match(idn):
+            continue
+        idn = query_idn(rm, resource_name)
+        if idn is None:
+            continue
+        if match(idn):
+            return resource_name, idn
+        cache.forget(resource_name)
+
+    idns = scan_visa(rm, query)
+    cache.update(idns)
+    for resource_name in sorted(idns):
+        if match(idns[resource_name]):
+            return resource_name, idns[resource_name]
+    return None, None
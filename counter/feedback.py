@@ -0,0 +1,186 @@
+# %% package imports
+import logging
+import stats
+
+
+# %% settings
+class FeedbackSettings:
+    """
+    Parameters of the reference laser and comb temperature feedback. One
+    instance is shared by the owner (CounterWidget, CounterDaemon) and all
+    of its controllers, which read it on every update, so a change applies
+    at once.
+    """
+
+    def __init__(self):
+        # How often to feedback to reference laser
+        self.laser_feedback_period = 2  # s
+        # Deviation from target frequency that triggers laser feedback
+        self.laser_feedback_threshold = 5  # Hz
+        # Max frequency deviation from target before laser feedback is canceled
+        self.laser_allowed_frequency_detune = 120  # Hz
+        # Number of consecutive times the frequency deviation can be bigger
+        # than max allowed before feedback is canceled
+        self.laser_feedback_strike_limit = 3
+
+        # How often to feedback to comb temperature
+        self.temp_feedback_period = 10  # s
+        # Temperature step size during temperature tuning
+        self.temp_step = 0.08  # deg C
+        # Deviation from target frequency that triggers temperature feedback
+        self.temp_feedback_threshold = 100  # Hz
+        # Max magnitude temperature adjustment that is allowed
+        self.temp_max_allowed_adjust = 5  # deg C
+
+        # Both feedbacks act on an exponentially weighted average of the
+        # screened readings (see stats.EWMA) rather than on the newest one
+        # alone; this is the weight of each new reading (1 uses the newest
+        # reading only). At 0.2 the noise is cut to a third, and the average
+        # settles within about 10 readings, well inside either period.
+        self.feedback_average_weight = 0.2
+
+
+# %% controllers
+class ReferenceFeedback:
+    """
+    Keeps a comb on target by stepping the reference laser (an
+    orionlasers.OrionLaser): every laser_feedback_period, if the frequency
+    is more than laser_feedback_threshold off target, the laser current (or,
+    with use_temp, its thermistor setpoint) is stepped by one unit. A
+    frequency more than laser_allowed_frequency_detune off target is a
+    strike; after more than laser_feedback_strike_limit strikes in a row the
+    feedback gives up.
+
+    The frequency compared to the target is self.average, an EWMA of the
+    readings passed to update() (see feedback_average_weight).
+
+    update() returns False once the feedback has given up or the laser
+    failed, True otherwise. self.setpoint is the last value the laser was
+    set to.
+    """
+
+    def __init__(self, laser, target, settings, channel, use_temp=False, log=None):
+        self.laser = laser
+        self.target = target  # Hz
+        self.settings = settings
+        self.channel = channel
+        self.use_temp = use_temp
+        self.log = logging.getLogger("counter") if log is None else log
+        self.last_time = -9999
+        self.strikes = 0
+        self.setpoint = None
+        self.average = stats.EWMA(settings.feedback_average_weight)
+
+    def update(self, times, freqs):
+        settings = self.settings
+        if not len(freqs):
+            return True
+        self.average.alpha = settings.feedback_average_weight
+        freq = self.average.update(freqs)
+        if times[-1] - self.last_time <= settings.laser_feedback_period:
+            return True
+        dF = freq - self.target
+
+        if abs(dF) > settings.laser_allowed_frequency_detune:
+            self.strikes += 1
+            self.log.warning(
+                "Frequency difference from target (%.1f) greater than allowed (%.1f)"
+                % (dF, settings.laser_allowed_frequency_detune)
+            )
+            self.log.warning(
+                "Strike #%i (%i strikes allowed)"
+                % (self.strikes, settings.laser_feedback_strike_limit)
+            )
+            # Frequency is too far off, turn off feedback
+            return self.strikes <= settings.laser_feedback_strike_limit
+
+        # Rep rate has NOT drifted too far from target
+        self.strikes = 0
+        if abs(dF) > settings.laser_feedback_threshold:
+            try:
+                if self.use_temp:
+                    # Temp up, R down -> wl up, f down
+                    # dT changes thermister setpoint of laser in Ohms
+                    self.setpoint = self.laser.change_t(-1 if dF > 0 else 1)
+                    self.log.info("Ref laser temp set to %i" % self.setpoint)
+                else:
+                    # I up -> wl up, f down
+                    self.setpoint = self.laser.change_i(1 if dF < 0 else -1)
+                    self.log.info("Ref laser current set to %i (0.1mA)" % self.setpoint)
+            except Exception as e:
+                print(e)
+                self.log.warning("Failed to communicate with ref laser")
+                return False
+            self.last_time = times[-1]
+        return True
+
+
+class TemperatureFeedback:
+    """
+    Keeps a comb on target through its temperature controller: every
+    temp_feedback_period, if the frequency is more than
+    temp_feedback_threshold off target, the adjust value is moved by
+    temp_step (limited to +-temp_max_allowed_adjust) and sent to the
+    controller through client (an AsyncSocketComms.AsyncSocketClient). As in
+    ReferenceFeedback the frequency is self.average, an EWMA of the readings.
+    """
+
+    def __init__(self, client, target, settings, channel, log=None):
+        self.client = client
+        self.target = target  # Hz
+        self.settings = settings
+        self.channel = channel
+        self.log = logging.getLogger("counter") if log is None else log
+        self.last_time = -9999
+        self.adjust = 0.0  # deg C
+        self.average = stats.EWMA(settings.feedback_average_weight)
+
+    def update(self, times, freqs):
+        settings = self.settings
+        if not len(freqs):
+            return
+        self.average.alpha = settings.feedback_average_weight
+        freq = self.average.update(freqs)
+        if times[-1] - self.last_time <= settings.temp_feedback_period:
+            return
+        dF = freq - self.target
+        if abs(dF) <= settings.temp_feedback_threshold:
+            return
+
+        # Temp increase lowers rep rate, temp decrease raises it
+        sign = 1 if dF > 0 else -1
+        self.adjust += sign * settings.temp_step
+
+        # Limit temperature feedback value
+        if abs(self.adjust) > settings.temp_max_allowed_adjust:
+            self.adjust = sign * settings.temp_max_allowed_adjust
+            self.log.warning(
+                "Channel %i temp adjust at limit (%.2f)" % (self.channel, self.adjust)
+            )
+
+        # Only queued, so this never blocks. If the temperature server has
+        # gone (e.g. it is being restarted) the client keeps reconnecting
+        # and sends the newest value once back.
+        self.client.send_setpoint("%f\n" % self.adjust)
+        self.log.info(
+            "Channel %i temperature adjusted by %.2f" % (self.channel, self.adjust)
+        )
+        if not self.client.connected:
+            self.log.warning(
+                "Server at port %i unreachable (%s); reconnecting"
+                % (self.client.PORT, self.client.last_error)
+            )
+        self.last_time = times[-1]
+
+    def commit(self):
+        """Has the controller add the adjust value to its set point"""
+        # Sent after any adjust value still queued
+        self.client.send_text("COMMITADJUST\n")
+        self.log.warning(
+            "Channel %i temperature adjust value (%.2f) added to set point"
+            % (self.channel, self.adjust)
+        )
+        self.adjust = 0.0
+
+    def close(self):
+        self.client.close()
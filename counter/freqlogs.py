@@ -0,0 +1,131 @@
+# %% package imports
+import os
+import struct
+import threading
+import time
+import collections
+import numpy as np
+
+# %% global variables
+# Every log file starts with a HEADER_SIZE byte header: MAGIC, then the log
+# start as a unix timestamp (float64), then zero padding. The rest of the
+# file is a packed array of RECORD_DTYPE records.
+MAGIC = b"CNTLOG1\n"
+HEADER_SIZE = 64
+RECORD_DTYPE = np.dtype(
+    [
+        ("time", "<f8"),  # s since log start
+        ("channel", "u1"),
+        ("freq", "<f8"),  # Hz
+        ("target", "<f8"),  # Hz
+        ("feedback", "u1"),  # FEEDBACK_* flags
+    ]
+)
+
+# Bits of the feedback field
+FEEDBACK_REF = 0x01  # reference laser feedback active
+FEEDBACK_TEMP = 0x02  # comb temperature feedback active
+REJECTED = 0x04  # reading rejected as an outlier, not used for feedback
+
+FILE_EXTENSION = ".cntlog"
+
+
+# %% writer
+class BinaryLogWriter:
+    """
+    Appends RECORD_DTYPE records to a log file from a background thread.
+
+    append() only queues the record, so it is cheap enough to call from the
+    acquisition path. The writer thread wakes up every flush_period seconds,
+    writes everything queued in one write() call, and fsyncs the file every
+    fsync_period seconds, so at most fsync_period worth of data can be lost
+    on a crash. If given, on_write(records) is called after every batch
+    has been written.
+
+    Records appended once close() has begun are not written; they are
+    counted in self.records_dropped.
+    """
+
+    def __init__(self, path, flush_period=1.0, fsync_period=10.0, on_write=None):
+        self.path = path
+        self.on_write = on_write
+        self.flush_period = flush_period  # s
+        self.fsync_period = fsync_period  # s
+        self.records_written = 0
+        self.records_dropped = 0
+
+        self.file = open(path, "wb")
+        header = MAGIC + struct.pack("<d", time.time())
+        self.file.write(header.ljust(HEADER_SIZE, b"\x00"))
+
+        self.queue = collections.deque()
+        # Held by append() and close(), so nothing is queued after the last
+        # write
+        self._lock = threading.Lock()
+        self._shutdown = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="log writer " + os.path.basename(path), daemon=True
+        )
+        self._thread.start()
+
+    def append(self, t, channel, freq, target, feedback=0):
+        with self._lock:
+            if self._shutdown.is_set():
+                self.records_dropped += 1
+                return
+            self.queue.append((t, channel, freq, target, feedback))
+
+    def _write_queued(self):
+        n = len(self.queue)
+        if not n:
+            return
+        records = np.array([self.queue.popleft() for i in range(n)], RECORD_DTYPE)
+        self.file.write(records.tobytes())
+        self.file.flush()
+        self.records_written += n
+        if self.on_write is not None:
+            self.on_write(records)
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _run(self):
+        last_sync = time.perf_counter()
+        while not self._shutdown.wait(self.flush_period):
+            self._write_queued()
+            if time.perf_counter() - last_sync > self.fsync_period:
+                self._sync()
+                last_sync = time.perf_counter()
+
+    def close(self):
+        with self._lock:
+            self._shutdown.set()
+        self._thread.join()
+        self._write_queued()
+        self._sync()
+        self.file.close()
+
+
+# %% reader
+def load_log(path):
+    """
+    Memory-maps a log written by BinaryLogWriter. Returns (start_time,
+    records), where start_time is the unix time the log was started and
+    records is a read-only RECORD_DTYPE array (index it by field name, e.g.
+    records["freq"]). A partially written last record is ignored, so this is
+    safe to call on a log that is still being written.
+    """
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+        raise ValueError("%s is not a counter log" % path)
+    start_time = struct.unpack("<d", header[len(MAGIC) : len(MAGIC) + 8])[0]
+
+    n = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    if not n:
+        return start_time, np.zeros(0, RECORD_DTYPE)
+    records = np.memmap(
+        path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE, shape=(n,)
+    )
+    return start_time, records
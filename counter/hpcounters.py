@@ -1,10 +1,26 @@
 # %% package imports
 import pyvisa as visa
-import sys, math
+import sys, math, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+try:  # imported as part of the counter package
+    from . import discovery
+except ImportError:  # run from inside counter/
+    import discovery
 
 # %% global variables
 COUNTER_ID_PREFIX = "HEWLETT-PACKARD,53132A,0,"
 DEFAULT_GATE_TIME = 0.1
+# Statistics the 53132A can compute over a block of measurements
+BLOCK_STATISTICS = ("MEAN", "SDEV", "MIN", "MAX")
+# Message AVailable bit of the status byte: a result is waiting to be read
+STB_MAV = 0x10
+# Readings taken on one channel before ChannelScheduler moves to the next
+DEFAULT_BATCH_SIZE = 10
+# VISA resource of the GPIB controller, used to address several counters at once
+DEFAULT_GPIB_INTERFACE = "GPIB0::INTFC"
+# How often the status byte is serial polled once the gate has closed
+STB_POLL_PERIOD = 0.0005  # s
 
 
 # %% HP Agilent Counter Class
@@ -15,6 +31,8 @@ class AgilentCounter:
         use_external_clock=False,
         gate_time=DEFAULT_GATE_TIME,
         name=None,
+        resource_manager=None,
+        idn_cache=None,
     ):
 
         # Shoulde be 'GPIB0::3::INSTR'
@@ -25,33 +43,32 @@ class AgilentCounter:
         else:
             print("Attempting to connect counter " + counter_id)
 
-        self.rm = visa.ResourceManager()
-        GPIB_list = self.rm.list_resources("GPIB?*INSTR")
+        # resource_manager can be a simulators.FakeResourceManager for testing
+        # without hardware. Only counters found through the system's own
+        # resource manager are remembered in the IDN cache on disk by
+        # default; with any other the cache is kept in memory.
+        if idn_cache is None:
+            idn_cache = discovery.IdnCache(
+                discovery.DEFAULT_IDN_CACHE_PATH if resource_manager is None else None
+            )
+        if resource_manager is None:
+            resource_manager = visa.ResourceManager()
+        self.rm = resource_manager
 
-        print(
-            "Found "
-            + str(len(GPIB_list))
-            + " GPIB device(s), searching for counter...\n"
-        )
+        if counter_id is None:
+            match = lambda idn: idn.lower().startswith(COUNTER_ID_PREFIX.lower())
+        else:
+            match = lambda idn: idn.lower() == counter_id.lower()
 
-        found_counter = False
-        for resource_name in GPIB_list:  # Likely will be 'GPIB0::3::INSTR'
-            try:
-                self.counter = self.rm.open_resource(resource_name)
-                devname = str(self.counter.query("*IDN?")).strip()
-                if counter_id is None:
-                    if devname.lower().startswith(COUNTER_ID_PREFIX.lower()):
-                        found_counter = True
-                        break
-                else:
-                    if devname.lower() == counter_id.lower():
-                        found_counter = True
-                        break
-                self.counter.before_close()
-                self.counter.close()
-            except Exception as e:
-                print("Failed to test device at " + resource_name)
-                print(e)
+        # A counter found before is checked first with a single *IDN?; only
+        # if it has gone is the whole bus scanned, all resources at once
+        print("Searching GPIB for counter...\n")
+        resource_name, devname = discovery.find_visa(
+            self.rm, match, "GPIB?*INSTR", idn_cache
+        )
+        found_counter = resource_name is not None
+        if found_counter:
+            self.counter = self.rm.open_resource(resource_name)
 
         if not found_counter:
             if counter_id is None:
@@ -65,6 +82,7 @@ class AgilentCounter:
         print("Found counter at " + resource_name)
 
         self.gate_time = gate_time
+        self.trigger_time = time.perf_counter()
 
         try:
             self.set_config_default()
@@ -163,6 +181,7 @@ class AgilentCounter:
         # transferred over the bus. Can use "READ?" command too.
 
         self.counter.write(":FUNC 'FREQ 2'")  # Select frequency mode and channel
+        self.channel = 2  # channel of the selected :FUNC
         self.counter.write(":INIT:CONT ON")  # Put counter in Run mode
 
     def set_apporx_freq(self, channels=[1, 2], approx_freqs=None):
@@ -225,19 +244,128 @@ class AgilentCounter:
         self.begin_freq_measure(2)
         return (f1, self.get_result())
 
-    def begin_freq_measure(self, channel=1):
-        if channel == 1:
-            self.counter.write(":FUNC 'FREQ 1'")
-            self.counter.assert_trigger()
-        elif channel == 2 or channel == -1:
-            self.counter.write(":FUNC 'FREQ 2'")
-            self.counter.assert_trigger()
-        else:
+    def select_channel(self, channel):
+        """
+        Selects frequency measurement on channel. Every :FUNC change makes
+        the counter re-arm, so nothing is sent if channel is already selected.
+        """
+        if channel == -1:
+            channel = 2
+        if channel not in (1, 2):
             raise UserWarning(str(channel) + " is not a valid channel number.")
+        if channel != self.channel:
+            self.counter.write(":FUNC 'FREQ " + str(channel) + "'")
+            self.channel = channel
+
+    def begin_freq_measure(self, channel=1):
+        self.select_channel(channel)
+        self.trigger()
+
+    def trigger(self):
+        self.counter.assert_trigger()
+        self.trigger_time = time.perf_counter()
+
+    def wait_for_result(self, timeout=None):
+        """
+        Returns as soon as the counter has a result ready (MAV set in the
+        status byte), so the read that follows does not sit on the bus for
+        the rest of the gate. Nothing can be ready before the gate closes, so
+        that long is slept through; after that the status byte is serial
+        polled every STB_POLL_PERIOD. Raises IOError if nothing is ready
+        timeout seconds (default: gate time + VISA timeout) after the trigger.
+        """
+        if timeout is None:
+            timeout = self.gate_time + self.counter.timeout / 1000
+        deadline = self.trigger_time + timeout
+
+        delay = self.trigger_time + self.gate_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        while not self.counter.read_stb() & STB_MAV:
+            if time.perf_counter() > deadline:
+                raise IOError("Timed out waiting for a result from " + self.name)
+            time.sleep(STB_POLL_PERIOD)
 
     def get_result(self):
         return float(self.counter.read())
 
+    def acquire_block(self, channel=1, n=100):
+        """
+        Takes n consecutive frequency measurements on channel and returns them
+        as a NumPy array.
+
+        The 53132A has no reading memory, so every reading still needs its own
+        trigger, but the function is only selected once for the whole block
+        and the results come back in REAL (64 bit binary) format: 8 bytes per
+        reading instead of ~20 ASCII characters, and no string parsing.
+        """
+        data = np.empty(int(n))
+        self.counter.write(":FORMAT REAL")
+        try:
+            self.begin_freq_measure(channel)
+            for i in range(len(data)):
+                if i:
+                    self.trigger()
+                self.wait_for_result()
+                data[i] = self.counter.read_binary_values(
+                    datatype="d", is_big_endian=True
+                )[0]
+        finally:
+            self.counter.write(":FORMAT ASCII")
+        return data
+
+    def acquire_statistics(self, channel=1, n=100, statistics=BLOCK_STATISTICS):
+        """
+        Uses the 53132A's statistics arming to take n measurements on channel
+        in a single run, with no bus traffic between them. Returns a dict of
+        the requested statistics (any of BLOCK_STATISTICS), each fetched in
+        REAL format once the run has finished.
+
+        Based on "To Compute Statistics"
+          Agilent 53131A/132A Programming Guide
+        """
+        if channel == -1:
+            channel = 2
+        if channel not in (1, 2):
+            raise UserWarning(str(channel) + " is not a valid channel number.")
+
+        timeout = self.counter.timeout
+        # The run takes n gate times before anything can be read back
+        self.counter.timeout = timeout + 1500 * n * self.gate_time
+
+        results = {}
+        try:
+            self.counter.write(":INIT:CONT OFF")
+            self.select_channel(channel)
+            self.counter.write(":CALC3:AVER:COUNT " + str(int(n)))
+            self.counter.write(":CALC3:AVER:STATE ON")
+            self.counter.write(":TRIG:COUNT:AUTO ON")
+            self.counter.write(":FORMAT REAL")
+            self.counter.write(":INIT")
+            self.counter.query("*OPC?")  # Wait for the run to finish
+            for statistic in statistics:
+                self.counter.write(":CALC3:AVER:TYPE " + statistic)
+                results[statistic] = self.counter.query_binary_values(
+                    ":CALC3:DATA?", datatype="d", is_big_endian=True
+                )[0]
+        finally:
+            # Back to the single-measurement setup of set_config_default
+            self.counter.write(":FORMAT ASCII")
+            self.counter.write(":TRIG:COUNT:AUTO OFF")
+            self.counter.write(":CALC3:AVER:STATE OFF")
+            self.counter.write(":INIT:CONT ON")
+            self.counter.timeout = timeout
+        return results
+
+    def acquire_channels(self, channels=(1, 2), batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Takes batch_size readings on each of channels in turn, switching
+        channel only once per batch. Returns a dict of channel -> NumPy array.
+        """
+        return dict(
+            (channel, self.acquire_block(channel, batch_size)) for channel in channels
+        )
+
     def close(self):
         self.counter.write("*RST")  # Reset the counter
         self.counter.write("*CLS")  # Clear event registers and error queue
@@ -253,6 +381,95 @@ class AgilentCounter:
         self.rm.close()
 
 
+# %% channel scheduling
+class ChannelScheduler:
+    """
+    Reads several channels of one AgilentCounter as a single stream, taking
+    batch_size consecutive readings on a channel before moving on to the
+    next. Switching channel costs a :FUNC write and a re-arm of the counter,
+    so larger batches give more readings per second in total at the cost of
+    a longer gap between the readings of each channel; batch_size can be
+    changed at any time.
+    """
+
+    def __init__(self, counter, channels=(1, 2), batch_size=DEFAULT_BATCH_SIZE):
+        self.counter = counter
+        self.channels = list(channels)
+        self.batch_size = batch_size
+        self.index = 0  # into self.channels
+        self.count = 0  # readings taken on the current channel
+
+    def read(self):
+        """Takes the next reading and returns (channel, frequency)"""
+        if self.count >= self.batch_size:
+            self.index = (self.index + 1) % len(self.channels)
+            self.count = 0
+        channel = self.channels[self.index]
+        self.counter.begin_freq_measure(channel)
+        self.counter.wait_for_result()
+        self.count += 1
+        return channel, self.counter.get_result()
+
+
+# %% synchronous triggering
+class CounterGroup:
+    """
+    Several AgilentCounters on one GPIB bus measured simultaneously: every
+    counter is set to its channel, a single Group Execute Trigger starts all
+    of their measurements at the same instant, and the results are collected
+    from all counters concurrently. One reading of the whole group takes one
+    gate time, and the readings are not skewed by bus latency.
+
+    If the GPIB interface cannot be opened, the counters are triggered one
+    after another instead.
+    """
+
+    def __init__(self, counters, interface=DEFAULT_GPIB_INTERFACE):
+        self.counters = list(counters)
+        try:
+            self.interface = self.counters[0].rm.open_resource(interface)
+        except Exception as e:
+            print("Could not open " + interface + ", triggering counters in turn")
+            print(e)
+            self.interface = None
+        self.pool = ThreadPoolExecutor(len(self.counters))
+
+    def arm(self, channels=1):
+        """Selects channels (one for all counters, or one per counter)"""
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels] * len(self.counters)
+        for counter, channel in zip(self.counters, channels):
+            counter.select_channel(channel)
+
+    def trigger(self):
+        if self.interface is None:
+            for counter in self.counters:
+                counter.trigger()
+            return
+        self.interface.group_execute_trigger(*[c.counter for c in self.counters])
+        trigger_time = time.perf_counter()
+        for counter in self.counters:
+            counter.trigger_time = trigger_time
+
+    def collect(self):
+        def result(counter):
+            counter.wait_for_result()
+            return counter.get_result()
+
+        return np.array(list(self.pool.map(result, self.counters)))
+
+    def read(self, channels=1):
+        """Returns one simultaneous reading of every counter as a NumPy array"""
+        self.arm(channels)
+        self.trigger()
+        return self.collect()
+
+    def close(self):
+        self.pool.shutdown()
+        if self.interface is not None:
+            self.interface.close()
+
+
 # %% run
 if __name__ == "__main__":
     c = AgilentCounter()
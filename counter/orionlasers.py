@@ -6,8 +6,14 @@ except NameError:  # python 3
     pass
 from six import iteritems
 
-import serial, sys, glob
+import serial, time
+import numpy as np
 from copy import deepcopy
+from contextlib import contextmanager
+try:  # imported as part of the counter package
+    from . import discovery
+except ImportError:  # run from inside counter/
+    import discovery
 
 # Modified 2018-09-24 rjw
 
@@ -174,25 +180,9 @@ def list_serial_ports():
     :returns:
         A list of the serial ports available on the system
     """
-    if sys.platform.startswith("win"):
-        ports = ["COM%s" % (i + 1) for i in range(256)]
-    elif sys.platform.startswith("linux") or sys.platform.startswith("cygwin"):
-        # this excludes your current terminal "/dev/tty"
-        ports = glob.glob("/dev/tty[A-Za-z]*")
-    elif sys.platform.startswith("darwin"):
-        ports = glob.glob("/dev/tty.*")
-    else:
-        raise EnvironmentError("Unsupported platform")
-
-    result = []
-    for port in ports:
-        try:
-            s = serial.Serial(port)
-            s.close()
-            result.append(port)
-        except (OSError, serial.SerialException):
-            pass
-    return result
+    # The ports the OS reports are all tried at once, as opening a port can
+    # block for a while
+    return discovery.available_ports()
 
 
 ###############################################################################
@@ -310,41 +300,192 @@ def pkt_interpret(byte_list):
     return val, status
 
 
-def find(sn=None):
-    result = []
-    for port in list_serial_ports():
-        try:
-            test_laser = OrionLaser(port)
-            print("Orion (%i) found on port %s" % (test_laser.sn, port))
-            if sn is None:
-                result.append(port)
-            else:
-                if test_laser.sn == sn:
-                    result.append(port)
-            test_laser.close()
-        except Exception as e:
-            print("No Orion on %s (%s)" % (port, e))
+###############################################################################
+######################### Buffered Packet Codec ###############################
+
+# Smallest possible packet (a reply with no data) and a generous upper bound
+MIN_PKT_LEN = 10
+MAX_PKT_LEN = 64
+
+# Packets of the commands that take no value never change (apart from PKT_ID),
+# so they are only built once
+FIXED_PACKETS = dict(
+    (cmd, bytes(pkt_gen(cmd)))
+    for cmd, cmd_type in iteritems(COMMAND_TYPES)
+    if cmd_type == TYPE_READ or cmd in (0x24, 0x25)
+)
+
+
+class PacketCodec:
+    """
+    Encodes packets for, and decodes packets from, an ORION laser.
+
+    Replies are read in bulk (everything waiting in the OS buffer) into
+    self.buffer. Every HDR byte in the buffer is a candidate packet start;
+    length, footer and checksum of all candidates are checked at once with
+    NumPy, and the valid, non-overlapping packets are taken out in order.
+    Garbage between packets is dropped.
+
+    Each packet sent gets its own PKT_ID, which the laser echoes, so several
+    commands can be outstanding at once: receive(pkt_id) returns the reply
+    to that packet and keeps any other replies for later.
+
+    Packets without a data field (reads, enable/disable RS232) come from
+    FIXED_PACKETS with only PKT_ID and the checksum patched.
+    """
+
+    def __init__(self, ser, timeout=1.0):
+        self.ser = ser
+        self.timeout = timeout  # s
+        self.buffer = bytearray()
+        self.replies = {}  # pkt_id -> reply packet
+        self.next_pkt_id = 0
+        self.discarded = 0  # bytes that were not part of a valid packet
+
+    def encode(self, cmd_id, val=None, pkt_id=PKT_ID_DEFAULT):
+        if val is not None or cmd_id not in FIXED_PACKETS:
+            return bytes(pkt_gen(cmd_id, val, pkt_id))
+        pkt = FIXED_PACKETS[cmd_id]
+        if pkt_id == PKT_ID_DEFAULT:
+            return pkt
+        # PKT_ID_DEFAULT is 0, so the checksum only changes by -pkt_id
+        pkt = bytearray(pkt)
+        pkt[1] = pkt_id
+        pkt[-2] = (pkt[-2] - twos_complement_byte(pkt_id)) & 0xFF
+        return bytes(pkt)
+
+    def allocate_pkt_id(self):
+        pkt_id = self.next_pkt_id
+        self.next_pkt_id = (pkt_id + 1) & 0xFF
+        return pkt_id
+
+    def send(self, cmds):
+        """
+        Writes every (cmd_id, val) in cmds in one write() and returns the
+        PKT_IDs they were sent with
+        """
+        pkt_ids = [self.allocate_pkt_id() for cmd in cmds]
+        pkts = [self.encode(cmd, val, i) for (cmd, val), i in zip(cmds, pkt_ids)]
+        for pkt_id in pkt_ids:
+            self.replies.pop(pkt_id, None)
+        self.ser.write(b"".join(pkts))
+        return pkt_ids, pkts
+
+    def extract(self):
+        """Moves every complete, valid packet in self.buffer into self.replies"""
+        buf = np.frombuffer(bytes(self.buffer), dtype=np.uint8)
+        size = len(buf)
+        starts = np.flatnonzero(buf == HDR)
+
+        # LEN of each candidate (unknown yet if it has not arrived) and the
+        # index of its footer
+        lengths = np.full(len(starts), MAX_PKT_LEN, dtype=int)
+        has_len = starts + 2 < size
+        lengths[has_len] = buf[starts[has_len] + 2]
+        ends = starts + lengths + 1
+        complete = ends < size
+        plausible = (lengths >= MIN_PKT_LEN - 2) & (lengths <= MAX_PKT_LEN)
+
+        valid = complete & plausible
+        valid[valid] = buf[ends[valid]] == FTR
+        # Checksum: minus the sum of the signed bytes before the checksum
+        prefix = np.concatenate([[0], np.cumsum(buf.astype(np.int8), dtype=int)])
+        ends_v, starts_v = ends[valid], starts[valid]
+        chksum = -(prefix[ends_v - 1] - prefix[starts_v]) & 0xFF
+        valid[valid] = chksum == buf[ends_v - 1]
+
+        used = 0
+        for start, end in zip(starts[valid], ends[valid]):
+            if start < used:
+                continue
+            self.discarded += start - used
+            pkt = bytearray(buf[start : end + 1])
+            self.replies[pkt[1]] = pkt
+            used = end + 1
+
+        # Everything after the last packet is garbage except a packet that
+        # is still arriving
+        waiting = starts[(starts >= used) & ~complete & plausible]
+        keep_from = waiting[0] if len(waiting) else size
+        self.discarded += keep_from - used
+        del self.buffer[:keep_from]
+
+    def poll(self, block=True):
+        size = self.ser.in_waiting
+        if not size:
+            if not block:
+                return
+            size = 1
+        data = self.ser.read(size)
+        if data:
+            self.buffer += data
+            self.extract()
+        return len(data)
+
+    def receive(self, pkt_id):
+        """Returns the reply to pkt_id, waiting up to self.timeout for it"""
+        deadline = time.time() + self.timeout
+        while pkt_id not in self.replies:
+            if not self.poll() and time.time() > deadline:
+                raise IOError("No reply from laser to packet %i" % pkt_id)
+        return self.replies.pop(pkt_id)
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.replies = {}
+
+
+def find(sn=None, use_registry=True):
+    """
+    Returns the ports of ORION lasers (with serial number sn). Every port is
+    probed in parallel, unless a laser remembered in the device registry
+    from an earlier search is still there (see discovery.find_devices).
+    """
+    if use_registry:
+        result = discovery.find_devices(discovery.ORION, sn)
+    else:
+        result = [
+            device["port"]
+            for device in discovery.discover()
+            if device["type"] == discovery.ORION and sn in (None, device["sn"])
+        ]
+    for port in result:
+        print("Orion found on port %s" % port)
     return result
 
 
 ###############################################################################
 ############################ Orion Laser Class ################################
 
+# Whether OrionLaser writes several packets before reading any reply (see
+# OrionLaser.execute_cmds). This has only been tried against the simulated
+# laser in simulators.py, not a real ORION, so it is off by default.
+PIPELINE_COMMANDS = False
+
 
 class OrionLaser:
-    def __init__(self, port, name=None, verbose=False):
+    def __init__(
+        self, port, name=None, verbose=False, ser=None, pipelined=PIPELINE_COMMANDS
+    ):
         self.verbose = verbose
-        self.ser = serial.Serial(
-            port.strip(),
-            baudrate=9600,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            bytesize=serial.EIGHTBITS,
-            xonxoff=False,
-            timeout=0.1,
-        )
+        self.pipelined = pipelined
+        if ser is None:
+            ser = serial.Serial(
+                port.strip(),
+                baudrate=9600,
+                parity=serial.PARITY_NONE,
+                stopbits=serial.STOPBITS_ONE,
+                bytesize=serial.EIGHTBITS,
+                xonxoff=False,
+                timeout=0.1,
+            )
+        # ser can be a simulators.FakeOrionSerial for testing without hardware
+        self.ser = ser
+        self.codec = PacketCodec(self.ser, timeout=0.5)
         self.port = self.ser.portstr
         self.limits = deepcopy(LIMITS_DEFAULT)
+        # While a session is active RS232 control stays enabled between calls
+        self.session_active = False
 
         try:
             self.execute_cmd(0x24, None)  # Enable RS232
@@ -371,6 +512,11 @@ class OrionLaser:
             self.sn = self.execute_cmd(0x08, None)  # Read device serial number
             self.pn = num2str(self.execute_cmd(0x42, None)).strip()  # Read product ID
 
+            # Last known volatile setpoints, kept up to date from the laser's
+            # replies so relative changes do not need a read first
+            self.i_set = self.i_0
+            self.t_set = self.t_0
+
             self.execute_cmd(0x25, None)  # Disable RS232
 
         except Exception as e:
@@ -391,7 +537,7 @@ class OrionLaser:
 
         print(self.name + " was connected successfully.")
 
-    def execute_cmd(self, cmd, val):
+    def check_limits(self, cmd, val):
         try:
             lim = self.limits[cmd]
             if val < lim[0] or val > lim[1]:
@@ -401,9 +547,8 @@ class OrionLaser:
                 )
         except KeyError:
             pass
-        pkt_send = pkt_gen(cmd, val)
-        self.ser.write(pkt_send)
-        resp = pkt_read(self.ser)
+
+    def check_response(self, cmd, val, pkt_send, resp):
         if self.verbose:
             print(COMMAND_NAMES[cmd])
             print(list(pkt_send))
@@ -420,51 +565,121 @@ class OrionLaser:
             )
         return return_value
 
+    def execute_cmd(self, cmd, val):
+        return self.execute_cmds([(cmd, val)])[0]
+
+    def execute_cmds(self, cmds):
+        """
+        Runs several commands (cmd, val) and returns the list of return
+        values. Each packet has its own PKT_ID and its reply is matched to it
+        by PKT_ID.
+
+        With self.pipelined every packet is written in one go and only then
+        are the replies read back, which costs one round trip instead of one
+        per command. Whether the laser accepts a packet before it has
+        answered the last one (in particular the RS232 enable 0x24 and
+        disable 0x25 around a command, see execute_with_serial) has not been
+        verified on hardware, so by default each packet is written and its
+        reply read before the next.
+        """
+        for cmd, val in cmds:
+            self.check_limits(cmd, val)
+        if self.pipelined:
+            pkt_ids, pkts = self.codec.send(cmds)
+            sent = zip(cmds, pkt_ids, pkts)
+        else:
+            sent = self.send_in_turn(cmds)
+
+        results = []
+        for (cmd, val), pkt_id, pkt_send in sent:
+            resp = self.codec.receive(pkt_id)
+            results.append(self.check_response(cmd, val, pkt_send, resp))
+        return results
+
+    def send_in_turn(self, cmds):
+        # Yields each command as it is sent; the caller reads its reply
+        # before the next one is written
+        for cmd_val in cmds:
+            (pkt_id,), (pkt,) = self.codec.send([cmd_val])
+            yield cmd_val, pkt_id, pkt
+
+    def execute_with_serial(self, cmds):
+        """
+        Runs cmds with RS232 control enabled. Outside a session the enable and
+        disable commands are sent with cmds (pipelined with them if
+        self.pipelined). Returns the return values of cmds only.
+        """
+        if self.session_active:
+            return self.execute_cmds(cmds)
+        return self.execute_cmds([(0x24, None)] + cmds + [(0x25, None)])[1:-1]
+
+    def begin_session(self):
+        """
+        Enables RS232 control until end_session(), so a feedback loop does not
+        pay for enabling and disabling it around every step
+        """
+        if not self.session_active:
+            self.execute_cmd(0x24, None)  # Enable RS232
+            self.session_active = True
+
+    def end_session(self):
+        if self.session_active:
+            self.session_active = False
+            self.execute_cmd(0x25, None)  # Disable RS232
+
+    @contextmanager
+    def session(self):
+        already_active = self.session_active
+        self.begin_session()
+        try:
+            yield self
+        finally:
+            if not already_active:
+                self.end_session()
+
+    def refresh_setpoints(self):
+        """Reads the volatile setpoints back in case they were changed elsewhere"""
+        self.i_set, self.t_set = self.execute_with_serial([(0x1D, None), (0x1F, None)])
+        return self.i_set, self.t_set
+
     def get_t(self):
-        self.execute_cmd(0x24, None)  # Enable RS232
-        temp = self.execute_cmd(0x1F, None)  # Read vol temp
-        self.execute_cmd(0x25, None)  # Disable RS232
-        return temp
+        (self.t_set,) = self.execute_with_serial([(0x1F, None)])  # Read vol temp
+        return self.t_set
 
     def set_to_default(self, reset_to_factory=False):
-        self.execute_cmd(0x24, None)  # Enable RS232
+        cmds = []
         if reset_to_factory:
-            self.execute_cmd(0x27, self.i_factory)  # Set invol current
-            self.execute_cmd(0x29, self.t_factory)  # Set invol temp
+            cmds.append((0x27, self.i_factory))  # Set invol current
+            cmds.append((0x29, self.t_factory))  # Set invol temp
             self.i_invol = self.i_factory
             self.t_invol = self.t_factory
-        self.execute_cmd(0x1E, self.i_invol)  # Set vol current
-        self.execute_cmd(0x20, self.t_invol)  # Set vol temp
-        self.execute_cmd(0x25, None)  # Disable RS232
+        cmds.append((0x1E, self.i_invol))  # Set vol current
+        cmds.append((0x20, self.t_invol))  # Set vol temp
+        self.i_set, self.t_set = self.execute_with_serial(cmds)[-2:]
 
     def set_t(self, temp):
-        self.execute_cmd(0x24, None)  # Enable RS232
-        self.execute_cmd(0x20, temp)  # Set vol temp
-        self.execute_cmd(0x25, None)  # Disable RS232
+        (reported,) = self.execute_with_serial([(0x20, temp)])  # Set vol temp
+        if reported is not None:
+            self.t_set = reported
 
     def set_i(self, i):
-        self.execute_cmd(0x24, None)  # Enable RS232
-        self.execute_cmd(0x1E, i)  # Set vol current
-        self.execute_cmd(0x25, None)  # Disable RS232
+        (reported,) = self.execute_with_serial([(0x1E, i)])  # Set vol current
+        if reported is not None:
+            self.i_set = reported
 
     def change_t(self, dTemp):
-        self.execute_cmd(0x24, None)  # Enable RS232
-        temp = self.execute_cmd(0x1F, None)  # Read vol temp
-        new_temp = temp + dTemp
-        self.execute_cmd(0x20, new_temp)  # Set vol temp
-        self.execute_cmd(0x25, None)  # Disable RS232
+        new_temp = self.t_set + dTemp
+        self.set_t(new_temp)
         return new_temp
 
     def change_i(self, dI):
-        self.execute_cmd(0x24, None)  # Enable RS232
-        i = self.execute_cmd(0x1D, None)  # Read vol current
-        new_i = i + dI
-        self.execute_cmd(0x1E, new_i)  # Set vol current
-        self.execute_cmd(0x25, None)  # Disable RS232
+        new_i = self.i_set + dI
+        self.set_i(new_i)
         return new_i
 
     def close(self):
         print("\nClosing " + self.name)
+        self.session_active = False
         try:
             self.execute_cmd(0x25, None)  # Disable RS232
         except Exception:
@@ -0,0 +1,361 @@
+# %% package imports
+import os
+import time
+import datetime
+import logging
+import functools
+import hpcounters
+import acquisition
+import calibration
+import freqlogs
+import queries
+import sharedring
+import simulators
+import stats
+import telemetry
+from serialcounters import Counter
+import AsyncSocketComms
+
+# %% global variables
+# channels for Agilent and chinese counter
+channel_hpc = 1
+channel_chin = 2
+
+# Datetime format used in logfile names, logging events, etc
+TIMEFMT = "%Y-%m-%d_%H%M%S"
+
+# [min,max] frequencies that are allowed to be entered as targets
+ACCEPTABLE_FREQ_RANGE = (199e6, 201e6)  # Hz
+
+# Correction of the serial counter, measured with new_counter.py; see
+# calibration.py to keep it fitted while running
+OFFSET_AGILENT_CHIN = 8.646939525961876  # Hz
+
+
+# %% function defs
+def make_logger(log_dir, name="counter", timefmt=TIMEFMT):
+    """The event log: to the console and a new file in log_dir"""
+    fh = logging.FileHandler(
+        os.path.join(
+            log_dir, "%s_counterlog.log" % datetime.datetime.now().strftime(timefmt)
+        ),
+        "w",
+    )
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s  %(message)s", timefmt)
+    fh.setFormatter(formatter)
+    sh.setFormatter(formatter)
+
+    log = logging.getLogger(name)
+    log.setLevel(logging.DEBUG)
+    log.handlers = [fh, sh]
+    return log
+
+
+# %% counter pipeline
+class CounterPipeline:
+    """
+    The measurement path of the counter, with no GUI, shared by
+    CounterWidget and CounterDaemon:
+
+    Each instrument is read by its own acquisition thread, which pushes
+    timestamped readings into a ring buffer as soon as the counter has them
+    (status byte MAV for the Agilent, bytes waiting on the serial port for
+    the other). The buffers are in shared memory when possible, so other
+    processes can read the stream with sharedring.SharedRing.attach(name).
+
+    Every reading is also published once on self.bus under self.topics.
+    Each channel's readings are screened for outliers (see
+    stats.HampelFilter) on a thread of their own, which logs them all and
+    republishes the good ones under self.clean_topics; feedback should only
+    use those. The screening thread must see every reading, so it may hold
+    up publishing.
+
+    targets is the list of target frequencies logged with the readings; it
+    is shared with the owner, not copied. self.flags[index] holds the
+    freqlogs.FEEDBACK_* bits logged with channel index.
+
+    With calibrate, the HP counter alternates between its two channels, so
+    channel 1 readings come in bursts of calibration_batch_size with gaps
+    about as long in between. Their spacing is then uneven: ADEV is not
+    available for the channels in self.uneven_channels, and the outlier
+    window of channel 1 spans about twice as long as without calibrate.
+
+    With sim, the drivers talk to the simulated instruments of simulators.py
+    (made with simulators.make_counters(**sim_options)).
+    """
+
+    def __init__(
+        self,
+        log,
+        log_dir,
+        targets,
+        sim=False,
+        sim_options=None,
+        chin_port_name="COM18",
+        gate_time=0.1,
+        ring_prefix="counter",
+        calibrate=False,
+        calibration_batch_size=hpcounters.DEFAULT_BATCH_SIZE,
+        telemetry_port=None,
+        query_port=None,
+    ):
+        self.channels = [1, 2]
+        num = len(self.channels)
+        self.log = log
+        self.log_dir = log_dir
+        self.targets = targets
+
+        # How often to log frequencies
+        self.freq_log_period = 0.1  # s
+        # Frequency logs are binary (see freqlogs.py, load them back with
+        # freqlogs.load_log). Queued records are written out every
+        # log_flush_period and fsynced every log_fsync_period.
+        self.log_flush_period = 1  # s
+        self.log_fsync_period = 10  # s
+        self.log_files = [None] * num
+        self.last_log_time = [0] * num
+        self.log_start_times = [0] * num
+        self.flags = [0] * num
+
+        # Readings more than outlier_threshold MADs from the median of the
+        # outlier_window readings before them are not fed back, and are
+        # flagged REJECTED in the frequency log. The MAD is taken to be at
+        # least outlier_min_spread.
+        self.outlier_filters = [
+            stats.HampelFilter(window=31, threshold=5.0, min_spread=1.0)
+            for index in range(num)
+        ]
+
+        if sim:
+            options = dict(noise=10)
+            options.update(sim_options or {})
+            resource_manager, chin_port, self.sim_signals = simulators.make_counters(
+                **options
+            )
+            chin_port_name = simulators.SIM_COUNTER_PORT
+        else:
+            resource_manager = chin_port = None
+
+        # Load Agilent counter
+        self.counter = hpcounters.AgilentCounter(
+            None, False, gate_time, resource_manager=resource_manager
+        )
+        self.counter.set_clock_external(True)
+        self.counter.set_apporx_freq([1, 2], 199868311)
+        self.gateTime = self.counter.get_gate_time()
+
+        # Load the Chinese counter from eBay
+        self.chin_counter = Counter(chin_port_name, ser=chin_port)
+        self.chin_counter.select_high_freq_channel()
+        self.chin_counter.readonce(100)
+        self.chin_counter.open()
+        self.offset_agilent_chin = OFFSET_AGILENT_CHIN
+
+        self.bus = telemetry.TelemetryBus()
+        self.topics = ["chan%i" % ch for ch in self.channels]
+        self.clean_topics = [topic + "_clean" for topic in self.topics]
+
+        # With calibrate, offset_agilent_chin is kept fitted while running
+        # (see calibration.py). The HP counter then also measures the channel
+        # 2 signal on its own channel 2, wired as for new_counter.py,
+        # alternating in batches of calibration_batch_size readings
+        self.calibration = None
+        self.uneven_channels = set()
+        if calibrate:
+            self.hp_scheduler = hpcounters.ChannelScheduler(
+                self.counter, (channel_hpc, channel_chin), calibration_batch_size
+            )
+            self.calibration = calibration.CounterCalibration(
+                self.bus, self.offset_agilent_chin, self.gateTime, log=self.log
+            )
+            self.calibration.start()
+            self.uneven_channels.add(channel_hpc)
+
+        self.ring_names = [
+            "%s_chan%i" % (ring_prefix, channel) for channel in self.channels
+        ]
+        self.workers = [
+            acquisition.AcquisitionWorker(
+                functools.partial(self.read_channel, index),
+                buffer=self.make_buffer(self.ring_names[index]),
+                name="channel %i acquisition" % channel,
+                bus=self.bus,
+                topic=self.topics[index],
+            )
+            for index, channel in enumerate(self.channels)
+        ]
+        self.screeners = [
+            self.bus.consume(
+                topic,
+                functools.partial(self.screen_readings, index),
+                name="%s screening" % topic,
+                policy=telemetry.BLOCK,
+            )
+            for index, topic in enumerate(self.topics)
+        ]
+
+        # telemetry_port streams every reading to other processes as lines
+        # of text (see telemetry.SocketBridge)
+        self.telemetry_bridge = None
+        if telemetry_port is not None:
+            self.telemetry_bridge = telemetry.SocketBridge(
+                self.bus,
+                self.topics,
+                AsyncSocketComms.AsyncSocketServer(telemetry_port),
+            )
+        # Queries about the readings (latest, last n, statistics, ADEV) are
+        # answered from the ring buffers, on query_port if given
+        self.queries = queries.QueryHandler(
+            dict(
+                (channel, worker.buffer)
+                for channel, worker in zip(self.channels, self.workers)
+            ),
+            query_port,
+            self.uneven_channels,
+        )
+
+    def make_buffer(self, name):
+        try:
+            return sharedring.SharedRing.create(name, acquisition.DEFAULT_BUFFER_SIZE)
+        except Exception as e:
+            self.log.warning(
+                "No shared memory ring %s (%s); using a local one" % (name, e)
+            )
+            return acquisition.RingBuffer()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def read_channel(self, index):
+        # Reads one measurement as soon as it is ready; runs on the acquisition
+        # thread of channel index
+        if self.channels[index] == 1:
+            if self.calibration is None:
+                # The Agilent only takes data on one of its channels now
+                self.counter.begin_freq_measure(channel_hpc)
+                self.counter.wait_for_result()
+                return self.counter.get_result()
+            # Channel 2 readings of the Agilent only go to the calibration
+            while True:
+                channel, freq = self.hp_scheduler.read()
+                if channel == channel_hpc:
+                    return freq
+                self.bus.publish(
+                    calibration.REFERENCE_TOPIC, time.perf_counter(), freq
+                )
+        elif self.channels[index] == 2:
+            raw = 1010e6 - self.chin_counter.read_and_return_float()
+            if self.calibration is None:
+                return raw + self.offset_agilent_chin
+            self.bus.publish(calibration.RAW_TOPIC, time.perf_counter(), raw)
+            return self.calibration.apply(raw)
+        else:
+            raise ValueError("self.channels[index] should be either 1 or 2")
+
+    def pause(self, index):
+        self.workers[index].pause()
+
+    def resume(self, index):
+        """Resumes a paused channel; returns False if it was not paused"""
+        if not self.workers[index].is_paused():
+            return False
+        self.outlier_filters[index].reset()
+        self.screeners[index].error = None
+        self.workers[index].resume()
+        return True
+
+    def set_flag(self, index, flag, on):
+        if on:
+            self.flags[index] |= flag
+        else:
+            self.flags[index] &= ~flag
+
+    # %% screening and logging
+    def screen_readings(self, index, times, freqs):
+        # Runs on the channel's screening thread
+        good = self.outlier_filters[index].update(freqs)
+        self.bus.publish(self.clean_topics[index], times[good], freqs[good])
+        self.log_readings(index, times, freqs, ~good)
+
+    def log_readings(self, index, times, freqs, rejected):
+        writer = self.log_files[index]
+        if writer is None:
+            return
+        flags = self.flags[index]
+        for sampleTime, freq, bad in zip(times, freqs, rejected):
+            if bad:
+                # Outliers are always logged, outside the logging period
+                writer.append(
+                    sampleTime - self.log_start_times[index],
+                    self.channels[index],
+                    freq,
+                    self.targets[index],
+                    flags | freqlogs.REJECTED,
+                )
+            elif sampleTime - self.last_log_time[index] > self.freq_log_period:
+                # Time to log another point...
+                writer.append(
+                    sampleTime - self.log_start_times[index],
+                    self.channels[index],
+                    freq,
+                    self.targets[index],
+                    flags,
+                )
+                # If it has been too long since last log, set current time
+                # to last log Otherwise just add log period to last log
+                # time to keep interval constant
+                if sampleTime - self.last_log_time[index] < self.freq_log_period * 2:
+                    self.last_log_time[index] += self.freq_log_period
+                else:
+                    self.last_log_time[index] = sampleTime
+
+    def start_logging(self, index, on_write=None):
+        """Starts a new frequency log of channel index; returns its path"""
+        self.stop_logging(index)
+        channel = self.channels[index]
+        startDateTime = datetime.datetime.now().strftime(TIMEFMT)
+        path = os.path.join(
+            self.log_dir,
+            "%s_chan%i%s" % (startDateTime, channel, freqlogs.FILE_EXTENSION),
+        )
+        self.log_start_times[index] = time.perf_counter()
+        self.last_log_time[index] = -9999
+        self.log_files[index] = freqlogs.BinaryLogWriter(
+            path, self.log_flush_period, self.log_fsync_period, on_write
+        )
+        self.log.warning("Channel %i logging started" % channel)
+        return path
+
+    def stop_logging(self, index):
+        writer = self.log_files[index]
+        if writer is None:
+            return
+        self.log_files[index] = None
+        writer.close()
+        self.log.warning("Channel %i logging stopped" % self.channels[index])
+
+    def is_logging(self, index):
+        return self.log_files[index] is not None
+
+    def close(self):
+        for index in range(len(self.channels)):
+            self.stop_logging(index)
+        self.queries.close()
+        if self.telemetry_bridge is not None:
+            self.telemetry_bridge.close()
+
+        # Stop acquisition before the instruments are closed underneath it
+        for worker in self.workers:
+            worker.stop(2 * self.gateTime + 1)
+            if isinstance(worker.buffer, sharedring.SharedRing):
+                worker.buffer.close()
+        if self.calibration is not None:
+            self.calibration.stop(1)
+        for screener in self.screeners:
+            screener.stop(1)
+
+        # close the com port to the chinese counter
+        self.chin_counter.close()
+        self.counter.close()
@@ -0,0 +1,130 @@
+# %% package imports
+import json
+import time
+import numpy as np
+import allan
+import stats
+import AsyncSocketComms
+
+# %% global variables
+# Most samples a LAST query returns
+MAX_SAMPLES = 10000
+
+
+# %% function defs
+def recent(buffer, seconds):
+    """
+    Returns (times, values) of the readings in buffer (an
+    acquisition.RingBuffer or sharedring.SharedRing) from the last seconds
+    before the newest one. Only about as much as the window holds is copied
+    out of the buffer, however large it is.
+    """
+    n = 64
+    while True:
+        times, values = buffer.latest(n)
+        if n >= len(buffer) or not len(times) or times[0] <= times[-1] - seconds:
+            break
+        n *= 4
+    start = np.searchsorted(times, times[-1] - seconds) if len(times) else 0
+    return times[start:], values[start:]
+
+
+# %% query handler
+class QueryHandler:
+    """
+    Answers queries about the readings of each channel straight from its
+    ring buffer, with no file I/O and without holding up acquisition:
+
+        CHANNELS                    channels that can be queried
+        LATEST <ch>                 newest reading, and its age (s)
+        LAST <ch> <n>               last n readings (at most MAX_SAMPLES)
+        STATS <ch> <seconds>        statistics of the last seconds of readings
+        ADEV <ch> [<seconds>]       overlapping Allan deviation of the last
+                                    seconds of readings (default everything)
+
+    Replies are JSON, {"error": "<message>"} on failure. Timestamps are
+    time.perf_counter() values, as in the buffers.
+
+    buffers is a dict of channel -> buffer. ADEV is refused for the channels
+    in uneven_channels, whose readings are not evenly spaced in time. Give
+    port to serve the queries
+    on an AsyncSocketComms.AsyncSocketServer of their own; otherwise add
+    self.commands to an existing request handler.
+    """
+
+    def __init__(self, buffers, port=None, uneven_channels=()):
+        self.buffers = buffers
+        self.uneven_channels = uneven_channels
+        self.commands = {
+            "CHANNELS": self.channels,
+            "LATEST": self.latest,
+            "LAST": self.last,
+            "STATS": self.stats,
+            "ADEV": self.adev,
+        }
+        self.server = None
+        if port is not None:
+            self.server = AsyncSocketComms.AsyncSocketServer(
+                port, request_handler=self.handle_request
+            )
+
+    def handle_request(self, text):
+        words = text.split()
+        try:
+            if not words:
+                raise ValueError("Empty request")
+            command = self.commands.get(words[0].upper())
+            if command is None:
+                raise ValueError("Unknown command " + words[0])
+            result = command(*words[1:])
+        except Exception as e:
+            result = dict(error="%s: %s" % (type(e).__name__, e))
+        return json.dumps(result)
+
+    def buffer(self, channel):
+        try:
+            return self.buffers[int(channel)]
+        except (KeyError, ValueError):
+            raise ValueError("No channel %s" % channel)
+
+    def channels(self):
+        return sorted(self.buffers)
+
+    def latest(self, channel):
+        times, values = self.buffer(channel).latest(1)
+        if not len(times):
+            return dict(channel=int(channel), time=None, freq=None, age=None)
+        return dict(
+            channel=int(channel),
+            time=times[-1],
+            freq=values[-1],
+            age=time.perf_counter() - times[-1],
+        )
+
+    def last(self, channel, n):
+        n = min(int(n), MAX_SAMPLES)
+        times, values = self.buffer(channel).latest(n)
+        return dict(channel=int(channel), times=times.tolist(), freqs=values.tolist())
+
+    def stats(self, channel, seconds):
+        times, values = recent(self.buffer(channel), float(seconds))
+        result = stats.window_stats(values)
+        result["span"] = times[-1] - times[0] if len(times) else 0.0
+        result["channel"] = int(channel)
+        return result
+
+    def adev(self, channel, seconds=None):
+        buffer = self.buffer(channel)
+        if int(channel) in self.uneven_channels:
+            raise ValueError("Readings of channel %s are unevenly spaced" % channel)
+        if seconds is None:
+            times, values = buffer.latest(len(buffer))
+        else:
+            times, values = recent(buffer, float(seconds))
+        tau0 = (times[-1] - times[0]) / (len(times) - 1) if len(times) > 1 else 1.0
+        taus, adevs = allan.overlapping_adev(values, tau0)
+        return dict(channel=int(channel), taus=taus.tolist(), adevs=adevs.tolist())
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
@@ -1,8 +1,9 @@
 # From http://stackoverflow.com/questions/12090503/listing-available-com-ports-with-python
 
-import sys
-import glob
-import serial
+try:  # imported as part of the counter package
+    from . import discovery
+except ImportError:  # run from inside counter/
+    import discovery
 
 
 def serial_ports():
@@ -14,29 +15,12 @@ def serial_ports():
         :returns:
             A list of the serial ports available on the system
     """
-    if sys.platform.startswith("win"):
-        ports = ["COM%s" % (i + 1) for i in range(256)]
-    elif sys.platform.startswith("linux") or sys.platform.startswith("cygwin"):
-        # this excludes your current terminal "/dev/tty"
-        ports = glob.glob("/dev/tty[A-Za-z]*")
-    elif sys.platform.startswith("darwin"):
-        ports = glob.glob("/dev/tty.*")
-    else:
-        raise EnvironmentError("Unsupported platform")
-
-    result = []
-    for port in ports:
-        try:
-            s = serial.Serial(port)
-            s.close()
-            result.append(port)
-        except (OSError, serial.SerialException):
-            pass
-    return result
+    # Ports come from the OS's port list rather than trying COM1-COM256, and
+    # are opened concurrently
+    return discovery.available_ports()
 
 
 if __name__ == "__main__":
     print(serial_ports())
-    a = serial_ports()
-    for port in a:
-        print(port)
+    for device in discovery.discover():
+        print(device)
@@ -0,0 +1,271 @@
+# %% package imports
+import collections
+import threading
+import time
+import numpy as np
+import serial
+
+# %% global variables
+# Every reading from the counter looks like b"F-CH2:199868311.123\r\n"
+FRAME_HEADER = b"F-CH"
+FRAME_END = b"\r"
+# Anything longer than this between a header and FRAME_END is garbage
+MAX_FRAME_LENGTH = 64
+# Read timeout (s); the counter sends a frame at least once a second
+DEFAULT_TIMEOUT = 2
+
+
+# %% frame decoder
+class FrameDecoder:
+    """
+    Incremental decoder for the serial counter's output stream.
+
+    feed() takes whatever bytes are available, however they happen to be
+    split up, and returns every complete reading as a list of (channel,
+    frequency) tuples. Partial frames are kept for the next call. A corrupt
+    or misaligned frame only costs that one reading: the decoder resyncs on
+    the next FRAME_HEADER and counts the failure in self.errors.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.errors = 0
+
+    def feed(self, data):
+        self.buffer += data
+        readings = []
+        start = 0
+        while True:
+            i = self.buffer.find(FRAME_HEADER, start)
+            if i < 0:
+                # keep a trailing partial header
+                start = max(start, len(self.buffer) - len(FRAME_HEADER) + 1)
+                break
+            j = self.buffer.find(FRAME_END, i)
+            if j < 0:
+                if len(self.buffer) - i > MAX_FRAME_LENGTH:
+                    self.errors += 1
+                    start = i + 1
+                    continue
+                start = i
+                break
+
+            # A second header before the end means the first frame was cut
+            resync = self.buffer.find(FRAME_HEADER, i + 1, j)
+            if resync >= 0:
+                self.errors += 1
+                start = resync
+                continue
+
+            frame = self.buffer[i + len(FRAME_HEADER) : j]
+            start = j + 1
+            try:
+                if frame[1:2] != b":":
+                    raise ValueError("bad channel tag %s" % bytes(frame))
+                readings.append((int(frame[:1]), float(frame[2:])))
+            except ValueError:
+                self.errors += 1
+
+        del self.buffer[:start]
+        return readings
+
+    def reset(self):
+        self.buffer.clear()
+
+
+# %% serial session
+class SerialSession:
+    """
+    Keeps a serial port open across commands instead of opening and closing
+    it for every call, which costs tens of ms on USB-serial adapters.
+
+    Every transaction goes through call(), which opens the port if needed
+    and, if the port fails (e.g. the adapter was unplugged), closes it and
+    retries with exponential backoff before giving up. on_reconnect is
+    called after each reopen so the owner can drop any partial state.
+    Transactions are serialized with a lock, so one session can be shared
+    between threads. Can be used as a context manager.
+    """
+
+    def __init__(
+        self, ser, max_retries=5, backoff=0.05, max_backoff=2.0, on_reconnect=None
+    ):
+        self.ser = ser
+        self.max_retries = max_retries
+        self.backoff = backoff  # s
+        self.max_backoff = max_backoff  # s
+        self.on_reconnect = on_reconnect
+        self.reconnects = 0
+        self.lock = threading.RLock()
+
+    @property
+    def is_open(self):
+        return self.ser.is_open
+
+    def open(self):
+        with self.lock:
+            if not self.ser.is_open:
+                self.ser.open()
+
+    def close(self):
+        with self.lock:
+            if self.ser.is_open:
+                self.ser.close()
+
+    def call(self, func, *args):
+        with self.lock:
+            delay = self.backoff
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if not self.ser.is_open:
+                        self.ser.open()
+                        if attempt:
+                            self.reconnects += 1
+                            if self.on_reconnect is not None:
+                                self.on_reconnect()
+                    return func(*args)
+                except (serial.SerialException, OSError) as e:
+                    error = e
+                    try:
+                        self.ser.close()
+                    except Exception:
+                        pass
+                    time.sleep(delay)
+                    delay = min(2 * delay, self.max_backoff)
+            raise error
+
+    def write(self, data):
+        return self.call(self.ser.write, data)
+
+    def read(self, size=1):
+        return self.call(self.ser.read, size)
+
+    def in_waiting(self):
+        return self.call(lambda: self.ser.in_waiting)
+
+    def reset_input_buffer(self):
+        return self.call(self.ser.reset_input_buffer)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# %% chinese counter
+class Counter:
+    """
+    This is the Chinese counter
+    """
+
+    def __init__(self, COM, ser=None):
+        # initialize the Serial instance (ser can be a simulators.FakeSerial
+        # for testing without hardware)
+        self.ser = serial.Serial() if ser is None else ser
+
+        # set the serial's communication port
+        self.COM = COM
+
+        # the baudrate should already be 9600, but just so you know
+        self.ser.baudrate = 9600
+        self.ser.timeout = DEFAULT_TIMEOUT
+
+        # decoded readings that have not been returned yet, per channel
+        self.decoder = FrameDecoder()
+        self.pending = {1: collections.deque(), 2: collections.deque()}
+
+        # the port is opened once and then reused by every command
+        self.session = SerialSession(self.ser, on_reconnect=self.clear_pending)
+
+    @property
+    def COM(self):
+        return self.ser.port
+
+    @COM.setter
+    def COM(self, port):
+        assert type(port) == str, f"the port must be a string, but got: {port}"
+        assert port[:3] == "COM", f"the port must start with 'COM' but got {port}"
+
+        self.ser.port = port
+
+    def select_high_freq_channel(self):
+        # initialization from Scott Egbert
+        # Power up select CH2 frequency mode (the high speed channel)
+        self.select_mode(b"$E2222*")
+
+    def select_low_freq_channel(self):
+        # initialization from Scott Egbert
+        # Power up select CH2 frequency mode (the low speed channel)
+        self.select_mode(b"$E2020*")
+
+    def select_mode(self, command):
+        # Anything already received was measured in the old mode; drop it
+        # here instead of closing and reopening the port
+        self.session.write(command)
+        self.session.reset_input_buffer()
+        self.clear_pending()
+
+    def readonce(self, size):
+        return self.session.read(size)
+
+    def writeonce(self, byt):
+        self.session.write(byt)
+
+    def open(self):
+        self.session.open()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def clear_pending(self):
+        self.decoder.reset()
+        for readings in self.pending.values():
+            readings.clear()
+
+    def poll(self, block=True):
+        """
+        Reads everything waiting in the OS buffer (waiting for at least one
+        byte if block is True) and decodes it into self.pending. Returns the
+        number of new readings.
+        """
+        size = self.session.in_waiting()
+        if not size:
+            if not block:
+                return 0
+            size = 1
+        data = self.session.read(size)
+        if not data:
+            raise IOError("Timed out waiting for data from " + str(self.COM))
+        readings = self.decoder.feed(data)
+        for channel, freq in readings:
+            self.pending.setdefault(channel, collections.deque()).append(freq)
+        return len(readings)
+
+    def read_available(self, channel=2, block=False):
+        """
+        Returns every reading on channel received so far as a NumPy array
+        """
+        readings = self.pending[channel]
+        self.poll(block and not readings)
+        while block and not readings:
+            self.poll()
+        return np.array([readings.popleft() for i in range(len(readings))])
+
+    def read_and_return_float(self, channel=2):
+        """
+        Returns the oldest reading on channel that has not been returned yet,
+        waiting for one if necessary
+        """
+        readings = self.pending[channel]
+        while not readings:
+            self.poll()
+        return readings.popleft()
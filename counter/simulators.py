@@ -0,0 +1,452 @@
+# %% package imports
+import threading
+import time
+import numpy as np
+import serial
+try:
+    from . import orionlasers as ol
+except ImportError:
+    import orionlasers as ol
+
+# %% global variables
+SIM_COUNTER_ID = "HEWLETT-PACKARD,53132A,0,SIM"
+SIM_GPIB_RESOURCE = "GPIB0::3::INSTR"
+SIM_COUNTER_PORT = "COMSIM1"
+SIM_LASER_PORT = "COMSIM2"
+
+# Frequencies the simulated combs start at, per counter channel (Hz)
+SIM_FREQS = {1: 199867900.421, 2: 199868526.215}
+
+
+# %% simulated signal
+class SimulatedSignal:
+    """
+    A frequency that drifts linearly and has white frequency noise,
+        f(t) = freq + offset + drift * t + noise * N(0, 1)
+    offset is there for actuators (e.g. a simulated reference laser) to move
+    the frequency.
+    """
+
+    def __init__(self, freq, noise=1.0, drift=0.0, seed=None):
+        self.freq = freq  # Hz
+        self.noise = noise  # Hz rms
+        self.drift = drift  # Hz/s
+        self.offset = 0.0  # Hz
+        self.rng = np.random.default_rng(seed)
+        self.t0 = time.perf_counter()
+
+    def value(self, t=None):
+        if t is None:
+            t = time.perf_counter()
+        return (
+            self.freq
+            + self.offset
+            + self.drift * (t - self.t0)
+            + self.noise * self.rng.standard_normal()
+        )
+
+
+# %% simulated HP 53132A
+class FakeVisaResource:
+    """
+    Stands in for the pyvisa resource of an HP 53132A. Understands the SCPI
+    subset used by hpcounters.AgilentCounter: every write is accepted, and the
+    commands below change the simulated state. A trigger starts a
+    measurement, which is ready gate_time + latency seconds later; read()
+    blocks until then, like the real counter.
+    """
+
+    def __init__(self, signals=None, latency=0.005, idn=SIM_COUNTER_ID):
+        if signals is None:
+            signals = {ch: SimulatedSignal(f) for ch, f in SIM_FREQS.items()}
+        self.signals = signals
+        self.latency = latency  # s
+        self.idn = idn
+        self.timeout = 2000  # ms, as in pyvisa
+
+        self.channel = 2
+        self.gate_time = 0.1
+        self.format = "ASCII"
+        self.stat_count = 100
+        self.stat_type = "MEAN"
+        self.stats_enabled = False
+        self.stats = {}
+        self.commands = []  # every command received, for inspection
+
+        self.output = []  # pending (ready_time, value)
+        self.lock = threading.Lock()
+
+    def write(self, command):
+        command = command.strip()
+        self.commands.append(command)
+        key = command.upper()
+        if key.startswith(":FUNC"):
+            self.channel = int(key.rstrip("'\"")[-1])
+        elif key.startswith(":FREQ:ARM:STOP:TIM"):
+            self.gate_time = float(key.split()[-1])
+        elif key.startswith(":FORM"):
+            self.format = key.split()[-1]
+        elif key.startswith(":CALC3:AVER:COUNT"):
+            self.stat_count = int(key.split()[-1])
+        elif key.startswith(":CALC3:AVER:TYPE"):
+            self.stat_type = key.split()[-1]
+        elif key.startswith(":CALC3:AVER:STAT"):
+            self.stats_enabled = key.split()[-1] in ("ON", "1")
+        elif key == ":INIT" and self.stats_enabled:
+            self._run_statistics()
+        elif key == "*RST":
+            self.output = []
+
+    def _run_statistics(self):
+        values = np.empty(self.stat_count)
+        for i in range(self.stat_count):
+            values[i] = self.signals[self.channel].value()
+        time.sleep(self.stat_count * self.gate_time)
+        self.stats = {
+            "MEAN": values.mean(),
+            "SDEV": values.std(ddof=1),
+            "MIN": values.min(),
+            "MAX": values.max(),
+        }
+
+    def assert_trigger(self):
+        with self.lock:
+            t = time.perf_counter() + self.gate_time
+            self.output.append((t + self.latency, self.signals[self.channel].value(t)))
+
+    def _next_value(self):
+        with self.lock:
+            if not self.output:
+                raise IOError("VI_ERROR_TMO: simulated counter was not triggered")
+            ready, value = self.output.pop(0)
+        delay = ready - time.perf_counter()
+        if delay > self.timeout / 1000:
+            time.sleep(self.timeout / 1000)
+            raise IOError("VI_ERROR_TMO: simulated counter timed out")
+        if delay > 0:
+            time.sleep(delay)
+        return value
+
+    def message_available(self):
+        with self.lock:
+            return bool(self.output) and self.output[0][0] <= time.perf_counter()
+
+    def read_stb(self):
+        # bit 4 (MAV) of the status byte: a result is ready to be read
+        return 0x10 if self.message_available() else 0x00
+
+    def read(self):
+        return "%+.12E\n" % self._next_value()
+
+    def read_binary_values(self, datatype="d", is_big_endian=True, **kwargs):
+        return [self._next_value()]
+
+    def query(self, command):
+        command = command.strip().upper()
+        if command == "*IDN?":
+            return self.idn + "\n"
+        if command == "*OPC?":
+            return "1\n"
+        self.write(command)
+        return "0\n"
+
+    def query_binary_values(self, command, datatype="d", is_big_endian=True, **kw):
+        if command.strip().upper().startswith(":CALC3:DATA?"):
+            return [self.stats.get(self.stat_type, np.nan)]
+        raise ValueError("simulated counter cannot answer " + command)
+
+    def before_close(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeGpibInterface:
+    """Stands in for the pyvisa GPIBInterface of the bus controller"""
+
+    def group_execute_trigger(self, *resources):
+        for resource in resources:
+            resource.assert_trigger()
+
+    def close(self):
+        pass
+
+
+class FakeResourceManager:
+    """
+    Stands in for pyvisa.ResourceManager, with one simulated counter on the
+    bus. Pass it to hpcounters.AgilentCounter(resource_manager=...).
+    """
+
+    def __init__(self, resources=None, **kwargs):
+        if resources is None:
+            resources = {SIM_GPIB_RESOURCE: FakeVisaResource(**kwargs)}
+        self.resources = resources
+
+    def list_resources(self, query="?*::INSTR"):
+        return tuple(self.resources)
+
+    def open_resource(self, resource_name, **kwargs):
+        if resource_name.upper().endswith("::INTFC"):
+            return FakeGpibInterface()
+        return self.resources[resource_name]
+
+    def close(self):
+        pass
+
+
+# %% simulated serial counter
+class FakeSerial:
+    """
+    Stands in for the serial.Serial of the serial counter. Once opened it
+    produces one b"F-CHn:<freq>\\r\\n" frame every period seconds, where the
+    frequency is 1010 MHz minus the simulated signal (the counter sits behind
+    a mixer), plus offset for the counter's own error. $E2222* / $E2020*
+    select channel 2 / channel 1 frames, as on the real counter.
+    """
+
+    def __init__(
+        self, signal=None, period=0.1, latency=0.002, port=SIM_COUNTER_PORT, offset=0.0
+    ):
+        self.signal = SimulatedSignal(SIM_FREQS[2]) if signal is None else signal
+        self.offset = offset  # Hz
+        self.period = period  # s
+        self.latency = latency  # s
+        self.port = port
+        self.baudrate = 9600
+        self.timeout = None
+        self.is_open = False
+
+        self.channel = 2
+        self.buffer = bytearray()
+        self.next_frame_time = None
+
+    @property
+    def portstr(self):
+        return self.port
+
+    def open(self):
+        self.is_open = True
+        self.buffer.clear()
+        self.next_frame_time = time.perf_counter() + self.period + self.latency
+
+    def close(self):
+        self.is_open = False
+
+    def _check_open(self):
+        if not self.is_open:
+            raise serial.SerialException("Attempting to use a port that is not open")
+
+    def _generate(self):
+        now = time.perf_counter()
+        while self.next_frame_time <= now:
+            freq = (
+                1010e6
+                - self.signal.value(self.next_frame_time - self.latency)
+                + self.offset
+            )
+            self.buffer += b"F-CH%i:%.3f\r\n" % (self.channel, freq)
+            self.next_frame_time += self.period
+
+    @property
+    def in_waiting(self):
+        self._check_open()
+        self._generate()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        self._check_open()
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        self._generate()
+        while len(self.buffer) < size:
+            wait = self.next_frame_time - time.perf_counter()
+            if deadline is not None:
+                wait = min(wait, deadline - time.perf_counter())
+                if wait <= 0:
+                    break
+            time.sleep(max(wait, 0))
+            self._generate()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def write(self, data):
+        self._check_open()
+        if data == b"$E2222*":
+            self.channel = 2
+        elif data == b"$E2020*":
+            self.channel = 1
+        return len(data)
+
+    def reset_input_buffer(self):
+        self._check_open()
+        self._generate()
+        self.buffer.clear()
+
+
+# %% simulated Orion laser
+class FakeOrionSerial:
+    """
+    Stands in for the serial.Serial of an ORION laser and answers the
+    pkt_gen/pkt_read packet protocol. Replies become readable after latency
+    plus the time it takes to send them at 9600 baud. If signal is given,
+    changing the volatile current moves signal.offset by hz_per_step per
+    0.1 mA, so feedback loops can be closed on the simulation.
+    """
+
+    def __init__(
+        self,
+        signal=None,
+        hz_per_step=-2.0,
+        latency=0.002,
+        port=SIM_LASER_PORT,
+        sn=12345,
+        pn="SIMORION",
+    ):
+        self.signal = signal
+        self.hz_per_step = hz_per_step  # Hz per 0.1 mA
+        self.latency = latency  # s
+        self.port = port
+        self.timeout = 0.1
+        self.is_open = True
+        self.baudrate = 9600
+
+        self.serial_enabled = False
+        self.values = {
+            0x04: 900,  # factory current
+            0x06: 10000,  # factory temp
+            0x08: sn,
+            0x1D: 900,  # volatile current
+            0x1F: 10000,  # volatile temp
+            0x26: 900,  # involatile current
+            0x28: 10000,  # involatile temp
+            0x42: int.from_bytes(pn.encode(), "big"),
+        }
+        # write command -> the read command whose value it sets
+        self.writes = {0x1E: 0x1D, 0x20: 0x1F, 0x27: 0x26, 0x29: 0x28}
+        self.buffer = bytearray()
+        self.pending = []  # (ready_time, response)
+        self.packets = 0
+
+    @property
+    def portstr(self):
+        return self.port
+
+    @property
+    def in_waiting(self):
+        self._deliver()
+        return len(self.buffer)
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def _deliver(self):
+        now = time.perf_counter()
+        while self.pending and self.pending[0][0] <= now:
+            self.buffer += self.pending.pop(0)[1]
+
+    def write(self, data):
+        data = bytearray(data)
+        size = len(data)
+        # Several packets may be written back to back
+        while data:
+            if data[0] != ol.HDR or len(data) < 3:
+                data.pop(0)
+                continue
+            length = data[2] + 2
+            self._respond(data[:length])
+            del data[:length]
+        return size
+
+    def _respond(self, pkt):
+        self.packets += 1
+        status = 0x00
+        val = None
+        if not ol.pkt_validate(pkt):
+            status = 0x01
+            cmd_id = pkt[6] if len(pkt) > 6 else 0
+            cmd_type = ol.TYPE_READ
+        else:
+            cmd_type, cmd_id = pkt[5], pkt[6]
+            arg = ol.bytes2num(pkt[7:-2])
+            if cmd_id == 0x24:
+                self.serial_enabled = True
+            elif cmd_id == 0x25:
+                self.serial_enabled = False
+            elif cmd_id in self.writes:
+                lim = ol.LIMITS_DEFAULT.get(cmd_id)
+                if lim is not None and not lim[0] <= arg <= lim[1]:
+                    status = 0x30
+                else:
+                    read_id = self.writes[cmd_id]
+                    if read_id == 0x1D and self.signal is not None:
+                        change = arg - self.values[read_id]
+                        self.signal.offset += change * self.hz_per_step
+                    self.values[read_id] = arg
+                val = self.values[read_id]
+            elif cmd_id in self.values:
+                val = self.values[cmd_id]
+            elif cmd_id in ol.COMMAND_NAMES:
+                val = 0
+            else:
+                status = 0x08
+
+        resp = (
+            bytearray([ol.HDR, pkt[1], 0x00, ol.ID_LASER, ol.ID_COMPUTER])
+            + bytearray([cmd_type, status, cmd_id])
+            + ol.num2bytes(val)
+            + b"\x00"
+            + ol.FTRCHR
+        )
+        resp[2] = len(resp) - 2
+        resp[-2] = ol.chksum_gen(resp)
+
+        # 10 bits per byte on the wire
+        start = max([time.perf_counter()] + [t for t, r in self.pending[-1:]])
+        ready = start + self.latency + 10 * (len(pkt) + len(resp)) / self.baudrate
+        self.pending.append((ready, bytes(resp)))
+
+    def read(self, size=1):
+        deadline = time.perf_counter() + (self.timeout or 0)
+        self._deliver()
+        while len(self.buffer) < size and self.pending:
+            wait = min(self.pending[0][0], deadline) - time.perf_counter()
+            if wait <= 0 and time.perf_counter() >= deadline:
+                break
+            time.sleep(max(wait, 0))
+            self._deliver()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self.buffer.clear()
+        self.pending = []
+
+
+# %% convenience constructors
+def make_counters(
+    noise=1.0, drift=0.0, latency=0.005, period=None, seed=None, chin_offset=0.0
+):
+    """
+    Returns (resource_manager, serial_port, signals) for a simulated HP
+    counter on channel 1 and serial counter on channel 2 of the usual setup.
+    The HP counter measures both signals; the serial counter reads channel 2
+    off by chin_offset.
+    """
+    rng = np.random.default_rng(seed)
+    signals = {
+        ch: SimulatedSignal(f, noise, drift, rng.integers(2**31))
+        for ch, f in SIM_FREQS.items()
+    }
+    resource_manager = FakeResourceManager(
+        {SIM_GPIB_RESOURCE: FakeVisaResource(signals, latency)}
+    )
+    serial_port = FakeSerial(
+        signals[2], 0.1 if period is None else period, latency, offset=chin_offset
+    )
+    return resource_manager, serial_port, signals
@@ -0,0 +1,355 @@
+# %% package imports
+import numpy as np
+
+
+# %% function defs
+def median_mad(values):
+    """
+    Returns (median, MAD) of values, where MAD is the median absolute
+    deviation scaled by 1.4826 so that it estimates the standard deviation
+    of normally distributed data
+    """
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return np.nan, np.nan
+    median = np.median(values)
+    return median, 1.4826 * np.median(abs(values - median))
+
+
+def window_stats(values):
+    """Returns a dict of statistics of a block of values, e.g. a ring buffer window"""
+    values = np.asarray(values, dtype=float)
+    count = len(values)
+    median, mad = median_mad(values)
+    return dict(
+        count=count,
+        mean=values.mean() if count else np.nan,
+        std=values.std(ddof=1) if count > 1 else np.nan,
+        min=values.min() if count else np.nan,
+        max=values.max() if count else np.nan,
+        median=median,
+        mad=mad,
+    )
+
+
+def buffer_stats(buffer, n):
+    """
+    Statistics (see window_stats) of the last n readings in an
+    acquisition.RingBuffer, plus the time span they cover
+    """
+    times, values = buffer.latest(n)
+    result = window_stats(values)
+    result["span"] = times[-1] - times[0] if len(times) else 0.0
+    return result
+
+
+# %% running statistics
+class RunningStats:
+    """
+    Mean, variance, min and max of everything passed to update() since the
+    last reset(). A batch is folded in with the parallel form of Welford's
+    algorithm, so the cost is O(1) per sample, vectorized over the batch,
+    and there is no loss of precision from summing large frequencies.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = np.nan
+        self.m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+
+    def update(self, values):
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        n = len(values)
+        if not n:
+            return
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        if not self.count:
+            self.count, self.mean, self.m2 = n, mean, m2
+            self.min, self.max = values.min(), values.max()
+            return
+
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    @property
+    def var(self):
+        if self.count < 2:
+            return np.nan
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+class EWMA:
+    """
+    Exponentially weighted moving average,
+        s[n] = (1 - alpha) s[n - 1] + alpha y[n]
+    A batch of k samples is folded in with one weighted sum instead of k
+    Python-level steps.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self):
+        self.value = np.nan
+        self.count = 0
+
+    def update(self, values):
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        k = len(values)
+        if not k:
+            return self.value
+        if not self.count:
+            # start from the first sample rather than from zero
+            self.value = values[0]
+            values = values[1:]
+            k -= 1
+        decay = 1 - self.alpha
+        weights = self.alpha * decay ** np.arange(k - 1, -1, -1)
+        self.value = decay**k * self.value + (weights * values).sum()
+        self.count += k + (self.count == 0)
+        return self.value
+
+
+class RollingStats:
+    """
+    Mean and variance of the last size samples. The window's sums are updated
+    as samples enter and leave it, so update() is O(1) per sample; min, max,
+    median and MAD are computed over the window when asked for.
+    """
+
+    def __init__(self, size):
+        self.size = int(size)
+        self.values = np.zeros(self.size)
+        self.reset()
+
+    def reset(self):
+        self.values[:] = 0
+        self.head = 0  # total number of samples seen
+        self.offset = None
+        self.sum = 0.0
+        self.sumsq = 0.0
+
+    def update(self, values):
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        if not len(values):
+            return
+        if self.offset is None:
+            # Sums are taken relative to the first sample to keep precision
+            self.offset = values[0]
+        new = values[-self.size :] - self.offset
+        head = self.head + len(values) - len(new)
+
+        # The slots about to be overwritten hold the samples leaving the
+        # window (or zero if they were never written)
+        idx = np.arange(head, head + len(new)) % self.size
+        leaving = self.values[idx]
+        self.sum += new.sum() - leaving.sum()
+        self.sumsq += (new**2).sum() - (leaving**2).sum()
+        self.values[idx] = new
+
+        # Recompute the sums from scratch once per trip around the window so
+        # rounding errors cannot build up
+        if head // self.size != (head + len(new)) // self.size:
+            self.sum = self.values.sum()
+            self.sumsq = (self.values**2).sum()
+        self.head = head + len(new)
+
+    def __len__(self):
+        return min(self.head, self.size)
+
+    def window(self):
+        n = len(self)
+        idx = np.arange(self.head - n, self.head) % self.size
+        return self.values[idx] + self.offset
+
+    @property
+    def mean(self):
+        n = len(self)
+        if not n:
+            return np.nan
+        return self.offset + self.sum / n
+
+    @property
+    def var(self):
+        n = len(self)
+        if n < 2:
+            return np.nan
+        return max(0.0, (self.sumsq - self.sum**2 / n) / (n - 1))
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def stats(self):
+        return window_stats(self.window())
+
+
+# %% outlier rejection
+class HampelFilter:
+    """
+    Flags outliers in a stream of readings: a reading is rejected if it is
+    more than threshold times the MAD (see median_mad) away from the median
+    of the window readings before it. The MAD is floored at min_spread, so a
+    run of identical readings does not make every change an outlier.
+
+    The test only looks back, so it adds no delay in front of a feedback
+    loop. A batch is tested with one vectorized median over all of its
+    windows. Readings with fewer than window readings before them are
+    accepted. The parameters may be changed between updates; bad values
+    raise ValueError.
+    """
+
+    def __init__(self, window=21, threshold=5.0, min_spread=0.0):
+        self.window = window
+        self.threshold = threshold
+        self.min_spread = min_spread
+        self.reset()
+
+    @property
+    def window(self):
+        return self._window
+
+    @window.setter
+    def window(self, window):
+        if not int(window) >= 1:
+            raise ValueError("window must be at least 1")
+        self._window = int(window)
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, threshold):
+        if not threshold > 0:
+            raise ValueError("threshold must be positive")
+        self._threshold = threshold
+
+    @property
+    def min_spread(self):
+        return self._min_spread
+
+    @min_spread.setter
+    def min_spread(self, min_spread):
+        if not min_spread >= 0:
+            raise ValueError("min_spread must not be negative")
+        self._min_spread = min_spread
+
+    def reset(self):
+        self.history = np.zeros(0)  # the last window readings
+        self.rejected = 0
+
+    def update(self, values):
+        """Returns a boolean array, True for the values that are accepted"""
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        k = len(values)
+        good = np.ones(k, dtype=bool)
+        if not k:
+            return good
+        w = self.window
+        h = len(self.history)
+        history = np.concatenate((self.history, values))
+
+        # values[i] is history[h + i]; its window starts at history[h + i - w]
+        first = max(0, w - h)
+        if first < k:
+            windows = np.lib.stride_tricks.sliding_window_view(history, w)[
+                h + first - w : h + k - w
+            ]
+            median = np.median(windows, axis=1)
+            mad = 1.4826 * np.median(abs(windows - median[:, None]), axis=1)
+            good[first:] = abs(values[first:] - median) <= self.threshold * np.maximum(
+                mad, self.min_spread
+            )
+        self.history = history[-w:]
+        self.rejected += int(k - good.sum())
+        return good
+
+
+# %% recursive least squares
+class RecursiveLeastSquares:
+    """
+    Least-squares fit of y = X theta, updated as data arrives, with
+    exponential forgetting: every new sample scales the weight of all older
+    ones by forgetting, so the fit follows slow changes with a memory of
+    about 1 / (1 - forgetting) samples.
+
+    The fit is kept in information form (the weighted normal equations), so
+    a batch of k samples is folded in with one matrix product rather than k
+    rank-one updates; the result is the same as k steps of the usual RLS
+    recursion. prior_precision (per parameter) ties theta to prior when
+    there is little data; it is not forgotten.
+    """
+
+    def __init__(self, num_params, forgetting=1.0, prior=None, prior_precision=0.0):
+        self.num_params = int(num_params)
+        self.forgetting = forgetting
+        self.prior = np.zeros(self.num_params) if prior is None else np.asarray(prior)
+        self.prior_precision = np.diag(
+            np.broadcast_to(np.asarray(prior_precision, dtype=float), self.num_params)
+        )
+        self.reset()
+
+    def reset(self):
+        p = self.num_params
+        self.xx = np.zeros((p, p))  # sum of w x x^T
+        self.xy = np.zeros(p)  # sum of w x y
+        self.yy = 0.0  # sum of w y^2
+        self.weight = 0.0  # sum of w
+        self.count = 0
+
+    def update(self, X, y):
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        X = np.asarray(X, dtype=float).reshape(len(y), self.num_params)
+        k = len(y)
+        if not k:
+            return
+        w = self.forgetting ** np.arange(k - 1, -1, -1)
+        decay = self.forgetting**k
+        self.xx = decay * self.xx + (X.T * w) @ X
+        self.xy = decay * self.xy + (X.T * w) @ y
+        self.yy = decay * self.yy + (w * y**2).sum()
+        self.weight = decay * self.weight + w.sum()
+        self.count += k
+
+    @property
+    def theta(self):
+        return np.linalg.solve(
+            self.xx + self.prior_precision,
+            self.xy + self.prior_precision @ self.prior,
+        )
+
+    @property
+    def residual_var(self):
+        """Weighted variance of the residuals y - X theta"""
+        dof = self.weight - self.num_params
+        if dof <= 0:
+            return np.nan
+        theta = self.theta
+        sse = self.yy - 2 * theta @ self.xy + theta @ self.xx @ theta
+        return max(0.0, sse) / dof
+
+    @property
+    def covariance(self):
+        """Covariance of theta, from the scatter of the residuals"""
+        return self.residual_var * np.linalg.inv(self.xx + self.prior_precision)
+
+    @property
+    def std(self):
+        return np.sqrt(np.diag(self.covariance))
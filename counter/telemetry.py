@@ -0,0 +1,193 @@
+# %% package imports
+import threading
+import collections
+import numpy as np
+
+# %% global variables
+# What publish() does when a subscriber's queue is full
+DROP_OLDEST = "drop_oldest"  # make room by discarding the oldest readings
+BLOCK = "block"  # wait up to block_timeout for the subscriber, then drop
+
+DEFAULT_MAXLEN = 4096  # readings queued per subscriber
+DEFAULT_BLOCK_TIMEOUT = 1.0  # s
+
+
+# %% bus
+class Subscription:
+    """
+    A subscriber's queue of (times, values) batches on one topic. Readings
+    that had to be discarded are counted in self.dropped.
+    """
+
+    def __init__(self, bus, topic, maxlen, policy, block_timeout):
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError("Unknown back-pressure policy " + str(policy))
+        self.bus = bus
+        self.topic = topic
+        self.maxlen = maxlen
+        self.policy = policy
+        self.block_timeout = block_timeout  # s
+        self.batches = collections.deque()
+        self.count = 0  # readings queued
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def _put(self, times, values):
+        with self.cond:
+            if self.policy == BLOCK:
+                self.cond.wait_for(
+                    lambda: self.count + len(times) <= self.maxlen, self.block_timeout
+                )
+            self.batches.append((times, values))
+            self.count += len(times)
+            while self.count > self.maxlen:
+                times, values = self.batches.popleft()
+                excess = self.count - self.maxlen
+                if excess < len(times):
+                    self.batches.appendleft((times[excess:], values[excess:]))
+                    self.dropped += excess
+                    self.count -= excess
+                else:
+                    self.dropped += len(times)
+                    self.count -= len(times)
+            self.cond.notify_all()
+
+    def drain(self, timeout=0):
+        """
+        Returns (times, values) of everything queued, waiting up to timeout
+        seconds (None: forever) for something to arrive
+        """
+        with self.cond:
+            if not self.count and timeout != 0:
+                self.cond.wait_for(lambda: self.count, timeout)
+            batches = list(self.batches)
+            self.batches.clear()
+            self.count = 0
+            self.cond.notify_all()
+        if not batches:
+            return np.zeros(0), np.zeros(0)
+        if len(batches) == 1:
+            return batches[0]
+        return (
+            np.concatenate([times for times, values in batches]),
+            np.concatenate([values for times, values in batches]),
+        )
+
+    def clear(self):
+        self.drain()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class TelemetryBus:
+    """
+    In-process publish/subscribe of timestamped readings. A producer calls
+    publish(topic, times, values) once per batch; every subscriber to topic
+    gets the batch in its own bounded queue, so consumers work at their own
+    pace. With the DROP_OLDEST policy a slow subscriber loses its oldest
+    readings and never holds up the producer or anyone else; with BLOCK the
+    producer waits for it, at most block_timeout, which suits consumers that
+    must see everything, like a logger.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}  # topic -> tuple of Subscriptions
+
+    def subscribe(
+        self,
+        topic,
+        maxlen=DEFAULT_MAXLEN,
+        policy=DROP_OLDEST,
+        block_timeout=DEFAULT_BLOCK_TIMEOUT,
+    ):
+        subscription = Subscription(self, topic, maxlen, policy, block_timeout)
+        with self.lock:
+            subs = self.subscriptions.get(topic, ())
+            self.subscriptions[topic] = subs + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subs = self.subscriptions.get(subscription.topic, ())
+            self.subscriptions[subscription.topic] = tuple(
+                s for s in subs if s is not subscription
+            )
+
+    def publish(self, topic, times, values):
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        if not len(times):
+            return
+        # subscriptions[topic] is replaced, never modified, so no lock needed
+        for subscription in self.subscriptions.get(topic, ()):
+            subscription._put(times, values)
+
+    def consume(self, topic, callback, name=None, **kwargs):
+        """
+        Calls callback(times, values) on a thread of its own with every batch
+        published on topic. Returns the Consumer; call its stop() when done.
+        """
+        consumer = Consumer(self.subscribe(topic, **kwargs), callback, name)
+        consumer.start()
+        return consumer
+
+
+class Consumer(threading.Thread):
+    """Feeds a Subscription to a callback on its own thread"""
+
+    def __init__(self, subscription, callback, name=None):
+        super().__init__(name=name, daemon=True)
+        self.subscription = subscription
+        self.callback = callback
+        self.error = None
+        self._shutdown = threading.Event()
+
+    def run(self):
+        while not self._shutdown.is_set():
+            times, values = self.subscription.drain(timeout=0.1)
+            if not len(times):
+                continue
+            try:
+                self.callback(times, values)
+            except Exception as e:
+                self.error = e
+
+    def stop(self, timeout=None):
+        self._shutdown.set()
+        self.subscription.close()
+        if self.is_alive():
+            self.join(timeout)
+
+
+# %% socket bridge
+class SocketBridge:
+    """
+    Forwards topics to other processes through an
+    AsyncSocketComms.AsyncSocketServer: every reading goes to every connected
+    client as a line "<topic> <time> <value>". Clients that cannot keep up
+    miss lines rather than slowing anything down.
+    """
+
+    def __init__(self, bus, topics, server, maxlen=DEFAULT_MAXLEN):
+        self.server = server
+        self.consumers = [
+            bus.consume(
+                topic,
+                lambda times, values, topic=topic: self.forward(topic, times, values),
+                name="telemetry bridge " + topic,
+                maxlen=maxlen,
+            )
+            for topic in topics
+        ]
+
+    def forward(self, topic, times, values):
+        self.server.broadcast(
+            "".join("%s %.6f %.6f\n" % (topic, t, v) for t, v in zip(times, values))
+        )
+
+    def close(self):
+        for consumer in self.consumers:
+            consumer.stop(1)
+        self.server.stopListening()
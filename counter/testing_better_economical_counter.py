@@ -1,27 +1,14 @@
-import time
-import threading
-import serial as serial
-import numpy as np
-import matplotlib.pyplot as plt
-from PyQt5.QtCore import QObject, pyqtSignal
+from serialcounters import Counter
 
 # %%
-ser = serial.Serial()
-ser.baudrate = 9600
-ser.port = 'COM5'
+counter = Counter('COM5')
+counter.open()
 
 
 # %%
-def read(ser, N):
-    ser.open()
-    _ = ser.read(N)
-    print(_)
-    ser.close()
-    return float(str(_).split("CH2:")[1].split("\\r")[0])
-
-
 List = []
 while True:
-    value = read(ser, 29)
-    List.append(value)
-    print(value)
+    # every reading that has come in since the last pass, not just one
+    values = counter.read_available(2, block=True)
+    List.extend(values)
+    print(values)
@@ -189,8 +189,8 @@ class ApplicationWindow(QtGui.QMainWindow, tempcontGUI):
     def timerHandler(self):
         ########################## IPC for Oscillator setpoint #################################
         self.setpoint_max_adjust = 5.
-        line = self.IPC_serv.run()
-        if line:
+        # Every line received since the last tick, oldest first
+        for line in self.IPC_serv.get_lines():
             if line == 'COMMITADJUST':
                 # Add adjust value to set point and then set adjust value to 0
                 newSetPoint = self.requested_setpoints[self.ctrl_i['Oscillator']] + self.setpoint_adjust_Oscillator
@@ -218,8 +218,8 @@ class ApplicationWindow(QtGui.QMainWindow, tempcontGUI):
             # self.setTempSetpoint('Oscillator') #sets temperature setpoint for box
 
         # ...and now for transceiver
-        line = self.IPC_servt.run()
-        if line:
+        # Every line received since the last tick, oldest first
+        for line in self.IPC_servt.get_lines():
             if line == 'COMMITADJUST':
                 # Add adjust value to set point and then set adjust value to 0
                 newSetPoint = self.requested_setpoints[self.ctrl_i['Transceiver']] + self.setpoint_adjust_Transceiver
@@ -23,6 +23,12 @@ from SuperLaserLand_JD2 import SuperLaserLand_JD2
 # To communication with the temperature controller process
 import AsyncSocketComms
 
+# To share the counter readings with other processes
+try:
+    import sharedring
+except ImportError:
+    sharedring = None  # needs python >= 3.8
+
 import weakref
 
 
@@ -52,6 +58,7 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
             print('Error: no connection to temp control')
             
         self.last_update_freq = time.clock()
+        self.openSharedRing()
         self.initUI()
         self.openOutputFiles()
         self.initSL()
@@ -83,6 +90,25 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
             self.client = None
         end_time = time.clock()
         print('openTCPConnection(): Time taken: %f sec' % (end_time-start_time))
+    def openSharedRing(self):
+        # The in-loop counter readings are published to a shared memory ring
+        # named lockbox_counter<output_number>; read them from another
+        # process with sharedring.SharedRing.attach(name)
+        self.ring = None
+        if sharedring is None:
+            return
+        name = 'lockbox_counter%d' % self.output_number
+        try:
+            self.ring = sharedring.SharedRing.create(name)
+        except Exception as e:
+            print('No shared memory ring %s (%s)' % (name, e))
+
+    def closeEvent(self, event):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        super(FreqErrorWindowWithTempControlV2, self).closeEvent(event)
+
     def initBuffer(self):
 #        print('initBuffer')
         self.gate_time_counter = 100e6/self.sl.fs
@@ -386,7 +412,7 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
 
                         try:                        
                             print('Sending a new setpoint: %f degrees' % self.setpoint_change)
-                            self.client.send_text('%f\n' % self.setpoint_change)
+                            self.client.send_setpoint('%f\n' % self.setpoint_change)
                         except:
                             e = sys.exc_info()[0]
                             # If we get here, this probably means that the TCP connection to the temperature controller was lost.
@@ -539,6 +565,11 @@ class FreqErrorWindowWithTempControlV2(QtGui.QWidget):
                     self.file_output_counter0.write(freq_counter_samples)
                 elif self.output_number == 1:
                     self.file_output_counter1.write(freq_counter_samples)
+
+                if self.ring is not None:
+                    # The last sample is the newest, one gate time apart
+                    sample_times = time.perf_counter() - self.gate_time_counter * np.arange(len(freq_counter_samples))[::-1]
+                    self.ring.push_many(sample_times, freq_counter_samples)
                             
                 # Record the new chunk of data in the buffer:
 #                print('len = %d' % len(freq_counter_samples))
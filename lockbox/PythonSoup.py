@@ -238,9 +238,15 @@ class PythonSoup(QtGui.QDialog):
         return
         
     def readFrequency(self):
+        # Send every query before reading any reply, to save a bus round trip
+        # per counter. This only fetches each free-running counter's last
+        # reading, so the readings are not simultaneous; on Python 3 use
+        # counter/hpcounters.CounterGroup (one Group Execute Trigger) for that
+        for counter in self.counters:
+            counter.write(':FETCH:FREQUENCY?')
         self.frequencies = []
         for counter in self.counters:
-            freq = float(counter.ask(':FETCH:FREQUENCY?'))
+            freq = float(counter.read())
             self.frequencies.append(freq)
             print(freq)
 #        counter = self.counters[0]
@@ -0,0 +1,214 @@
+# %% package imports
+import os
+import sys
+import struct
+import time
+import ctypes
+import numpy as np
+from multiprocessing import shared_memory
+
+try:
+    from multiprocessing import resource_tracker
+except ImportError:
+    resource_tracker = None
+
+# %% global variables
+# Every segment starts with a HEADER_SIZE byte header, then capacity records
+# of RECORD_DTYPE. Header fields (little endian):
+#   magic, capacity (u8), head = total records written (u8),
+#   claim = head once the write in progress is done (u8),
+#   epoch (f8) = time.time() - time.perf_counter() when the ring was created,
+#   pid (u8) of the writer
+MAGIC = b"SHRING2\x00"
+HEADER_SIZE = 64
+HEADER = struct.Struct("<8sQQQdQ")
+HEAD_OFFSET = 16
+RECORD_DTYPE = np.dtype([("time", "<f8"), ("value", "<f8")])
+
+DEFAULT_CAPACITY = 2**16
+
+
+# %% function defs
+def process_alive(pid):
+    """Whether a process with this pid is running (on this machine)"""
+    if sys.platform == "win32":
+        # os.kill would terminate the process on Windows
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+            return code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# %% shared ring buffer
+class SharedRing:
+    """
+    A RingBuffer (see acquisition.py) of (time, value) records in shared
+    memory, so other processes, e.g. the lockbox or the temperature
+    controller, can read a stream without any copying through sockets.
+
+    There is one writer: the process that created the ring with create(),
+    whose pid is kept in the header.
+    Readers attach() by name. Writes are bracketed as in a seqlock: the
+    writer first advances claim past the records it is about to write,
+    writes them, and only then advances head to match. A reader copies the
+    records below head and then checks claim: any record the writer may have
+    overwritten meanwhile (older than claim - capacity) is discarded and
+    counted as dropped, so a reader never retries and never blocks the
+    writer.
+
+    Times are time.perf_counter() values, which come from the system-wide
+    monotonic clock on Windows and Linux and so are comparable between
+    processes; add self.epoch to get unix time.
+    """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.name = shm.name
+        self.owner = owner
+        magic, capacity, head, claim, epoch, pid = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a shared ring" % self.name)
+        self.capacity = capacity
+        self.epoch = epoch
+        self.pid = pid
+        self.header = np.ndarray(2, "<u8", shm.buf, HEAD_OFFSET)  # head, claim
+        self.records = np.ndarray(capacity, RECORD_DTYPE, shm.buf, HEADER_SIZE)
+
+    @classmethod
+    def create(cls, name, capacity=DEFAULT_CAPACITY):
+        """
+        Creates the ring name, with this process as its writer. A ring of
+        that name left behind by a writer that is no longer running is
+        replaced; if its writer is still running, FileExistsError is raised.
+        """
+        size = HEADER_SIZE + capacity * RECORD_DTYPE.itemsize
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            cls.remove_stale(name)
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        epoch = time.time() - time.perf_counter()
+        HEADER.pack_into(shm.buf, 0, MAGIC, capacity, 0, 0, epoch, os.getpid())
+        return cls(shm, owner=True)
+
+    @staticmethod
+    def remove_stale(name):
+        stale = shared_memory.SharedMemory(name)
+        try:
+            magic = pid = None
+            if stale.size >= HEADER.size:
+                magic, _, _, _, _, pid = HEADER.unpack_from(stale.buf, 0)
+            if magic == MAGIC and process_alive(pid):
+                raise FileExistsError(
+                    "Shared ring %s is in use by process %i" % (name, pid)
+                )
+        finally:
+            stale.close()
+        # left behind by a writer that did not exit cleanly
+        stale.unlink()
+
+    @classmethod
+    def attach(cls, name):
+        # The segment belongs to the writer; it must not be destroyed when
+        # this process exits
+        try:
+            shm = shared_memory.SharedMemory(name, track=False)  # python >= 3.13
+        except TypeError:
+            shm = shared_memory.SharedMemory(name)
+            if resource_tracker is not None:
+                try:
+                    resource_tracker.unregister(shm._name, "shared_memory")
+                except Exception:
+                    pass
+        return cls(shm, owner=False)
+
+    @property
+    def head(self):
+        return int(self.header[0])
+
+    def push(self, t, value):
+        self.push_many([t], [value])
+
+    def push_many(self, times, values):
+        n = len(times)
+        if not n:
+            return
+        times = np.asarray(times)[-self.capacity :]
+        values = np.asarray(values)[-self.capacity :]
+        head = int(self.header[0]) + n - len(times)
+        idx = np.arange(head, head + len(times)) % self.capacity
+
+        self.header[1] = head + len(times)
+        self.records["time"][idx] = times
+        self.records["value"][idx] = values
+        self.header[0] = head + len(times)
+
+    def read(self, cursor, head=None):
+        """
+        Returns (times, values, new_cursor, dropped) for every record written
+        since cursor, as RingBuffer.read does
+        """
+        if head is None:
+            head = int(self.header[0])
+        start = max(cursor, head - self.capacity)
+        records = self.records[np.arange(start, head) % self.capacity]
+
+        # Drop whatever the writer has claimed (and may have overwritten)
+        # since the copy began
+        overrun = min(int(self.header[1]) - self.capacity - start, len(records))
+        if overrun > 0:
+            records = records[overrun:]
+            start += overrun
+        return records["time"], records["value"], head, start - cursor
+
+    def latest(self, n=1):
+        head = self.head
+        n = min(n, head, self.capacity)
+        times, values, _, _ = self.read(head - n, head)
+        return times, values
+
+    def reader(self, from_start=False):
+        return SharedRingReader(self, from_start)
+
+    def __len__(self):
+        return min(self.head, self.capacity)
+
+    def close(self):
+        """Detaches; the writer also destroys the segment"""
+        self.header = self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedRingReader:
+    """A reader's cursor into a SharedRing, like acquisition.RingReader"""
+
+    def __init__(self, ring, from_start=False):
+        self.ring = ring
+        head = ring.head
+        self.cursor = max(0, head - ring.capacity) if from_start else head
+        self.dropped = 0
+
+    def drain(self):
+        times, values, self.cursor, dropped = self.ring.read(self.cursor)
+        self.dropped += dropped
+        return times, values
+
+    def pending(self):
+        return self.ring.head - self.cursor
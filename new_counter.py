@@ -1,68 +1,9 @@
 import time
 import matplotlib.pyplot as plt
 import numpy as np
-import serial
 import clipboard_and_style_sheet
 import counter.hpcounters as HPC
-
-
-class Counter:
-    def __init__(self, COM):
-        # initialize the Serial instance
-        self.ser = serial.Serial()
-
-        # set the serial's communication port
-        self.COM = COM
-
-        # the baudrate should already be 9600, but just so you know
-        self.ser.baudrate = 9600
-
-    @property
-    def COM(self):
-        return self.ser.port
-
-    @COM.setter
-    def COM(self, port):
-        assert type(port) == str, f"the port must be a string, but got: {port}"
-        assert port[:3] == 'COM', f"the port must start with 'COM' but got {port}"
-
-        self.ser.port = port
-
-    def select_high_freq_channel(self):
-        # initialization from Scott Egbert
-        # Power up select CH2 frequency mode (the high speed channel)
-        self.open()
-        self.ser.write(b"$E2222*")
-        self.close()
-
-    def select_low_freq_channel(self):
-        # initialization from Scott Egbert
-        # Power up select CH2 frequency mode (the high speed channel)
-        self.open()
-        self.ser.write(b"$E2020*")
-        self.close()
-
-    def readonce(self, size):
-        self.open()
-        read = self.ser.read(size)
-        self.close()
-        return read
-
-    def writeonce(self, byt):
-        self.open()
-        self.ser.write(byt)
-        self.close()
-
-    def open(self):
-        self.ser.open()
-
-    def close(self):
-        self.ser.close()
-
-    def read_and_return_float(self):
-        dat = str(self.ser.read(29))
-        dat = float((dat.split('F-CH2:')[1]).split('\\r')[0])
-        return dat
+from counter.serialcounters import Counter
 
 
 # %% test 1
@@ -113,35 +54,18 @@ class Counter:
 # Data2 = np.zeros(npts)
 # counter = Counter('COM18')
 # 
-# # initially open
-# counter.open()
-# for i in range(npts):
-#     # select low frequency channel
-#     counter.ser.write(b"$E2020*")
-# 
-#     # close and open
-#     counter.close()
-#     counter.open()
-# 
-#     # read
-#     dat = str(counter.ser.read(100))
-# 
-#     # select high frequency
-#     counter.ser.write(b"$E2222*")
-# 
-#     # close and open
-#     counter.close()
-#     counter.open()
-# 
-#     dat = float((dat.split('F-CH1:')[1]).split('\\r')[0])
-#     Data1[i] = dat
-# 
-#     # read
-#     dat = str(counter.ser.read(100))
-#     dat = float((dat.split('F-CH2:')[1]).split('\\r')[0])
-#     Data2[i] = dat
-# 
-#     print(i)
+# # the port stays open while switching channels
+# with counter:
+#     for i in range(npts):
+#         # select low frequency channel and read
+#         counter.select_low_freq_channel()
+#         Data1[i] = counter.read_and_return_float(1)
+#
+#         # select high frequency channel and read
+#         counter.select_high_freq_channel()
+#         Data2[i] = counter.read_and_return_float(2)
+#
+#         print(i)
 
 # %% test2 for green counter
 npts = 1000
@@ -153,26 +77,23 @@ hpc_channel = 2
 
 # initially open
 chin_cnt.open()
-# chin_cnt.ser.write(b"$E2020*")
-chin_cnt.ser.write(b"$E2222*")
-chin_cnt.ser.read(100)
-chin_cnt.close()
-chin_cnt.open()
+# chin_cnt.select_low_freq_channel()
+chin_cnt.select_high_freq_channel()
+chin_cnt.readonce(100)
 
 for i in range(npts):
     # read
     hpc.begin_freq_measure(hpc_channel)
     first = hpc.get_result()
 
-    dat = str(chin_cnt.ser.read(29))
+    # dat = chin_cnt.read_and_return_float(1)
+    dat = chin_cnt.read_and_return_float(2)
 
     hpc.begin_freq_measure(hpc_channel)
     second = hpc.get_result()
 
     Data_hpc[i] = 1010e6 - (first + second) / 2
 
-    # dat = float((dat.split('F-CH1:')[1]).split('\\r')[0])
-    dat = float((dat.split('F-CH2:')[1]).split('\\r')[0])
     Data_chin[i] = dat
 
     print(i, dat, Data_hpc[i])